@@ -0,0 +1,266 @@
+"""
+Batched forwarding for the AMT data plane.
+
+Instead of one recvfrom() and one sendto() per datagram, the socket is drained in bursts
+into a preallocated ring of buffers and every burst is forwarded in one go. On Linux this
+uses recvmmsg(2)/sendmmsg(2) through ctypes, so a burst costs two system calls; elsewhere it
+falls back to a non-blocking recv_into()/sendto() loop, which still saves the per-packet
+poll and interpreter overhead of the single-packet loop.
+"""
+import ctypes
+import errno
+import select
+import socket
+import time
+
+from constants import DEFAULT_MTU
+from datapath import udp_payload, udp_payload_bounds
+
+MSG_WAITFORONE = 0x10000
+DEFAULT_BATCH_SIZE = 32
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_uint16),
+        ("sin_addr", ctypes.c_uint8 * 4),
+        ("sin_zero", ctypes.c_uint8 * 8),
+    ]
+
+
+def _load_libc():
+    # The interpreter is linked against libc, so its own symbol table exposes recvmmsg/sendmmsg
+    # (ctypes.util.find_library would spawn subprocesses and slow down the tunnel's start)
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except (OSError, TypeError):
+        return None
+    if not (hasattr(libc, "recvmmsg") and hasattr(libc, "sendmmsg")):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+def mmsg_supported():
+    """
+    :return: True if recvmmsg/sendmmsg are available on this platform
+    """
+    return _libc is not None
+
+
+class BatchForwarder:
+    """
+    Receives AMT Multicast Data bursts from the tunnel socket and forwards the UDP payloads
+    to a sink from transport.py.
+
+    The tunnel socket keeps its timeout semantics: forward_burst() raises socket.timeout if
+    nothing arrives within sock.gettimeout() seconds. Other AMT messages arriving in a burst are
+    passed to on_control(message), which returns True if it handled the message. Forwarded payloads
+    are accounted in metrics (a TunnelMetrics from metrics.py), if given.
+    """
+
+    def __init__(self, sock, sink, batch_size=DEFAULT_BATCH_SIZE, use_mmsg=None, on_control=None, metrics=None):
+        self.sock = sock
+        self.sink = sink
+        self.on_control = on_control
+        self.metrics = metrics
+        self.batch_size = batch_size
+        self.use_mmsg = mmsg_supported() if use_mmsg is None else use_mmsg and mmsg_supported()
+        # sendmmsg only applies to the UDP transport; stream transports get one writev() per burst
+        self.send_mmsg = self.use_mmsg and sink.name == "udp"
+
+        # Preallocated ring of receive buffers, reused for every burst
+        self.buffers = [bytearray(DEFAULT_MTU) for _ in range(batch_size)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        self.sizes = [0] * batch_size
+        self.dropped = 0
+
+        if self.use_mmsg:
+            self._setup_mmsg()
+        else:
+            # A timed socket polls before every call, so the rest of a burst is drained through a
+            # non-blocking duplicate of it
+            self._nonblocking_sock = sock.dup()
+            self._nonblocking_sock.setblocking(False)
+
+    def _setup_mmsg(self):
+        n = self.batch_size
+        self._addresses = [
+            ctypes.addressof((ctypes.c_char * DEFAULT_MTU).from_buffer(buffer)) for buffer in self.buffers
+        ]
+        self._recv_iov = (_IOVec * n)()
+        self._recv_msgs = (_MMsgHdr * n)()
+        self._send_iov = (_IOVec * n)()
+        self._send_msgs = (_MMsgHdr * n)()
+
+        for i in range(n):
+            self._recv_iov[i].iov_base = self._addresses[i]
+            self._recv_iov[i].iov_len = DEFAULT_MTU
+            self._recv_msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._recv_iov[i])
+            self._recv_msgs[i].msg_hdr.msg_iovlen = 1
+
+        if not self.send_mmsg:
+            return
+        host, port = self.sink.destination
+        self._sockaddr = _SockAddrIn(socket.AF_INET, socket.htons(port))
+        self._sockaddr.sin_addr[:] = list(socket.inet_aton(host))
+
+        for i in range(n):
+            self._send_msgs[i].msg_hdr.msg_name = ctypes.addressof(self._sockaddr)
+            self._send_msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(self._sockaddr)
+            self._send_msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._send_iov[i])
+            self._send_msgs[i].msg_hdr.msg_iovlen = 1
+
+    def _wait_readable(self):
+        timeout = self.sock.gettimeout()
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            raise socket.timeout("timed out")
+
+    def _receive_mmsg(self):
+        self._wait_readable()
+        received = _libc.recvmmsg(
+            self.sock.fileno(), self._recv_msgs, self.batch_size, MSG_WAITFORONE | socket.MSG_DONTWAIT, None
+        )
+        if received < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise OSError(err, "recvmmsg: " + errno.errorcode.get(err, str(err)))
+        for i in range(received):
+            self.sizes[i] = self._recv_msgs[i].msg_len
+        return received
+
+    def _receive_loop(self):
+        self.sizes[0] = self.sock.recv_into(self.buffers[0])
+        received = 1
+        while received < self.batch_size:
+            try:
+                self.sizes[received] = self._nonblocking_sock.recv_into(self.buffers[received])
+            except (BlockingIOError, InterruptedError):
+                break
+            received += 1
+        return received
+
+    def _send_mmsg(self, payloads):
+        count = len(payloads)
+        for j, (i, start, end) in enumerate(payloads):
+            self._send_iov[j].iov_base = self._addresses[i] + start
+            self._send_iov[j].iov_len = end - start
+        sent = 0
+        while sent < count:
+            result = _libc.sendmmsg(
+                self.sink.sock.fileno(), ctypes.byref(self._send_msgs, sent * ctypes.sizeof(_MMsgHdr)), count - sent, 0
+            )
+            if result < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                # Count the rest of the burst as lost, like a failed sendto()
+                for _, start, end in payloads[sent:]:
+                    self.sink.dropped_packets += 1
+                    self.sink.dropped_bytes += end - start
+                break
+            for _, start, end in payloads[sent:sent + result]:
+                self.sink.bytes += end - start
+            sent += result
+        self.sink.packets += sent
+        return sent
+
+    def _send_sink(self, payloads):
+        self.sink.write_batch([self.views[i][start:end] for i, start, end in payloads])
+        return len(payloads)
+
+    def close(self):
+        if not self.use_mmsg:
+            self._nonblocking_sock.close()
+
+    def forward_burst(self):
+        """
+        Receives up to batch_size datagrams and forwards their UDP payloads.
+
+        :return: Number of forwarded payloads (unhandled non-data messages are counted in self.dropped)
+        """
+        received = self._receive_mmsg() if self.use_mmsg else self._receive_loop()
+
+        payloads = []
+        for i in range(received):
+            bounds = udp_payload_bounds(self.views[i], self.sizes[i])
+            if bounds is None:
+                if self.on_control is not None and self.on_control(self.views[i][:self.sizes[i]]):
+                    if self.metrics is not None:
+                        self.metrics.control_messages += 1
+                else:
+                    self.dropped += 1
+                continue
+            payloads.append((i, bounds[0], bounds[1]))
+
+        if not payloads:
+            return 0
+        if self.metrics is not None:
+            now = time.monotonic()
+            for i, start, end in payloads:
+                self.metrics.observe(self.views[i][start:end], now)
+        return self._send_mmsg(payloads) if self.send_mmsg else self._send_sink(payloads)
+
+
+class SingleForwarder:
+    """
+    The one-datagram-per-call counterpart of BatchForwarder, with the same interface, used by
+    the tunnel's single I/O mode.
+    """
+
+    def __init__(self, sock, sink, on_control=None, metrics=None):
+        self.sock = sock
+        self.sink = sink
+        self.on_control = on_control
+        self.metrics = metrics
+        self.buffer = bytearray(DEFAULT_MTU)
+        self.view = memoryview(self.buffer)
+        self.dropped = 0
+
+    def close(self):
+        pass
+
+    def forward_burst(self):
+        """
+        Receives one datagram and forwards its UDP payload.
+
+        :return: 1 if a payload was forwarded, 0 otherwise
+        """
+        nbytes = self.sock.recv_into(self.buffer)
+        payload = udp_payload(self.view, nbytes)
+        if payload is None:
+            if self.on_control is not None and self.on_control(self.view[:nbytes]):
+                if self.metrics is not None:
+                    self.metrics.control_messages += 1
+            else:
+                self.dropped += 1
+            return 0
+        self.sink.write(payload)
+        if self.metrics is not None:
+            self.metrics.observe(payload, time.monotonic())
+        return 1
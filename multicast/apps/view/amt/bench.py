@@ -0,0 +1,531 @@
+"""
+Micro-benchmarks for the AMT gateway.
+
+Run from this directory, e.g.:
+
+    python3 bench.py decode --packets 200000
+    python3 bench.py decode --packets 200000 --forward
+    python3 bench.py forward --packets 200000 --batch-size 32
+    python3 bench.py handshake --rounds 200
+    python3 bench.py startup --rounds 5
+    python3 bench.py replay --packets 100000 [--save-baseline]
+
+replay runs a synthetic capture (handshake, MPEG-TS data, periodic Membership Queries), and the
+captures given with --pcap, through the same forwarders as tunnel.py, over loopback sockets only,
+and fails when a scenario got slower than bench_baseline.json. Each scenario runs in a process of
+its own, so that its peak RSS is its own. Python does not count allocations, so blocks/pkt is the
+net number of memory blocks left allocated per datagram (0 when the data path does not retain
+anything).
+"""
+import argparse
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from batch import DEFAULT_BATCH_SIZE, BatchForwarder, SingleForwarder, mmsg_supported
+from capture import UdpDatagram, read_udp_datagrams, write_pcap
+from constants import AMT_MEM_QUERY, AMT_MULT_DATA, AMT_RELAY_PORT, DEFAULT_MTU, LOCAL_LOOPBACK
+from datapath import encode_multicast_data, message_type, udp_payload
+from fakerelay import synthetic_ts_payloads
+from metrics import TunnelMetrics
+from transport import UdpSink
+from messages import (
+    discovery_template,
+    encode_membership_query,
+    encode_relay_advertisement,
+    membership_update_template,
+    parse_membership_query,
+    request_template,
+)
+
+# Seven 188-byte MPEG-TS packets, the usual payload of a multicast video datagram
+TS_PAYLOAD = (b"\x47" + bytes(187)) * 7
+
+
+def synthetic_data_packet(source="162.250.138.201", group="232.162.250.139", payload=TS_PAYLOAD):
+    return encode_multicast_data(source, group, payload)
+
+
+def report(name, packets, elapsed):
+    print(f"{name:<12} {packets / elapsed:>12,.0f} pkt/s {elapsed * 1e6 / packets:>8.2f} us/pkt")
+
+
+def bench_fast_path(data, packets, send):
+    buffer = bytearray(data)
+    view = memoryview(buffer)
+    nbytes = len(data)
+
+    start = time.perf_counter()
+    for _ in range(packets):
+        send(udp_payload(view, nbytes))
+    return time.perf_counter() - start
+
+
+def bench_scapy_path(data, packets, send):
+    from scapy.layers.inet import UDP
+    from models import AMT_Multicast_Data
+
+    start = time.perf_counter()
+    for _ in range(packets):
+        amt_packet = AMT_Multicast_Data(data)
+        send(bytes(amt_packet[UDP].payload))
+    return time.perf_counter() - start
+
+
+def decode(args):
+    data = synthetic_data_packet()
+
+    if args.forward:
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind((LOCAL_LOOPBACK, 0))
+        out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        destination = sink.getsockname()
+
+        def send(payload):
+            out.sendto(payload, destination)
+    else:
+        def send(payload):
+            pass
+
+    report("fast path", args.packets, bench_fast_path(data, args.packets, send))
+    try:
+        scapy_packets = max(1, args.packets // 10)
+        report("scapy", scapy_packets, bench_scapy_path(data, scapy_packets, send))
+    except ImportError:
+        print("scapy is not installed, skipping the scapy path")
+
+
+def loopback_pair(rcvbuf=8 * 1024 * 1024):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    receiver.bind((LOCAL_LOOPBACK, 0))
+    receiver.settimeout(1)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    return sender, receiver
+
+
+def bench_forward_loop(forward_chunk, packets, chunk=500):
+    """
+    Feeds synthetic AMT traffic into a loopback socket in chunks and times only the
+    forwarding of each chunk.
+    """
+    data = synthetic_data_packet()
+    relay, tunnel_socket = loopback_pair()
+    out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    _, sink = loopback_pair()
+    destination = sink.getsockname()
+
+    elapsed = 0.0
+    forwarded = 0
+    while forwarded < packets:
+        count = min(chunk, packets - forwarded)
+        for _ in range(count):
+            relay.sendto(data, tunnel_socket.getsockname())
+        start = time.perf_counter()
+        done = 0
+        while done < count:
+            done += forward_chunk(tunnel_socket, out, destination)
+        elapsed += time.perf_counter() - start
+        forwarded += done
+        # Drain the sink so it never starts dropping
+        sink.setblocking(False)
+        try:
+            while True:
+                sink.recv(DEFAULT_MTU)
+        except BlockingIOError:
+            pass
+        sink.settimeout(1)
+    return forwarded, elapsed
+
+
+def forward(args):
+    buffer = bytearray(DEFAULT_MTU)
+    view = memoryview(buffer)
+
+    def single(sock, out, destination):
+        nbytes = sock.recv_into(buffer)
+        out.sendto(udp_payload(view, nbytes), destination)
+        return 1
+
+    report("single", *bench_forward_loop(single, args.packets))
+
+    forwarders = {}
+
+    def batched(use_mmsg):
+        def forward_chunk(sock, out, destination):
+            if sock not in forwarders:
+                sink = UdpSink(destination[1])
+                sink.sock, sink.destination = out, destination
+                forwarders[sock] = BatchForwarder(sock, sink, args.batch_size, use_mmsg)
+            return forwarders[sock].forward_burst()
+        return forward_chunk
+
+    report("batch loop", *bench_forward_loop(batched(False), args.packets))
+    if mmsg_supported():
+        report("batch mmsg", *bench_forward_loop(batched(True), args.packets))
+
+
+def start_responder():
+    """
+    Answers Discovery with an Advertisement and Request with a Membership Query on a loopback socket.
+    """
+    responder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    responder.bind((LOCAL_LOOPBACK, 0))
+    response_mac = secrets.token_bytes(6)
+
+    def serve():
+        while True:
+            data, addr = responder.recvfrom(DEFAULT_MTU)
+            msg_type, nonce = data[0] & 0x0F, data[4:8]
+            if msg_type == 1:
+                responder.sendto(encode_relay_advertisement(nonce, LOCAL_LOOPBACK), addr)
+            elif msg_type == 3:
+                responder.sendto(encode_membership_query(nonce, response_mac, LOCAL_LOOPBACK), addr)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return responder.getsockname()
+
+
+def handshake_templates(sock, relay_addr, group, source):
+    nonce = secrets.token_bytes(4)
+    sock.sendto(discovery_template().render(nonce), relay_addr)
+    sock.recv(DEFAULT_MTU)
+    sock.sendto(request_template().render(nonce), relay_addr)
+    query = parse_membership_query(sock.recv(DEFAULT_MTU))
+    sock.sendto(membership_update_template([(group, [source])]).render(nonce, query.response_mac), relay_addr)
+
+
+def handshake_scapy(sock, relay_addr, group, source):
+    from scapy.all import IP, UDP, Packet, conf, send
+    from scapy.contrib.igmpv3 import IGMPv3, IGMPv3gr, IGMPv3mr
+    from scapy.supersocket import L3RawSocket
+
+    from constants import MCAST_ALLHOSTS, MCAST_ANYCAST
+    from models import AMT_Discovery, AMT_Membership_Query, AMT_Membership_Update, AMT_Relay_Request
+
+    # Loopback needs a raw L3 socket; on a real interface send() does the same route lookup and socket setup
+    conf.L3socket = L3RawSocket
+    ip_layer = IP(dst=relay_addr[0])
+    udp_layer = UDP(sport=sock.getsockname()[1], dport=relay_addr[1])
+    nonce = secrets.token_bytes(4)
+    send(ip_layer / udp_layer / AMT_Discovery(nonce=nonce), verbose=False)
+    sock.recv(DEFAULT_MTU)
+    send(ip_layer / udp_layer / AMT_Relay_Request(nonce=nonce), verbose=False)
+    response_mac = AMT_Membership_Query(sock.recv(DEFAULT_MTU)).response_mac
+    ip_layer2 = IP(src=MCAST_ANYCAST, dst=MCAST_ALLHOSTS, options=[Packet(b"\x00")])
+    send(
+        ip_layer / udp_layer / AMT_Membership_Update(nonce=nonce, response_mac=response_mac) / ip_layer2
+        / IGMPv3(type=34) / IGMPv3mr(records=[IGMPv3gr(maddr=group, srcaddrs=[source])]),
+        verbose=False
+    )
+
+
+def bench_handshake(handshake, relay_addr, rounds):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((LOCAL_LOOPBACK, 0))
+    sock.settimeout(5)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        handshake(sock, relay_addr, "232.162.250.139", "162.250.138.201")
+    return time.perf_counter() - start
+
+
+def handshake(args):
+    relay_addr = start_responder()
+    elapsed = bench_handshake(handshake_templates, relay_addr, args.rounds)
+    print(f"{'templates':<12} {elapsed * 1e3 / args.rounds:>8.3f} ms/handshake")
+    try:
+        rounds = max(1, args.rounds // 10)
+        elapsed = bench_handshake(handshake_scapy, relay_addr, rounds)
+        print(f"{'scapy send':<12} {elapsed * 1e3 / rounds:>8.3f} ms/handshake")
+    except ImportError:
+        print("scapy is not installed, skipping the scapy path")
+    except PermissionError:
+        print("scapy send() needs a raw socket (run as root), skipping the scapy path")
+
+
+AMT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_time(module, cwd):
+    code = (
+        f"import sys, time; sys.path.insert(0, {AMT_DIR!r}); start = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - start)"
+    )
+    output = subprocess.run([sys.executable, "-c", code], cwd=cwd, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def time_to_first_packet(launcher, cwd):
+    """
+    Starts tunnel.py against a loopback "relay" and returns the seconds until its Discovery arrives.
+    """
+    relay = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    relay.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    relay.bind((LOCAL_LOOPBACK, AMT_RELAY_PORT))
+    relay.settimeout(60)
+    command = launcher + [os.path.join(AMT_DIR, "tunnel.py"), LOCAL_LOOPBACK, "10.0.0.1", "232.0.0.1", "2999", "4999"]
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        relay.recvfrom(DEFAULT_MTU)
+        return time.perf_counter() - start
+    finally:
+        proc.kill()
+        proc.wait()
+        relay.close()
+
+
+def startup(args):
+    with tempfile.TemporaryDirectory() as cwd:
+        for module in ("tunnel", "scapy.all"):
+            try:
+                samples = [import_time(module, cwd) for _ in range(args.rounds)]
+                print(f"import {module:<10} {min(samples) * 1e3:>8.1f} ms")
+            except subprocess.CalledProcessError:
+                print(f"import {module:<10} failed")
+
+        launchers = [("direct", [sys.executable])]
+        if shutil.which("pipenv"):
+            launchers.append(("pipenv run", ["pipenv", "run", "python3"]))
+        for name, launcher in launchers:
+            samples = [time_to_first_packet(launcher, cwd) for _ in range(args.rounds)]
+            print(f"first packet ({name}) {min(samples) * 1e3:>8.1f} ms (median {sorted(samples)[len(samples) // 2] * 1e3:.1f} ms)")
+
+
+BASELINE_PATH = os.path.join(AMT_DIR, "bench_baseline.json")
+# Relative slowdown of us/pkt tolerated before a scenario counts as a regression
+REGRESSION_TOLERANCE = 0.25
+
+
+def synthetic_capture(packets, query_every=1000):
+    """
+    Builds the datagrams of an AMT session: Discovery, Advertisement, Request, Query and Update,
+    then Multicast Data carrying MPEG-TS, with a Membership Query every query_every packets.
+
+    :return: List of capture.UdpDatagram
+    """
+    gateway, gateway_port = "10.0.0.2", 40000
+    relay = "162.250.136.101"
+    nonce, response_mac = secrets.token_bytes(4), secrets.token_bytes(6)
+    clock = iter(1700000000.0 + i * 0.001 for i in itertools.count())
+
+    def to_relay(message):
+        return UdpDatagram(next(clock), gateway, gateway_port, relay, AMT_RELAY_PORT, bytes(message))
+
+    def to_gateway(message):
+        return UdpDatagram(next(clock), relay, AMT_RELAY_PORT, gateway, gateway_port, bytes(message))
+
+    datagrams = [
+        to_relay(discovery_template().render(nonce)),
+        to_gateway(encode_relay_advertisement(nonce, relay)),
+        to_relay(request_template().render(nonce)),
+        to_gateway(encode_membership_query(nonce, response_mac, relay)),
+        to_relay(membership_update_template([("232.162.250.139", ["162.250.138.201"])]).render(nonce, response_mac)),
+    ]
+    payloads = synthetic_ts_payloads()
+    for i in range(packets):
+        if i and i % query_every == 0:
+            datagrams.append(to_gateway(encode_membership_query(nonce, response_mac, relay)))
+        datagrams.append(to_gateway(synthetic_data_packet(payload=next(payloads))))
+    return datagrams
+
+
+def received_messages(datagrams):
+    """
+    Returns the payloads a tunnel would receive: the datagrams sent from the AMT relay port.
+    """
+    return [datagram.payload for datagram in datagrams if datagram.sport == AMT_RELAY_PORT]
+
+
+def control_handler(message):
+    # The tunnel parses Membership Queries arriving in the data path; replies are not sent here
+    return message_type(message) == AMT_MEM_QUERY and parse_membership_query(message) is not None
+
+
+def replay_messages(messages, make_forwarder, packets, chunk=500):
+    """
+    Replays messages (cycled up to packets datagrams) into a loopback socket and times the
+    forwarder draining them into a loopback UdpSink. The first chunk warms up caches and
+    buffers and is not measured.
+
+    :return: (datagrams measured, elapsed seconds, net allocated blocks)
+    """
+    relay, tunnel_socket = loopback_pair()
+    _, drain = loopback_pair()
+    drain.setblocking(False)
+    sink = UdpSink(drain.getsockname()[1])
+    metrics = TunnelMetrics()
+    forwarder = make_forwarder(tunnel_socket, sink, metrics)
+    address = tunnel_socket.getsockname()
+    source = itertools.cycle(messages)
+
+    elapsed = 0.0
+    consumed = 0
+    forwarded = 0
+    blocks = 0
+    packets += chunk
+    while consumed < packets:
+        count = min(chunk, packets - consumed)
+        for _ in range(count):
+            relay.sendto(next(source), address)
+        target = consumed + count
+        blocks_before = sys.getallocatedblocks()
+        start = time.perf_counter()
+        while forwarded + forwarder.dropped + metrics.control_messages < target:
+            forwarded += forwarder.forward_burst()
+        if consumed:
+            elapsed += time.perf_counter() - start
+            blocks += sys.getallocatedblocks() - blocks_before
+        consumed = target
+        try:
+            while True:
+                drain.recv(DEFAULT_MTU)
+        except BlockingIOError:
+            pass
+    forwarder.close()
+    sink.close()
+    return consumed - chunk, elapsed, blocks
+
+
+def make_forwarder(mode, batch_size):
+    if mode == "single":
+        return lambda sock, sink, metrics: SingleForwarder(sock, sink, control_handler, metrics)
+    return lambda sock, sink, metrics: BatchForwarder(
+        sock, sink, batch_size, on_control=control_handler, metrics=metrics
+    )
+
+
+def replay_in_process(messages, mode, packets, batch_size):
+    """
+    Runs one scenario in a fresh interpreter (spawned, not forked, so that it does not inherit the
+    peak RSS of this process).
+
+    :return: (datagrams measured, elapsed seconds, net allocated blocks, peak RSS in KiB)
+    """
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+        return executor.submit(replay_scenario, messages, mode, packets, batch_size).result()
+
+
+def replay_scenario(messages, mode, packets, batch_size):
+    consumed, elapsed, blocks = replay_messages(messages, make_forwarder(mode, batch_size), packets)
+    return consumed, elapsed, blocks, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def replay_scenarios(args):
+    scenarios = []
+    for path in args.pcap or ():
+        messages = received_messages(read_udp_datagrams(path))
+        if not any(message_type(message) == AMT_MULT_DATA for message in messages):
+            # Only the drop path would be measured
+            print(f"{path} has no AMT Multicast Data from a relay, skipping it")
+            continue
+        scenarios.append((os.path.basename(path), messages))
+
+    datagrams = synthetic_capture(args.synthetic_packets)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Go through the capture reader, as for a recorded capture
+        capture_path = args.synthetic_out or os.path.join(temp_dir, "synthetic.pcap")
+        write_pcap(capture_path, datagrams)
+        scenarios.append(("synthetic", received_messages(read_udp_datagrams(capture_path))))
+
+    for name, messages in scenarios:
+        for mode in ("single", "batch"):
+            yield f"{name}/{mode}", messages, mode
+
+
+def replay(args):
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    regressions = []
+    print(f"{'scenario':<28} {'pkt/s':>12} {'us/pkt':>8} {'blocks/pkt':>10} {'peak RSS':>10}  baseline us/pkt")
+    for name, messages, mode in replay_scenarios(args):
+        consumed, elapsed, blocks, peak_rss = replay_in_process(messages, mode, args.packets, args.batch_size)
+        result = {
+            "pkt_per_s": round(consumed / elapsed),
+            "us_per_pkt": round(elapsed * 1e6 / consumed, 3),
+            "blocks_per_pkt": round(blocks / consumed, 4),
+            "peak_rss_kb": peak_rss,
+        }
+        results[name] = result
+
+        reference = baseline.get(name)
+        comparison = "-"
+        if reference:
+            change = result["us_per_pkt"] / reference["us_per_pkt"] - 1
+            comparison = f"{reference['us_per_pkt']:.3f} ({change:+.0%})"
+            if change > args.tolerance or result["blocks_per_pkt"] > reference["blocks_per_pkt"] + 0.01:
+                regressions.append(name)
+                comparison += "  REGRESSION"
+        print(
+            f"{name:<28} {result['pkt_per_s']:>12,} {result['us_per_pkt']:>8.2f} {result['blocks_per_pkt']:>10.4f} "
+            f"{result['peak_rss_kb'] / 1024:>7.1f} MB  {comparison}"
+        )
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print(f"Baseline written to {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} scenario(s) slower than the baseline: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AMT gateway micro-benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    decode_parser = subparsers.add_parser("decode", help="Multicast Data decode (and forward) rate")
+    decode_parser.add_argument("--packets", type=int, default=100000)
+    decode_parser.add_argument("--forward", action="store_true", help="Also sendto() a loopback socket")
+    decode_parser.set_defaults(func=decode)
+
+    forward_parser = subparsers.add_parser("forward", help="Receive and forward rate over loopback sockets")
+    forward_parser.add_argument("--packets", type=int, default=100000)
+    forward_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    forward_parser.set_defaults(func=forward)
+
+    handshake_parser = subparsers.add_parser("handshake", help="Discovery/Request/Update latency against a loopback relay")
+    handshake_parser.add_argument("--rounds", type=int, default=200)
+    handshake_parser.set_defaults(func=handshake)
+
+    startup_parser = subparsers.add_parser("startup", help="tunnel.py import time and time to first Discovery")
+    startup_parser.add_argument("--rounds", type=int, default=5)
+    startup_parser.set_defaults(func=startup)
+
+    replay_parser = subparsers.add_parser(
+        "replay", help="Replay captured and synthetic AMT traffic through the forwarders, compared to a baseline"
+    )
+    replay_parser.add_argument("--packets", type=int, default=100000, help="Datagrams replayed per scenario")
+    replay_parser.add_argument("--pcap", action="append", help="Capture of AMT traffic to replay too (pcap or pcapng)")
+    replay_parser.add_argument("--synthetic-packets", type=int, default=5000, help="Data packets of the synthetic capture")
+    replay_parser.add_argument("--synthetic-out", help="Also keep the synthetic capture at this path")
+    replay_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    replay_parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline file")
+    replay_parser.add_argument("--save-baseline", action="store_true", help="Write the results as the new baseline")
+    replay_parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    replay_parser.set_defaults(func=replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Reading and writing packet captures without scapy.
+
+read_udp_datagrams() understands classic pcap (either byte order, micro- or nanosecond
+timestamps) and pcapng (Enhanced and Simple Packet Blocks) with Ethernet, raw IPv4, BSD loopback
+and Linux cooked link layers, and returns the IPv4/UDP datagrams in it. write_pcap() writes
+datagrams to a classic pcap file that Wireshark and tcpdump can open.
+"""
+import socket
+import struct
+from collections import namedtuple
+
+from datapath import IPPROTO_UDP, UDP_HDR_LEN, encode_udp_datagram
+
+UdpDatagram = namedtuple("UdpDatagram", ["timestamp", "source", "sport", "destination", "dport", "payload"])
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+
+ETHERTYPE_IPV4 = 0x0800
+PCAP_MAGIC = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+_ETHERNET_HEADER = bytes(6) + b"\x02\x00\x00\x00\x00\x01" + struct.pack("!H", ETHERTYPE_IPV4)
+
+
+def _ipv4_offset(linktype, frame):
+    """
+    Returns the offset of the IPv4 header in a frame, or None if it carries something else.
+    """
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        return 0
+    if linktype == LINKTYPE_ETHERNET:
+        offset, ethertype = 14, struct.unpack_from("!H", frame, 12)[0] if len(frame) >= 14 else 0
+        # 802.1Q tags
+        while ethertype == 0x8100 and len(frame) >= offset + 4:
+            ethertype = struct.unpack_from("!H", frame, offset + 2)[0]
+            offset += 4
+        return offset if ethertype == ETHERTYPE_IPV4 else None
+    if linktype == LINKTYPE_LINUX_SLL:
+        return 16 if len(frame) >= 16 and struct.unpack_from("!H", frame, 14)[0] == ETHERTYPE_IPV4 else None
+    if linktype == LINKTYPE_NULL:
+        return 4 if len(frame) >= 4 and frame[0] in (2, 0) else None
+    return None
+
+
+def _udp_datagram(timestamp, linktype, frame):
+    offset = _ipv4_offset(linktype, frame)
+    if offset is None or len(frame) < offset + 20 or frame[offset] >> 4 != 4:
+        return None
+    header_length = (frame[offset] & 0x0F) * 4
+    total_length = struct.unpack_from("!H", frame, offset + 2)[0]
+    fragment = struct.unpack_from("!H", frame, offset + 6)[0]
+    if frame[offset + 9] != IPPROTO_UDP or fragment & 0x3FFF:
+        return None
+    udp = offset + header_length
+    if len(frame) < udp + UDP_HDR_LEN:
+        return None
+    sport, dport, udp_length = struct.unpack_from("!HHH", frame, udp)
+    end = min(udp + udp_length, offset + total_length, len(frame))
+    return UdpDatagram(
+        timestamp,
+        socket.inet_ntoa(frame[offset + 12:offset + 16]), sport,
+        socket.inet_ntoa(frame[offset + 16:offset + 20]), dport,
+        bytes(frame[udp + UDP_HDR_LEN:end]),
+    )
+
+
+def _read_pcap(data):
+    magic = struct.unpack_from("<I", data)[0]
+    endian = "<" if magic in (PCAP_MAGIC, PCAP_MAGIC_NS) else ">"
+    magic = struct.unpack_from(endian + "I", data)[0]
+    if magic not in (PCAP_MAGIC, PCAP_MAGIC_NS):
+        raise ValueError("Not a pcap file")
+    resolution = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+    linktype = struct.unpack_from(endian + "I", data, 20)[0] & 0x0FFFFFFF
+    record = struct.Struct(endian + "IIII")
+    offset = 24
+    while offset + record.size <= len(data):
+        seconds, fraction, captured, _ = record.unpack_from(data, offset)
+        offset += record.size
+        yield seconds + fraction * resolution, linktype, data[offset:offset + captured]
+        offset += captured
+
+
+def _read_pcapng(data):
+    endian = "<"
+    linktypes = []
+    resolutions = []
+    offset = 0
+    while offset + 12 <= len(data):
+        block_type = struct.unpack_from(endian + "I", data, offset)[0]
+        if block_type == PCAPNG_SHB:
+            byte_order = struct.unpack_from("<I", data, offset + 8)[0]
+            endian = "<" if byte_order == PCAPNG_BYTE_ORDER_MAGIC else ">"
+            linktypes, resolutions = [], []
+        block_length = struct.unpack_from(endian + "I", data, offset + 4)[0]
+        if block_length < 12:
+            raise ValueError("Malformed pcapng block")
+        body = data[offset + 8:offset + block_length - 4]
+
+        if block_type == PCAPNG_IDB:
+            linktypes.append(struct.unpack_from(endian + "H", body)[0])
+            resolutions.append(1e-6)
+            # if_tsresol option
+            option = 8
+            while option + 4 <= len(body):
+                code, length = struct.unpack_from(endian + "HH", body, option)
+                if code == 0:
+                    break
+                if code == 9 and length >= 1:
+                    value = body[option + 4]
+                    resolutions[-1] = 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+                option += 4 + (length + 3) // 4 * 4
+        elif block_type == PCAPNG_EPB and linktypes:
+            interface, high, low, captured = struct.unpack_from(endian + "IIII", body)
+            timestamp = ((high << 32) | low) * resolutions[interface]
+            yield timestamp, linktypes[interface], body[20:20 + captured]
+        elif block_type == PCAPNG_SPB and linktypes:
+            yield 0.0, linktypes[0], body[4:]
+        offset += block_length
+
+
+def read_udp_datagrams(path):
+    """
+    Reads the IPv4/UDP datagrams of a pcap or pcapng file.
+
+    :param path: Path of the capture
+    :return: List of UdpDatagram; frames carrying anything else are skipped
+    """
+    with open(path, "rb") as capture:
+        data = memoryview(capture.read())
+    if len(data) < 24:
+        raise ValueError(f"{path} is too short for a capture file")
+    frames = _read_pcapng(data) if struct.unpack_from("<I", data)[0] == PCAPNG_SHB else _read_pcap(data)
+    datagrams = []
+    for timestamp, linktype, frame in frames:
+        datagram = _udp_datagram(timestamp, linktype, frame)
+        if datagram is not None:
+            datagrams.append(datagram)
+    return datagrams
+
+
+def write_pcap(path, datagrams):
+    """
+    Writes datagrams to a classic pcap file with an Ethernet link layer.
+
+    :param path: Path of the capture
+    :param datagrams: Iterable of UdpDatagram
+    """
+    with open(path, "wb") as capture:
+        capture.write(struct.pack("<IHHiIII", PCAP_MAGIC, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET))
+        for datagram in datagrams:
+            frame = _ETHERNET_HEADER + encode_udp_datagram(
+                datagram.source, datagram.destination, datagram.payload, datagram.sport, datagram.dport
+            )
+            seconds = int(datagram.timestamp)
+            micros = int(round((datagram.timestamp - seconds) * 1e6))
+            capture.write(struct.pack("<IIII", seconds, micros, len(frame), len(frame)))
+            capture.write(frame)
@@ -17,9 +17,24 @@ AMT_MEM_UPD = 5            # membership update
 AMT_MULT_DATA = 6          # multicast data
 AMT_TEARDOWN = 7           # teardown (not currently supported)
 
+################################################
+# Membership refresh
+################################################
+DEFAULT_QUERY_INTERVAL = 125  # seconds, used when a query carries no QQIC (RFC 3376)
+REFRESH_RETRY_INTERVAL = 10   # seconds before an unanswered refresh Request is retried
+
 ################################################
 # Addresses
 ################################################
+AMT_RELAY_PORT = 2268      # IANA port of AMT relays
 LOCAL_LOOPBACK = "127.0.0.1"
 MCAST_ANYCAST = "0.0.0.0"
 MCAST_ALLHOSTS = "224.0.0.22"
+
+################################################
+# Relays
+################################################
+DEFAULT_RELAY = "amt-relay.m2icast.net"
+DEFAULT_RELAY_IPS = ["162.250.137.254", "162.250.136.101", "164.113.199.110"]
+# Relays probed by the relay registry besides the relays of the streams
+KNOWN_RELAYS = [DEFAULT_RELAY, "amt-relay.geant.org"]
@@ -0,0 +1,138 @@
+"""
+Fast path for the AMT data plane.
+
+Multicast Data messages are decoded in place with struct and memoryview instead of
+building scapy layer stacks, so the forwarding loop never allocates per packet.
+
+Layout of an AMT Multicast Data message (RFC 7450, section 5.1.6):
+
+    0                   1                   2                   3
+    0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
+   +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+   |  V=0  |Type=6 |    Reserved   |        IP Multicast Data ...  |
+   +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+"""
+import socket
+import struct
+
+from constants import AMT_MULT_DATA
+from messages import IPV4_HDR, checksum
+
+AMT_DATA_HDR_LEN = 2        # version/type byte + reserved byte
+IPV4_MIN_HDR_LEN = 20
+UDP_HDR_LEN = 8
+IPPROTO_UDP = 17
+
+# Smallest datagram that can carry an inner IPv4/UDP header
+MIN_DATA_LEN = AMT_DATA_HDR_LEN + IPV4_MIN_HDR_LEN + UDP_HDR_LEN
+
+_UDP_HDR = struct.Struct("!HHHH")
+_U16 = struct.Struct("!H")
+
+
+def message_type(view):
+    """
+    Returns the AMT message type carried in the low nibble of the first byte.
+
+    :param view: Buffer (bytes, bytearray or memoryview) holding an AMT message
+    :return: AMT message type
+    """
+    return view[0] & 0x0F
+
+
+def udp_payload_bounds(view, nbytes):
+    """
+    Locates the UDP payload of an AMT Multicast Data message.
+
+    Only the AMT type nibble, the inner IPv4 version/IHL/protocol fields and the UDP length
+    are looked at. Anything that is not an unfragmented IPv4/UDP datagram inside a Multicast
+    Data message is rejected.
+
+    :param view: Buffer (bytes, bytearray or memoryview) holding the received message
+    :param nbytes: Number of valid bytes in the buffer (as returned by recv_into)
+    :return: (start, end) offsets of the UDP payload, or None if the message is not multicast data
+    """
+    if nbytes < MIN_DATA_LEN or message_type(view) != AMT_MULT_DATA:
+        return None
+
+    version_ihl = view[AMT_DATA_HDR_LEN]
+    if version_ihl >> 4 != 4 or view[AMT_DATA_HDR_LEN + 9] != IPPROTO_UDP:
+        return None
+    # Drop IP fragments, they cannot be forwarded as a single datagram
+    if _U16.unpack_from(view, AMT_DATA_HDR_LEN + 6)[0] & 0x3FFF:
+        return None
+
+    udp_offset = AMT_DATA_HDR_LEN + ((version_ihl & 0x0F) << 2)
+    if udp_offset + UDP_HDR_LEN > nbytes:
+        return None
+    udp_length = _U16.unpack_from(view, udp_offset + 4)[0]
+    end = udp_offset + udp_length
+    if udp_length < UDP_HDR_LEN or end > nbytes:
+        return None
+
+    return udp_offset + UDP_HDR_LEN, end
+
+
+def udp_payload(view, nbytes):
+    """
+    Returns the UDP payload of an AMT Multicast Data message without copying it,
+    so the caller can hand the result straight to sendto().
+
+    :param view: memoryview over the receive buffer
+    :param nbytes: Number of valid bytes in the buffer (as returned by recv_into)
+    :return: memoryview slice with the UDP payload, or None if the message is not multicast data
+    """
+    bounds = udp_payload_bounds(view, nbytes)
+    if bounds is None:
+        return None
+    return view[bounds[0]:bounds[1]]
+
+
+def udp_flow(view, nbytes):
+    """
+    Locates the UDP payload of an AMT Multicast Data message together with the inner flow it
+    belongs to, so one AMT session can demultiplex several (S,G) channels.
+
+    :param view: memoryview over the receive buffer
+    :param nbytes: Number of valid bytes in the buffer
+    :return: (addresses, dport, start, end) where addresses is the packed inner source and group
+             (8 bytes), or None if the message is not multicast data
+    """
+    bounds = udp_payload_bounds(view, nbytes)
+    if bounds is None:
+        return None
+    start, end = bounds
+    addresses = bytes(view[AMT_DATA_HDR_LEN + 12:AMT_DATA_HDR_LEN + 20])
+    return addresses, _U16.unpack_from(view, start - UDP_HDR_LEN + 2)[0], start, end
+
+
+def encode_udp_datagram(source, destination, payload, sport, dport, ttl=64):
+    """
+    Builds an IPv4/UDP datagram; the UDP checksum is left at zero.
+
+    :return: Encoded datagram as bytes
+    """
+    total_length = IPV4_MIN_HDR_LEN + UDP_HDR_LEN + len(payload)
+    ip_header = IPV4_HDR.pack(
+        0x45, 0, total_length, 0, 0, ttl, IPPROTO_UDP, 0,
+        socket.inet_aton(source), socket.inet_aton(destination)
+    )
+    ip_header = ip_header[:10] + _U16.pack(checksum(ip_header)) + ip_header[12:]
+    udp_header = _UDP_HDR.pack(sport, dport, UDP_HDR_LEN + len(payload), 0)
+    return ip_header + udp_header + bytes(payload)
+
+
+def encode_multicast_data(source, group, payload, sport=5000, dport=5000, ttl=64):
+    """
+    Builds an AMT Multicast Data message carrying a single IPv4/UDP datagram.
+    Used to synthesize traffic for benchmarks and local relays; the UDP checksum is left at zero.
+
+    :param source: Multicast source address
+    :param group: Multicast group address
+    :param payload: UDP payload
+    :param sport: UDP source port of the inner datagram
+    :param dport: UDP destination port of the inner datagram
+    :param ttl: TTL of the inner datagram
+    :return: Encoded message as bytes
+    """
+    return bytes((AMT_MULT_DATA, 0)) + encode_udp_datagram(source, group, payload, sport, dport, ttl)
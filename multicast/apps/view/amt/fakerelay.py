@@ -0,0 +1,251 @@
+"""
+Local stand-in for an AMT relay, for load tests that must not touch the public relays.
+
+The relay answers Discovery with an Advertisement and Request with a Membership Query carrying
+a fresh response MAC, accepts the Membership Updates that echo it and streams Multicast Data to
+every joined (S,G) channel, as described by the scapy models in models.py. The payload is an
+MPEG-TS file played in a loop (or a synthetic stream with valid continuity counters), paced at
+a configurable bitrate, with random loss applied per datagram. Gateways that stop refreshing
+their membership are dropped after the membership timeout; a Teardown drops them at once.
+
+Run from this directory (binding the AMT port on loopback, so tunnels can use 127.0.0.1 as
+relay):
+
+    python3 fakerelay.py --bitrate 4000000 --loss 0.001 [--ts stream.ts] [--address 127.0.0.1]
+
+loadtest.py starts it by itself.
+"""
+import argparse
+import asyncio
+import logging
+import random
+import secrets
+import socket
+import time
+
+from constants import AMT_MEM_UPD, AMT_RELAY_DISCO, AMT_RELAY_PORT, AMT_REQUEST, AMT_TEARDOWN, LOCAL_LOOPBACK
+from datapath import encode_multicast_data
+from messages import (
+    ALLOW_NEW_SOURCES,
+    BLOCK_OLD_SOURCES,
+    MODE_IS_INCLUDE,
+    encode_membership_query,
+    encode_relay_advertisement,
+    parse_membership_update,
+)
+
+logger = logging.getLogger("amt.fakerelay")
+
+TS_PACKET_SIZE = 188
+TS_PACKETS_PER_DATAGRAM = 7
+DEFAULT_BITRATE = 4_000_000
+# Seconds between sends; every tick sends the datagrams that fell due since the last one
+TICK = 0.005
+# Query interval advertised to gateways, in seconds (must fit a QQIC below 128)
+DEFAULT_QUERY_INTERVAL = 125
+# PIDs of the synthetic transport stream: video, audio, and PAT/PMT now and then
+TS_PIDS = (0x100, 0x100, 0x100, 0x100, 0x100, 0x101, 0x100)
+TS_TABLE_PIDS = (0x0000, 0x1000)
+
+
+def synthetic_ts_payloads():
+    """
+    Yields 7-packet MPEG-TS payloads with correct continuity counters.
+    """
+    counters = {}
+    index = 0
+    while True:
+        packets = []
+        for pid in TS_TABLE_PIDS if index % 100 == 0 else TS_PIDS:
+            counters[pid] = (counters.get(pid, -1) + 1) & 0x0F
+            packets.append(bytes((0x47, 0x40 | pid >> 8, pid & 0xFF, 0x10 | counters[pid])) + bytes(184))
+        index += 1
+        yield b"".join(packets)
+
+
+def load_ts_payloads(path=None, count=1600):
+    """
+    Splits an MPEG-TS file into datagram payloads of 7 TS packets.
+
+    :param path: Path of the file, or None for count synthetic payloads. count is a multiple of
+                 16 payloads, so the continuity counters of the synthetic loop wrap cleanly.
+    :return: List of payloads
+    """
+    if path is None:
+        payloads = synthetic_ts_payloads()
+        return [next(payloads) for _ in range(count)]
+    with open(path, "rb") as ts_file:
+        data = ts_file.read()
+    start = data.find(bytes((0x47,)))
+    if start < 0:
+        raise ValueError(f"{path} does not contain MPEG-TS packets")
+    size = TS_PACKET_SIZE * TS_PACKETS_PER_DATAGRAM
+    payloads = [data[offset:offset + size] for offset in range(start, len(data) - TS_PACKET_SIZE + 1, size)]
+    # Drop a trailing partial TS packet
+    payloads[-1] = payloads[-1][:len(payloads[-1]) // TS_PACKET_SIZE * TS_PACKET_SIZE]
+    return payloads
+
+
+class Gateway:
+    """
+    State of one gateway address known to the relay.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.response_mac = None
+        self.nonce = None
+        self.channels = set()
+        self.expires = 0.0
+
+
+class FakeRelay(asyncio.DatagramProtocol):
+    """
+    :param payloads: Payloads streamed in a loop to every joined channel
+    :param bitrate: Bits per second of UDP payload sent to each channel
+    :param loss: Probability of dropping each data datagram
+    :param query_interval: Query interval advertised in the QQIC of the Membership Queries
+    """
+
+    def __init__(self, payloads, bitrate=DEFAULT_BITRATE, loss=0.0, query_interval=DEFAULT_QUERY_INTERVAL):
+        self.payloads = payloads
+        self.loss = loss
+        self.query_interval = query_interval
+        # RFC 3376 group membership interval: robustness variable (2) times the query interval, plus slack
+        self.membership_timeout = 2 * query_interval + 10
+        average_size = sum(len(payload) for payload in payloads) / len(payloads)
+        self.rate = bitrate / 8 / average_size
+        self.transport = None
+        self.address = None
+        self.gateways = {}
+        # AMT and IPv4/UDP headers are constant per channel and payload size
+        self.headers = {}
+        self.position = 0
+        self.sent = 0
+        self.dropped = 0
+        self.rejected_updates = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info("sockname")[0]
+
+    def datagram_received(self, data, addr):
+        if not data:
+            return
+        msg_type = data[0] & 0x0F
+        if msg_type == AMT_RELAY_DISCO and len(data) >= 8:
+            relay_ip = self.address if self.address != "0.0.0.0" else LOCAL_LOOPBACK
+            self.transport.sendto(encode_relay_advertisement(data[4:8], relay_ip), addr)
+        elif msg_type == AMT_REQUEST and len(data) >= 8:
+            gateway = self.gateways.setdefault(addr, Gateway(addr))
+            gateway.nonce = bytes(data[4:8])
+            gateway.response_mac = secrets.token_bytes(6)
+            gateway.expires = max(gateway.expires, time.monotonic() + self.membership_timeout)
+            query = encode_membership_query(gateway.nonce, gateway.response_mac, LOCAL_LOOPBACK, qqic=self.query_interval)
+            self.transport.sendto(query, addr)
+        elif msg_type == AMT_MEM_UPD:
+            self.handle_update(data, addr)
+        elif msg_type == AMT_TEARDOWN:
+            gateway = self.gateways.pop(addr, None)
+            if gateway is not None:
+                logger.info(f"{addr[0]}:{addr[1]} tore down {len(gateway.channels)} channel(s)")
+
+    def handle_update(self, data, addr):
+        update = parse_membership_update(data)
+        gateway = self.gateways.get(addr)
+        # A relay only accepts updates that echo the MAC and nonce of its last query
+        if update is None or gateway is None or (update.response_mac, update.nonce) != (gateway.response_mac, gateway.nonce):
+            self.rejected_updates += 1
+            return
+        for group, sources, record_type in update.records:
+            channels = {(source, group) for source in sources}
+            if record_type in (MODE_IS_INCLUDE, ALLOW_NEW_SOURCES):
+                gateway.channels |= channels
+            elif record_type == BLOCK_OLD_SOURCES:
+                gateway.channels -= channels
+            else:
+                # CHANGE_TO_INCLUDE_MODE replaces the sources of the group; an empty list leaves it
+                gateway.channels = {channel for channel in gateway.channels if channel[1] != group} | channels
+        gateway.expires = time.monotonic() + self.membership_timeout
+
+    def header(self, channel, size):
+        key = (channel, size)
+        if key not in self.headers:
+            self.headers[key] = encode_multicast_data(channel[0], channel[1], bytes(size))[:-size]
+        return self.headers[key]
+
+    def send_data(self, count):
+        """
+        Sends the next count payloads to every joined channel.
+        """
+        now = time.monotonic()
+        for addr in [addr for addr, gateway in self.gateways.items() if gateway.expires < now]:
+            logger.info(f"Membership of {addr[0]}:{addr[1]} timed out")
+            del self.gateways[addr]
+
+        payloads = self.payloads
+        sendto = self.transport.sendto
+        for _ in range(count):
+            payload = payloads[self.position]
+            self.position = (self.position + 1) % len(payloads)
+            for addr, gateway in self.gateways.items():
+                for channel in gateway.channels:
+                    if self.loss and random.random() < self.loss:
+                        self.dropped += 1
+                        continue
+                    sendto(self.header(channel, len(payload)) + payload, addr)
+                    self.sent += 1
+
+    async def stream(self):
+        start = time.monotonic()
+        due = 0
+        while True:
+            await asyncio.sleep(TICK)
+            target = int((time.monotonic() - start) * self.rate)
+            self.send_data(target - due)
+            due = target
+
+    def describe(self):
+        channels = sum(len(gateway.channels) for gateway in self.gateways.values())
+        return (
+            f"{len(self.gateways)} gateway(s), {channels} channel(s), {self.sent} datagrams sent, "
+            f"{self.dropped} dropped, {self.rejected_updates} updates rejected"
+        )
+
+
+async def serve(args):
+    loop = asyncio.get_running_loop()
+    relay = FakeRelay(load_ts_payloads(args.ts), args.bitrate, args.loss, args.query_interval)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8 * 1024 * 1024)
+    sock.bind((args.address, args.port))
+    await loop.create_datagram_endpoint(lambda: relay, sock=sock)
+    logger.info(f"Fake AMT relay on {args.address}:{args.port}, {args.bitrate} bit/s per channel, loss {args.loss}")
+    loop.create_task(relay.stream())
+    while True:
+        await asyncio.sleep(args.report_interval)
+        logger.info(relay.describe())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local AMT relay streaming a looping MPEG-TS file")
+    parser.add_argument("--address", default=LOCAL_LOOPBACK, help="Address to bind")
+    parser.add_argument("--port", type=int, default=AMT_RELAY_PORT)
+    parser.add_argument("--ts", help="MPEG-TS file to stream (default: synthetic stream)")
+    parser.add_argument("--bitrate", type=int, default=DEFAULT_BITRATE, help="Bits per second per channel")
+    parser.add_argument("--loss", type=float, default=0.0, help="Probability of dropping a data datagram")
+    parser.add_argument("--query-interval", type=int, default=DEFAULT_QUERY_INTERVAL, choices=range(1, 128),
+                        metavar="SECONDS", help="Query interval advertised to gateways")
+    parser.add_argument("--report-interval", type=float, default=10.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - fakerelay - %(levelname)s - %(message)s")
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
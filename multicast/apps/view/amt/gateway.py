@@ -0,0 +1,568 @@
+"""
+Long-lived AMT gateway daemon hosting many tunnels in a few processes.
+
+Tunnels run as asyncio datagram endpoints in one of N worker processes (one per core by
+default). The parent process owns a unix control socket speaking JSON lines and routes each
+session to a worker by its relay, so opening a tunnel is a cheap RPC instead of a process spawn.
+
+All channels from the same relay share one AMT session (one handshake, one socket): a second
+stream from a relay that is already in use only costs a Membership Update.
+
+Requests (one JSON object per line, one reply line each):
+
+    {"op": "add", "id": 7, "relay": "...", "source": "...", "group": "...", "stream_port": null, "udp_port": 4007,
+     "stats_path": "/dev/shm/amt-tunnel-7.stats"}
+    {"op": "remove", "id": 7}
+    {"op": "list"}
+
+Replies carry "ok": true/false and either the result or an "error" message. "stats_path" is
+optional; the metrics of the session are published there (see metrics.py).
+
+Run from this directory:
+
+    python3 gateway.py --socket /tmp/amt-gateway.sock --workers 4
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import secrets
+import socket
+import time
+import zlib
+
+from constants import (
+    AMT_MEM_QUERY,
+    AMT_MULT_DATA,
+    AMT_RELAY_ADV,
+    AMT_RELAY_PORT,
+    DEFAULT_QUERY_INTERVAL,
+    LOCAL_LOOPBACK,
+    REFRESH_RETRY_INTERVAL,
+)
+from datapath import message_type, udp_flow
+from metrics import PUBLISH_INTERVAL, StatsPublisher, TunnelMetrics
+from messages import (
+    BLOCK_OLD_SOURCES,
+    CHANGE_TO_INCLUDE_MODE,
+    discovery_template,
+    membership_update_template,
+    parse_membership_query,
+    request_template,
+)
+from relays import DEFAULT_STATE_PATH, RelayRegistry
+
+logger = logging.getLogger("amt.gateway")
+
+DEFAULT_SOCKET_PATH = "/tmp/amt-gateway.sock"
+HANDSHAKE_TIMEOUT = 10
+HEARTBEAT_INTERVAL = 30
+IDLE_TIMEOUT = 60
+RECONNECT_DELAY = 5
+
+
+class RelayProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram endpoint of one AMT session. Multicast Data is demultiplexed straight from
+    datagram_received(); control messages are handed to whoever awaits them.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.transport = None
+        self.waiters = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        # An empty datagram carries no type
+        if not data:
+            return
+        msg_type = message_type(data)
+        if msg_type == AMT_MULT_DATA:
+            self.session.forward(data)
+            return
+        waiter = self.waiters.pop(msg_type, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(data)
+        elif msg_type == AMT_MEM_QUERY:
+            # Answer to a membership refresh of an established session
+            self.session.handle_query(data)
+
+    def error_received(self, exc):
+        logger.warning(f"Relay {self.session.relay}: {exc}")
+
+    def expect(self, msg_type):
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[msg_type] = waiter
+        return waiter
+
+
+class Subscription:
+    """
+    One (source, group[, port]) channel of a relay session, forwarded to a local UDP port.
+    """
+
+    def __init__(self, session_id, source, group, stream_port, udp_port, stats_path=None):
+        self.session_id = session_id
+        self.source = source
+        self.group = group
+        self.stream_port = stream_port
+        self.destination = (LOCAL_LOOPBACK, udp_port)
+        self.flow = (socket.inet_aton(source) + socket.inet_aton(group), stream_port)
+        self.metrics = TunnelMetrics()
+        self.publisher = StatsPublisher(stats_path) if stats_path else None
+        self.dropped = 0
+
+    def publish(self):
+        if self.publisher is not None:
+            self.publisher.publish(self.metrics, self.dropped)
+
+    def close(self):
+        if self.publisher is not None:
+            self.publisher.close()
+
+    def describe(self):
+        return {
+            "id": self.session_id,
+            "source": self.source,
+            "group": self.group,
+            "stream_port": self.stream_port,
+            "udp_port": self.destination[1],
+            "packets": self.metrics.packets,
+            "bytes": self.metrics.bytes,
+            "dropped": self.dropped,
+            "gaps": self.metrics.gaps,
+            "cc_errors": self.metrics.cc_errors,
+        }
+
+
+class RelaySession:
+    """
+    One AMT session with a relay carrying every subscribed (S,G) channel.
+
+    The Discovery/Request/Query handshake happens once per relay; joining another channel on an
+    established session only costs one Membership Update listing all group records, and incoming
+    Multicast Data is demultiplexed by its inner (source, group, port) to the right local consumer.
+    """
+
+    def __init__(self, out_sock, relay, registry):
+        self.out_sock = out_sock
+        self.relay = relay
+        self.registry = registry
+        self.subscriptions = {}
+        self.flows = {}
+        self.task = None
+        self.transport = None
+        # Setup stages the session has reached, marked on the subscriptions that join it later
+        self.stages = set()
+        self.relay_addr = None
+        self.nonce = None
+        self.response_mac = None
+        self.query_interval = DEFAULT_QUERY_INTERVAL
+        self.next_refresh = 0.0
+        self.refresh_pending = False
+        self.unmatched = 0
+        self.last_packet_time = 0.0
+        self.discovery_template = discovery_template()
+        self.request_template = request_template()
+
+    def relays(self):
+        # Ordered again on every round, so a reconnect starts with the healthiest address
+        while True:
+            candidates = self.registry.candidates(self.relay)
+            if not candidates:
+                logger.error(f"Relay {self.relay}: no address")
+                yield None
+            yield from candidates
+
+    def records(self, leaving=()):
+        """
+        :param leaving: (source, group) channels that were just left
+        :return: IGMPv3 records of the channels subscribed to, and of those left
+        """
+        groups = {}
+        for subscription in self.subscriptions.values():
+            groups.setdefault(subscription.group, set()).add(subscription.source)
+        records = [(group, sorted(sources)) for group, sources in sorted(groups.items())]
+        blocked = {}
+        for source, group in leaving:
+            if source not in groups.get(group, ()):
+                blocked.setdefault(group, set()).add(source)
+        for group, sources in sorted(blocked.items()):
+            if group in groups:
+                # The relay stops forwarding these sources only, the group's other sources keep flowing
+                records.append((group, sorted(sources), BLOCK_OLD_SOURCES))
+            else:
+                # Groups nobody listens to any more are left with an empty include list
+                records.append((group, [], CHANGE_TO_INCLUDE_MODE))
+        return records
+
+    def send_membership_update(self, leaving=()):
+        if self.transport is None or self.response_mac is None:
+            return None
+        records = self.records(leaving)
+        if not records:
+            return None
+        update = bytes(membership_update_template(records).render(self.nonce, self.response_mac))
+        self.transport.sendto(update, self.relay_addr)
+        return update
+
+    def add(self, subscription):
+        self.subscriptions[subscription.session_id] = subscription
+        self.flows.setdefault(subscription.flow, []).append(subscription)
+        for stage in self.stages:
+            subscription.metrics.mark(stage)
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        else:
+            # Already joined on this relay: one Membership Update and the channel flows
+            self.send_membership_update()
+
+    def remove(self, session_id):
+        subscription = self.subscriptions.pop(session_id)
+        consumers = self.flows[subscription.flow]
+        consumers.remove(subscription)
+        if not consumers:
+            del self.flows[subscription.flow]
+        if self.subscriptions:
+            self.send_membership_update(leaving=[(subscription.source, subscription.group)])
+        else:
+            self.stop()
+        subscription.close()
+        return subscription
+
+    def forward(self, data):
+        flow = udp_flow(memoryview(data), len(data))
+        if flow is None:
+            self.unmatched += 1
+            return
+        addresses, dport, start, end = flow
+        consumers = self.flows.get((addresses, dport)) or self.flows.get((addresses, None))
+        if not consumers:
+            self.unmatched += 1
+            return
+        payload = memoryview(data)[start:end]
+        now = time.monotonic()
+        for subscription in consumers:
+            try:
+                self.out_sock.sendto(payload, subscription.destination)
+            except BlockingIOError:
+                subscription.dropped += 1
+                continue
+            subscription.metrics.observe(payload, now)
+        self.last_packet_time = now
+
+    async def handshake(self, protocol, relay_ip):
+        relay_addr = (relay_ip, AMT_RELAY_PORT)
+        nonce = secrets.token_bytes(4)
+
+        advertisement = protocol.expect(AMT_RELAY_ADV)
+        sent_at = time.perf_counter()
+        protocol.transport.sendto(self.discovery_template.render(nonce), relay_addr)
+        try:
+            await asyncio.wait_for(advertisement, HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.registry.record(relay_ip, None)
+            raise
+        self.registry.record(relay_ip, time.perf_counter() - sent_at)
+        self.mark("advertisement")
+
+        query = protocol.expect(AMT_MEM_QUERY)
+        protocol.transport.sendto(self.request_template.render(nonce), relay_addr)
+        membership_query = parse_membership_query(await asyncio.wait_for(query, HANDSHAKE_TIMEOUT))
+        if membership_query is None:
+            raise ValueError("Malformed membership query")
+
+        self.transport = protocol.transport
+        self.relay_addr = relay_addr
+        self.nonce = nonce
+        self.apply_query(membership_query)
+
+    def apply_query(self, membership_query):
+        self.response_mac = membership_query.response_mac
+        self.query_interval = membership_query.query_interval or DEFAULT_QUERY_INTERVAL
+        self.next_refresh = time.monotonic() + self.query_interval
+        self.refresh_pending = False
+
+    def handle_query(self, data):
+        membership_query = parse_membership_query(data)
+        if self.transport is None or membership_query is None or membership_query.nonce != self.nonce:
+            return
+        self.apply_query(membership_query)
+        self.send_membership_update()
+
+    def refresh(self):
+        """
+        Asks the relay for a new Membership Query (RFC 7450, section 5.2.3.4); handle_query()
+        answers it with an Update carrying the new response MAC.
+        """
+        if self.refresh_pending:
+            logger.warning(f"Relay {self.relay}: membership refresh not answered, retrying")
+        self.transport.sendto(self.request_template.render(self.nonce), self.relay_addr)
+        self.refresh_pending = True
+        self.next_refresh = time.monotonic() + min(self.query_interval, REFRESH_RETRY_INTERVAL)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for relay_ip in self.relays():
+            if relay_ip is None:
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                # One ephemeral port per relay session, whatever the number of channels on it
+                transport, protocol = await loop.create_datagram_endpoint(
+                    lambda: RelayProtocol(self), local_addr=("0.0.0.0", 0)
+                )
+            except OSError as e:
+                logger.error(f"Relay {self.relay}: cannot open a socket: {e}")
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            self.mark("socket_bound")
+            try:
+                await self.handshake(protocol, relay_ip)
+                self.last_packet_time = time.monotonic()
+                self.send_membership_update()
+                logger.info(f"Relay {self.relay}: session up via {relay_ip} with {len(self.subscriptions)} channels")
+
+                while True:
+                    await asyncio.sleep(max(0.0, min(HEARTBEAT_INTERVAL, self.next_refresh - time.monotonic())))
+                    now = time.monotonic()
+                    idle = now - self.last_packet_time
+                    if idle > IDLE_TIMEOUT:
+                        logger.warning(f"Relay {self.relay}: no data for {idle:.0f}s, reconnecting")
+                        break
+                    if now >= self.next_refresh:
+                        self.refresh()
+                    elif idle > HEARTBEAT_INTERVAL:
+                        self.send_membership_update()
+            except asyncio.TimeoutError:
+                logger.warning(f"Relay {self.relay}: {relay_ip} did not answer, trying next relay")
+            except Exception as e:
+                logger.error(f"Relay {self.relay}: {e}")
+            finally:
+                self.transport = None
+                self.response_mac = None
+                self.stages.clear()
+                transport.close()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    def mark(self, stage):
+        self.stages.add(stage)
+        for subscription in self.subscriptions.values():
+            subscription.metrics.mark(stage)
+            subscription.publish()
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def describe(self):
+        return {
+            "relay": self.relay,
+            "relay_ip": self.relay_addr[0] if self.transport is not None else None,
+            "channels": len(self.subscriptions),
+            "unmatched": self.unmatched,
+        }
+
+
+class Worker:
+    """
+    Event loop of one worker process. Commands arrive over a multiprocessing pipe from the
+    parent and are answered on the same pipe.
+    """
+
+    def __init__(self, conn, relay_state):
+        self.conn = conn
+        self.registry = RelayRegistry(relay_state)
+        self.relay_sessions = {}
+        self.session_relays = {}
+        self.out_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.out_sock.setblocking(False)
+
+    def describe(self, session_id):
+        relay_session = self.relay_sessions[self.session_relays[session_id]]
+        return dict(relay_session.subscriptions[session_id].describe(), **relay_session.describe())
+
+    def handle(self, request):
+        op = request.get("op")
+        if op == "add":
+            session_id = request["id"]
+            if session_id in self.session_relays:
+                return self.describe(session_id)
+            relay = request["relay"]
+            stream_port = request.get("stream_port")
+            subscription = Subscription(
+                session_id, request["source"], request["group"],
+                int(stream_port) if stream_port else None, int(request["udp_port"]), request.get("stats_path")
+            )
+            if relay not in self.relay_sessions:
+                self.relay_sessions[relay] = RelaySession(self.out_sock, relay, self.registry)
+            self.relay_sessions[relay].add(subscription)
+            self.session_relays[session_id] = relay
+            return self.describe(session_id)
+        if op == "remove":
+            session_id = request["id"]
+            if session_id not in self.session_relays:
+                raise KeyError(f"No session {session_id}")
+            description = self.describe(session_id)
+            relay = self.session_relays.pop(session_id)
+            relay_session = self.relay_sessions[relay]
+            relay_session.remove(session_id)
+            if not relay_session.subscriptions:
+                del self.relay_sessions[relay]
+            return description
+        if op == "list":
+            return [self.describe(session_id) for session_id in self.session_relays]
+        raise ValueError(f"Unknown operation {op!r}")
+
+    def on_command(self):
+        try:
+            request_id, request = self.conn.recv()
+        except EOFError:
+            self.stopped.set_result(None)
+            return
+        try:
+            self.conn.send((request_id, True, self.handle(request)))
+        except Exception as e:
+            self.conn.send((request_id, False, str(e)))
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        loop.add_reader(self.conn.fileno(), self.on_command)
+        publisher = loop.create_task(self.publish_metrics())
+        await self.stopped
+        publisher.cancel()
+        for relay_session in self.relay_sessions.values():
+            relay_session.stop()
+            for subscription in relay_session.subscriptions.values():
+                subscription.close()
+
+    async def publish_metrics(self):
+        while True:
+            await asyncio.sleep(PUBLISH_INTERVAL)
+            for relay_session in self.relay_sessions.values():
+                for subscription in relay_session.subscriptions.values():
+                    subscription.publish()
+
+
+def worker_main(conn, index, relay_state):
+    logging.basicConfig(
+        level=logging.INFO, format=f"%(asctime)s - worker {index} - %(levelname)s - %(message)s", force=True
+    )
+    asyncio.run(Worker(conn, relay_state).serve())
+
+
+class WorkerHandle:
+    """
+    Parent-side end of a worker's pipe, matching replies to requests by id.
+    """
+
+    def __init__(self, index, relay_state):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=worker_main, args=(child_conn, index, relay_state), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.pending = {}
+        self.request_ids = itertools.count()
+
+    def attach(self, loop):
+        loop.add_reader(self.conn.fileno(), self.on_reply)
+
+    def on_reply(self):
+        request_id, ok, result = self.conn.recv()
+        future = self.pending.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_result({"ok": ok, "result": result} if ok else {"ok": ok, "error": result})
+
+    async def request(self, request):
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.conn.send((request_id, request))
+        return await future
+
+
+class Gateway:
+    def __init__(self, socket_path, workers, relay_state=DEFAULT_STATE_PATH):
+        self.socket_path = socket_path
+        self.workers = [WorkerHandle(index, relay_state) for index in range(workers)]
+        self.placement = {}
+
+    def shard(self, relay):
+        # Every channel of a relay lives in the same worker, so they can share its AMT session
+        return self.workers[zlib.crc32(relay.encode()) % len(self.workers)]
+
+    async def dispatch(self, request):
+        op = request.get("op")
+        if op in ("add", "remove"):
+            if "id" not in request:
+                return {"ok": False, "error": "Missing session id"}
+            session_id = request["id"]
+            if op == "add":
+                if session_id not in self.placement:
+                    if "relay" not in request:
+                        return {"ok": False, "error": "Missing relay"}
+                    self.placement[session_id] = self.shard(request["relay"])
+                worker = self.placement[session_id]
+            else:
+                worker = self.placement.pop(session_id, None)
+                if worker is None:
+                    return {"ok": False, "error": f"No session {session_id}"}
+            reply = await worker.request(request)
+            if op == "add" and not reply["ok"]:
+                self.placement.pop(session_id, None)
+            return reply
+        if op == "list":
+            replies = await asyncio.gather(*(worker.request(request) for worker in self.workers))
+            return {"ok": True, "result": [session for reply in replies for session in reply["result"]]}
+        return {"ok": False, "error": f"Unknown operation {op!r}"}
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    reply = await self.dispatch(json.loads(line))
+                except ValueError as e:
+                    reply = {"ok": False, "error": f"Malformed request: {e}"}
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        for worker in self.workers:
+            worker.attach(loop)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        logger.info(f"AMT gateway listening on {self.socket_path} with {len(self.workers)} workers")
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AMT gateway daemon hosting many tunnels")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="Path of the unix control socket")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--relay-state", default=DEFAULT_STATE_PATH, help="Path of the relay health file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - gateway - %(levelname)s - %(message)s")
+    asyncio.run(Gateway(args.socket, max(1, args.workers), args.relay_state).serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""
+Load test of N concurrent tunnels against a local fake AMT relay (fakerelay.py).
+
+The driver starts the relay, opens N tunnels to it, each joined to its own (S,G) channel and
+forwarding to its own loopback UDP port, and listens on all those ports. It reports:
+
+- setup latency: from starting a tunnel to the first datagram on its port
+- sustained throughput per tunnel, and what reached the ports against what the relay sent
+- CPU per tunnel, from the CPU time of the tunnel processes (or of the gateway daemon and its
+  workers) during the measurement window, in percent of one core
+- latency histograms of the setup stages the tunnels publish in their metrics blocks (socket
+  bound, Advertisement received, first data), each from the stage before it; --max-stage-p95
+  fails the run (exit status 1) when the 95th percentile of a stage exceeds a bound
+
+Tunnels are either tunnel.py processes, as open_tunnel starts them, or sessions on a gateway
+daemon (gateway.py) started by the driver. Run from this directory:
+
+    python3 loadtest.py --tunnels 200 --mode gateway --workers 4 --bitrate 4000000 --duration 30
+    python3 loadtest.py --tunnels 50 --mode process --io batch --loss 0.001 --ts stream.ts
+    python3 loadtest.py --tunnels 20 --max-stage-p95 advertisement=0.05 --max-stage-p95 first_data=0.5
+
+Everything runs on loopback; the relay binds the AMT port on --relay-address, which must not be
+in use.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import psutil
+
+from constants import AMT_RELAY_ADV, AMT_RELAY_PORT, LOCAL_LOOPBACK
+from fakerelay import DEFAULT_BITRATE
+from messages import discovery_template
+from metrics import TUNNEL_STAGES, LatencyHistogram, read_stats, stats_path
+
+AMT_DIR = os.path.dirname(os.path.abspath(__file__))
+MODES = ("process", "gateway")
+SOURCE = "10.0.0.1"
+# Tunnels stop waiting for their first datagram after this many seconds
+SETUP_TIMEOUT = 30.0
+
+
+def channel(index):
+    """
+    Returns the group of the index-th tunnel, one per tunnel in 232.1.0.0/16.
+    """
+    return f"232.1.{index // 250}.{index % 250 + 1}"
+
+
+class PortCounter(asyncio.DatagramProtocol):
+    """
+    Counts what one tunnel forwards to its UDP port.
+    """
+
+    def __init__(self):
+        self.started = None
+        # Unix time of the start, which the setup stages of the tunnel are measured from
+        self.started_at = None
+        self.first_packet = None
+        self.packets = 0
+        self.bytes = 0
+
+    def datagram_received(self, data, addr):
+        if self.first_packet is None:
+            self.first_packet = time.perf_counter()
+        self.packets += 1
+        self.bytes += len(data)
+
+    def setup_latency(self):
+        if self.first_packet is None or self.started is None:
+            return None
+        return self.first_packet - self.started
+
+
+def wait_for_relay(address, timeout=10.0):
+    """
+    Sends Discoveries until the relay at address answers.
+    """
+    template = discovery_template()
+    deadline = time.monotonic() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.2)
+        while time.monotonic() < deadline:
+            sock.sendto(template.render(os.urandom(4)), (address, AMT_RELAY_PORT))
+            try:
+                data = sock.recv(64)
+            except socket.timeout:
+                continue
+            if data and data[0] == AMT_RELAY_ADV:
+                return
+    raise RuntimeError(f"The fake relay on {address} did not answer within {timeout} seconds")
+
+
+async def gateway_request(socket_path, request):
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write(json.dumps(request).encode() + b"\n")
+    reply = json.loads(await reader.readline())
+    writer.close()
+    await writer.wait_closed()
+    if not reply.get("ok"):
+        raise RuntimeError(f"Gateway rejected {request}: {reply.get('error')}")
+    return reply.get("result")
+
+
+async def wait_for_socket(path, proc, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if proc.poll() is not None or time.monotonic() > deadline:
+            raise RuntimeError("The gateway daemon did not start")
+        await asyncio.sleep(0.05)
+
+
+def cpu_seconds(processes):
+    """
+    Returns the user and system CPU seconds used so far by processes and their children.
+    """
+    total = 0.0
+    for proc in processes:
+        try:
+            members = [proc, *proc.children(recursive=True)]
+        except psutil.NoSuchProcess:
+            continue
+        for member in members:
+            try:
+                times = member.cpu_times()
+            except psutil.NoSuchProcess:
+                continue
+            total += times.user + times.system
+    return total
+
+
+async def start_tunnels(args, counters, work_dir):
+    """
+    Starts one tunnel per counter and returns the processes to measure.
+    """
+    if args.mode == "process":
+        processes = []
+        for index, counter in enumerate(counters):
+            command = [
+                sys.executable, os.path.join(AMT_DIR, "tunnel.py"), args.relay_address, SOURCE, channel(index),
+                str(args.amt_base_port + index), str(args.udp_base_port + index),
+                "--io", args.io, "--relay-state", os.path.join(work_dir, "relays.json"),
+                "--stats-path", stats_path(index, work_dir),
+            ]
+            counter.started = time.perf_counter()
+            counter.started_at = time.time()
+            processes.append(subprocess.Popen(command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        return processes
+
+    socket_path = os.path.join(work_dir, "gateway.sock")
+    command = [
+        sys.executable, os.path.join(AMT_DIR, "gateway.py"), "--socket", socket_path,
+        "--workers", str(args.workers), "--relay-state", os.path.join(work_dir, "relays.json"),
+    ]
+    gateway = subprocess.Popen(command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    await wait_for_socket(socket_path, gateway)
+    for index, counter in enumerate(counters):
+        counter.started = time.perf_counter()
+        counter.started_at = time.time()
+        await gateway_request(socket_path, {
+            "op": "add", "id": index, "relay": args.relay_address, "source": SOURCE, "group": channel(index),
+            "stream_port": None, "udp_port": args.udp_base_port + index, "stats_path": stats_path(index, work_dir),
+        })
+    return [gateway]
+
+
+def stage_histograms(counters, work_dir):
+    """
+    Reads the setup stages the tunnels published and returns {stage: LatencyHistogram} of the
+    time each took from the stage before it (from the start of the tunnel for the first one).
+    """
+    histograms = {stage: LatencyHistogram() for stage in TUNNEL_STAGES}
+    for index, counter in enumerate(counters):
+        stats = read_stats(stats_path(index, work_dir))
+        if stats is None:
+            continue
+        previous = counter.started_at
+        for stage in TUNNEL_STAGES:
+            if not stats[stage]:
+                break
+            histograms[stage].observe(max(stats[stage] - previous, 0.0))
+            previous = stats[stage]
+    return histograms
+
+
+def parse_bound(text):
+    stage, _, seconds = text.partition("=")
+    if stage not in TUNNEL_STAGES:
+        raise argparse.ArgumentTypeError(f"unknown stage {stage!r}, expected one of {', '.join(TUNNEL_STAGES)}")
+    try:
+        return stage, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected STAGE=SECONDS, got {text!r}")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    relay_command = [
+        sys.executable, os.path.join(AMT_DIR, "fakerelay.py"), "--address", args.relay_address,
+        "--bitrate", str(args.bitrate), "--loss", str(args.loss), "--report-interval", "3600",
+    ]
+    if args.ts:
+        relay_command += ["--ts", args.ts]
+
+    counters = [PortCounter() for _ in range(args.tunnels)]
+    transports = []
+    processes = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        relay = subprocess.Popen(relay_command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_relay(args.relay_address)
+            for index, counter in enumerate(counters):
+                # Large buffers, so that the driver does not drop what the tunnels forward
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+                sock.bind((LOCAL_LOOPBACK, args.udp_base_port + index))
+                transport, _ = await loop.create_datagram_endpoint(lambda counter=counter: counter, sock=sock)
+                transports.append(transport)
+
+            processes = [psutil.Process(proc.pid) for proc in await start_tunnels(args, counters, work_dir)]
+            deadline = time.perf_counter() + SETUP_TIMEOUT
+            while any(counter.first_packet is None for counter in counters) and time.perf_counter() < deadline:
+                await asyncio.sleep(0.05)
+
+            # Measurement window, once every tunnel is up (or has given up)
+            relay_process = psutil.Process(relay.pid)
+            start_counts = [(counter.packets, counter.bytes) for counter in counters]
+            start_cpu, start_relay_cpu = cpu_seconds(processes), cpu_seconds([relay_process])
+            start = time.perf_counter()
+            await asyncio.sleep(args.duration)
+            elapsed = time.perf_counter() - start
+            cpu = cpu_seconds(processes) - start_cpu
+            relay_cpu = cpu_seconds([relay_process]) - start_relay_cpu
+            counts = [
+                (counter.packets - packets, counter.bytes - nbytes)
+                for counter, (packets, nbytes) in zip(counters, start_counts)
+            ]
+            # Before the tunnels stop and remove their metrics blocks
+            stages = stage_histograms(counters, work_dir)
+        finally:
+            for transport in transports:
+                transport.close()
+            # The workers of the gateway would outlive it, and join the channels of the next run
+            members = []
+            for proc in processes:
+                try:
+                    members += [proc, *proc.children(recursive=True)]
+                except psutil.NoSuchProcess:
+                    pass
+            for proc in members:
+                try:
+                    proc.terminate()
+                except psutil.NoSuchProcess:
+                    pass
+            psutil.wait_procs(members, timeout=5)
+            relay.terminate()
+            relay.wait()
+
+    latencies = [latency for latency in (counter.setup_latency() for counter in counters) if latency is not None]
+    rates = [nbytes * 8 / elapsed for _, nbytes in counts]
+    expected = args.bitrate * (1 - args.loss)
+    result = {
+        "mode": args.mode,
+        "tunnels": args.tunnels,
+        "up": len(latencies),
+        "setup_p50_ms": round(statistics.median(latencies) * 1e3, 1) if latencies else None,
+        "setup_p95_ms": round(percentile(latencies, 0.95) * 1e3, 1) if latencies else None,
+        "setup_max_ms": round(max(latencies) * 1e3, 1) if latencies else None,
+        "throughput_mean_bps": round(statistics.mean(rates)),
+        "throughput_min_bps": round(min(rates)),
+        "delivered": round(statistics.mean(rates) / expected, 4) if expected else None,
+        "aggregate_bps": round(sum(rates)),
+        "cpu_per_tunnel_percent": round(cpu / elapsed / args.tunnels * 100, 3),
+        "cpu_total_percent": round(cpu / elapsed * 100, 1),
+        "relay_cpu_percent": round(relay_cpu / elapsed * 100, 1),
+        "stages": {stage: histogram.summary() for stage, histogram in stages.items()},
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test N tunnels against a local fake AMT relay")
+    parser.add_argument("--tunnels", type=int, default=10)
+    parser.add_argument("--mode", choices=MODES, default="process", help="tunnel.py processes or gateway sessions")
+    parser.add_argument("--io", choices=("single", "batch"), default="batch", help="I/O mode of tunnel.py processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes of the gateway")
+    parser.add_argument("--relay-address", default=LOCAL_LOOPBACK, help="Loopback address the fake relay binds")
+    parser.add_argument("--bitrate", type=int, default=DEFAULT_BITRATE, help="Bits per second per tunnel")
+    parser.add_argument("--loss", type=float, default=0.0, help="Loss applied by the relay")
+    parser.add_argument("--ts", help="MPEG-TS file the relay streams (default: synthetic stream)")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of the measurement window")
+    parser.add_argument("--udp-base-port", type=int, default=21000, help="UDP port of the first tunnel")
+    parser.add_argument("--amt-base-port", type=int, default=31000, help="AMT port of the first tunnel process")
+    parser.add_argument(
+        "--max-stage-p95", type=parse_bound, action="append", default=[], metavar="STAGE=SECONDS",
+        help=f"Fail if the 95th percentile of a setup stage ({', '.join(TUNNEL_STAGES)}) is above SECONDS",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    failures = [
+        f"{stage} p95 {result['stages'][stage]['p95']} s > {bound} s"
+        for stage, bound in args.max_stage_p95
+        if result["stages"][stage]["p95"] is None or result["stages"][stage]["p95"] > bound
+    ]
+    if args.json:
+        print(json.dumps(result))
+    else:
+        report(result)
+    if failures:
+        print("Setup stages too slow: " + "; ".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+def report(result):
+    print(f"{result['up']}/{result['tunnels']} tunnels up ({result['mode']})")
+    if result["up"]:
+        print(
+            f"setup latency     p50 {result['setup_p50_ms']} ms, p95 {result['setup_p95_ms']} ms, "
+            f"max {result['setup_max_ms']} ms"
+        )
+    print(
+        f"throughput        {result['throughput_mean_bps'] / 1e6:.2f} Mbit/s per tunnel "
+        f"(min {result['throughput_min_bps'] / 1e6:.2f}), {result['aggregate_bps'] / 1e6:.1f} Mbit/s in total, "
+        f"{result['delivered']:.1%} of the relay's rate"
+    )
+    print(
+        f"CPU               {result['cpu_per_tunnel_percent']:.2f}% of a core per tunnel, "
+        f"{result['cpu_total_percent']:.1f}% in total; relay {result['relay_cpu_percent']:.1f}%"
+    )
+    for stage, summary in result["stages"].items():
+        if summary["count"]:
+            print(
+                f"{stage:17} p50 {summary['p50'] * 1e3:.1f} ms, p95 {summary['p95'] * 1e3:.1f} ms "
+                f"({summary['count']} tunnels)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Precompiled AMT control messages.
+
+Discovery, Request and Membership Update messages are packed once into byte templates;
+only the nonce and the response MAC are patched in before each send. The result is sent
+over the tunnel's own UDP socket, so no scapy layer stacks, route lookups or raw sockets
+are involved in the handshake or the periodic membership refresh.
+
+The templates are byte-for-byte identical to the scapy messages in models.py
+(AMT_Discovery, AMT_Relay_Request and AMT_Membership_Update / IP / IGMPv3 / IGMPv3mr).
+"""
+import socket
+import struct
+from collections import namedtuple
+
+from constants import (
+    AMT_MEM_QUERY,
+    AMT_MEM_UPD,
+    AMT_RELAY_ADV,
+    AMT_RELAY_DISCO,
+    AMT_REQUEST,
+    MCAST_ALLHOSTS,
+    MCAST_ANYCAST,
+)
+
+NONCE_LEN = 4
+MAC_LEN = 6
+
+IGMP_PROTO = 2
+IGMPV3_REPORT = 0x22
+IGMPV3_QUERY = 0x11
+MODE_IS_INCLUDE = 1
+CHANGE_TO_INCLUDE_MODE = 3
+ALLOW_NEW_SOURCES = 5
+BLOCK_OLD_SOURCES = 6
+
+IPV4_HDR = struct.Struct("!BBHHHBBH4s4s")
+_U16 = struct.Struct("!H")
+
+MCAST_ALLSYSTEMS = "224.0.0.1"
+
+MembershipQuery = namedtuple("MembershipQuery", ["response_mac", "nonce", "qrv", "qqic", "query_interval"])
+MembershipUpdate = namedtuple("MembershipUpdate", ["response_mac", "nonce", "records"])
+
+
+def checksum(data):
+    """
+    Computes the Internet checksum (RFC 1071) of the given bytes.
+    """
+    if len(data) % 2:
+        data = bytes(data) + b"\x00"
+    total = sum(struct.unpack("!%dH" % (len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+class MessageTemplate:
+    """
+    A packed AMT message with the offsets of the fields that change per send.
+    render() patches the buffer in place and returns it, so nothing is allocated per send.
+    """
+
+    def __init__(self, data, nonce_offset, mac_offset=None):
+        self.buffer = bytearray(data)
+        self.nonce_offset = nonce_offset
+        self.mac_offset = mac_offset
+
+    def render(self, nonce, response_mac=None):
+        self.buffer[self.nonce_offset:self.nonce_offset + NONCE_LEN] = nonce
+        if self.mac_offset is not None and response_mac is not None:
+            self.buffer[self.mac_offset:self.mac_offset + MAC_LEN] = response_mac
+        return self.buffer
+
+    def __len__(self):
+        return len(self.buffer)
+
+
+def discovery_template():
+    return MessageTemplate(bytes((AMT_RELAY_DISCO, 0, 0, 0)) + bytes(NONCE_LEN), nonce_offset=4)
+
+
+def request_template():
+    return MessageTemplate(bytes((AMT_REQUEST, 0, 0, 0)) + bytes(NONCE_LEN), nonce_offset=4)
+
+
+def igmpv3_report(records):
+    """
+    Packs an IGMPv3 Membership Report.
+
+    :param records: Iterable of (group, [sources]) tuples, one MODE_IS_INCLUDE record each, or
+                    (group, [sources], record_type) tuples for other record types
+    :return: Report as bytes, checksum included
+    """
+    records = list(records)
+    body = b""
+    for record in records:
+        group, sources = record[0], record[1]
+        record_type = record[2] if len(record) > 2 else MODE_IS_INCLUDE
+        body += struct.pack("!BBH4s", record_type, 0, len(sources), socket.inet_aton(group))
+        body += b"".join(socket.inet_aton(source) for source in sources)
+    report = struct.pack("!BBHHH", IGMPV3_REPORT, 0, 0, 0, len(records)) + body
+    return report[:2] + _U16.pack(checksum(report)) + report[4:]
+
+
+def membership_update_template(records):
+    """
+    Packs an AMT Membership Update carrying an IGMPv3 report for the given records.
+
+    :param records: Iterable of records as accepted by igmpv3_report()
+    :return: MessageTemplate with the response MAC at offset 2 and the nonce at offset 8
+    """
+    report = igmpv3_report(records)
+    # One zero option byte padded to a word, TOS 0xc0 and TTL 1, as sent by the scapy implementation
+    options = bytes(4)
+    ip_header = IPV4_HDR.pack(
+        0x40 | (20 + len(options)) // 4, 0xC0, 20 + len(options) + len(report), 1, 0, 1, IGMP_PROTO, 0,
+        socket.inet_aton(MCAST_ANYCAST), socket.inet_aton(MCAST_ALLHOSTS)
+    ) + options
+    ip_header = ip_header[:10] + _U16.pack(checksum(ip_header)) + ip_header[12:]
+    header = bytes((AMT_MEM_UPD, 0)) + bytes(MAC_LEN) + bytes(NONCE_LEN)
+    return MessageTemplate(header + ip_header + report, nonce_offset=8, mac_offset=2)
+
+
+def encode_relay_advertisement(nonce, relay_ip):
+    """
+    Packs an AMT Relay Advertisement, as answered by a relay to a Discovery.
+    """
+    return bytes((AMT_RELAY_ADV, 0, 0, 0)) + bytes(nonce) + socket.inet_aton(relay_ip)
+
+
+def encode_membership_query(nonce, response_mac, source_ip, qrv=2, qqic=125, max_resp_code=100):
+    """
+    Packs an AMT Membership Query carrying a general IGMPv3 query, as answered by a relay to a Request.
+    """
+    query = struct.pack("!BBH4sBBH", IGMPV3_QUERY, max_resp_code, 0, bytes(4), qrv & 0x07, qqic, 0)
+    query = query[:2] + _U16.pack(checksum(query)) + query[4:]
+    ip_header = IPV4_HDR.pack(
+        0x45, 0xC0, 20 + len(query), 1, 0, 1, IGMP_PROTO, 0,
+        socket.inet_aton(source_ip), socket.inet_aton(MCAST_ALLSYSTEMS)
+    )
+    ip_header = ip_header[:10] + _U16.pack(checksum(ip_header)) + ip_header[12:]
+    return bytes((AMT_MEM_QUERY, 0)) + bytes(response_mac) + bytes(nonce) + ip_header + query
+
+
+def decode_qqic(qqic):
+    """
+    Decodes the Querier's Query Interval Code of an IGMPv3 query (RFC 3376, section 4.1.7).
+
+    :return: Query interval in seconds
+    """
+    if qqic < 128:
+        return qqic
+    return ((qqic & 0x0F) | 0x10) << (((qqic >> 4) & 0x07) + 3)
+
+
+def parse_membership_query(data):
+    """
+    Parses an AMT Membership Query without scapy.
+
+    :param data: Received message
+    :return: MembershipQuery, or None if the message is not a well-formed Membership Query
+    """
+    view = memoryview(data)
+    if len(view) < 12 or view[0] != AMT_MEM_QUERY:
+        return None
+    response_mac = bytes(view[2:8])
+    nonce = bytes(view[8:12])
+
+    qrv, qqic = 0, 0
+    ip_offset = 12
+    if len(view) >= ip_offset + 20 and view[ip_offset] >> 4 == 4:
+        igmp_offset = ip_offset + ((view[ip_offset] & 0x0F) << 2)
+        if len(view) >= igmp_offset + 12 and view[igmp_offset] == IGMPV3_QUERY:
+            qrv = view[igmp_offset + 8] & 0x07
+            qqic = view[igmp_offset + 9]
+    return MembershipQuery(response_mac, nonce, qrv, qqic, decode_qqic(qqic))
+
+
+def parse_membership_update(data):
+    """
+    Parses an AMT Membership Update carrying an IGMPv3 report, as a relay would.
+
+    :param data: Received message
+    :return: MembershipUpdate whose records are (group, [sources], record_type) tuples,
+             or None if the message is not a well-formed Membership Update
+    """
+    view = memoryview(data)
+    if len(view) < 12 + 20 or view[0] != AMT_MEM_UPD:
+        return None
+    offset = 12 + ((view[12] & 0x0F) << 2)
+    if len(view) < offset + 8 or view[offset] != IGMPV3_REPORT:
+        return None
+
+    records = []
+    count = _U16.unpack_from(view, offset + 6)[0]
+    offset += 8
+    for _ in range(count):
+        if len(view) < offset + 8:
+            return None
+        record_type, aux_len, source_count = struct.unpack_from("!BBH", view, offset)
+        group = socket.inet_ntoa(view[offset + 4:offset + 8])
+        offset += 8
+        sources = [socket.inet_ntoa(view[offset + 4 * i:offset + 4 * i + 4]) for i in range(source_count)]
+        offset += 4 * source_count + 4 * aux_len
+        records.append((group, sources, record_type))
+    return MembershipUpdate(bytes(view[2:8]), bytes(view[8:12]), records)
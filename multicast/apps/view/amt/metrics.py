@@ -0,0 +1,287 @@
+"""
+Data-plane metrics of a tunnel, published through a small shared-memory block.
+
+TunnelMetrics keeps plain integer counters updated per forwarded payload: packets, bytes,
+inter-arrival gaps and MPEG-TS continuity-counter errors of the 188-byte TS packets in each
+payload, and the times the tunnel reached the stages of its setup (TUNNEL_STAGES), which the
+time-to-first-frame trace of a stream picks up (util/ttff.py). StatsPublisher copies them about
+once a second into a fixed-size file under /dev/shm, which any other process (the Django side)
+maps or reads with read_stats() without talking to the tunnel. LatencyHistogram aggregates setup
+latencies into fixed buckets.
+
+The block is guarded by a sequence counter (odd while being written), so readers never see a
+half-written record. This module has no sibling imports, so it can be imported both from the
+tunnel scripts and from the Django app.
+"""
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+TS_NULL_PID = 0x1FFF
+# Arrival gaps longer than this many seconds are counted as gaps
+GAP_THRESHOLD = 0.1
+PUBLISH_INTERVAL = 1.0
+
+STATS_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+STATS_MAGIC = b"AMTS"
+STATS_VERSION = 2
+STATS_SIZE = 4096
+
+_HEADER = struct.Struct("<4sH")
+_SEQ = struct.Struct("<Q")
+_SEQ_OFFSET = 8
+_BODY_OFFSET = _SEQ_OFFSET + _SEQ.size
+# Fields of the record after the sequence counter; times are Unix timestamps and seconds
+FIELDS = (
+    "pid", "started", "updated", "packets", "bytes", "bitrate", "gaps", "max_gap",
+    "ts_packets", "cc_errors", "dropped", "control_messages", "socket_bound", "advertisement", "first_data",
+)
+_BODY = struct.Struct("<QddQQdQdQQQQddd")
+# Setup stages of a tunnel, in order: its AMT socket bound, the relay's Advertisement received and
+# the first Multicast Data forwarded. Their times are Unix timestamps, 0 until reached.
+TUNNEL_STAGES = ("socket_bound", "advertisement", "first_data")
+# Upper bounds (seconds) of the buckets of a LatencyHistogram; the last bucket is unbounded
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 8.0, 15.0, 30.0, 60.0,
+)
+
+
+class TunnelMetrics:
+    """
+    Counters of the payloads forwarded by one tunnel.
+    """
+
+    def __init__(self, gap_threshold=GAP_THRESHOLD):
+        self.gap_threshold = gap_threshold
+        self.started = time.time()
+        self.packets = 0
+        self.bytes = 0
+        self.gaps = 0
+        self.max_gap = 0.0
+        self.ts_packets = 0
+        self.cc_errors = 0
+        self.control_messages = 0
+        self.socket_bound = 0.0
+        self.advertisement = 0.0
+        self.first_data = 0.0
+        self.last_arrival = None
+        # Last continuity counter per PID
+        self.continuity = {}
+
+    def mark(self, stage):
+        """
+        Records the time a setup stage (one of TUNNEL_STAGES) was first reached.
+        """
+        if not getattr(self, stage):
+            setattr(self, stage, time.time())
+
+    def observe(self, payload, now):
+        """
+        Accounts for one forwarded payload.
+
+        :param payload: UDP payload (bytes or memoryview)
+        :param now: Arrival time, time.monotonic()
+        """
+        if not self.packets:
+            self.first_data = time.time()
+        self.packets += 1
+        self.bytes += len(payload)
+        if self.last_arrival is not None:
+            gap = now - self.last_arrival
+            if gap > self.gap_threshold:
+                self.gaps += 1
+                if gap > self.max_gap:
+                    self.max_gap = gap
+        self.last_arrival = now
+        self.check_continuity(payload)
+
+    def check_continuity(self, payload):
+        count = len(payload) // TS_PACKET_SIZE
+        if not count or payload[0] != TS_SYNC_BYTE:
+            return
+        self.ts_packets += count
+        headers = _ts_headers(count).unpack_from(payload)
+        continuity = self.continuity
+        for index in range(count):
+            pid = headers[2 * index] & TS_NULL_PID
+            flags = headers[2 * index + 1]
+            # Null packets carry no counter; packets without payload do not increment it
+            if pid == TS_NULL_PID or not flags & 0x10:
+                continue
+            cc = flags & 0x0F
+            last = continuity.get(pid, (cc - 1) & 0x0F)
+            continuity[pid] = cc
+            # A repeated counter is a legal duplicate packet
+            if (cc - last) & 0x0F <= 1:
+                continue
+            offset = index * TS_PACKET_SIZE
+            # Signalled discontinuity in the adaptation field
+            if flags & 0x20 and payload[offset + 4] and payload[offset + 5] & 0x80:
+                continue
+            self.cc_errors += 1
+
+
+_TS_HEADER_STRUCTS = {}
+
+
+def _ts_headers(count):
+    """
+    Returns a struct unpacking (PID word, flags byte) of each of count TS packets in one call.
+    """
+    if count not in _TS_HEADER_STRUCTS:
+        gap = f"{TS_PACKET_SIZE - 4}x"
+        _TS_HEADER_STRUCTS[count] = struct.Struct(">" + gap.join(["xHB"] * count))
+    return _TS_HEADER_STRUCTS[count]
+
+
+class StatsPublisher:
+    """
+    Writes the metrics of one tunnel into a shared-memory block.
+
+    :param path: Path of the block, e.g. stats_path(name)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, STATS_SIZE)
+            self.block = mmap.mmap(fd, STATS_SIZE)
+        finally:
+            os.close(fd)
+        _HEADER.pack_into(self.block, 0, STATS_MAGIC, STATS_VERSION)
+        self.seq = 0
+        self.last_time = time.monotonic()
+        self.last_bytes = 0
+        self.bitrate = 0.0
+
+    def publish(self, metrics, dropped=0):
+        """
+        :param metrics: TunnelMetrics of the tunnel
+        :param dropped: Payloads lost in the hand-off to ffmpeg
+        """
+        now = time.monotonic()
+        if now > self.last_time:
+            self.bitrate = (metrics.bytes - self.last_bytes) * 8 / (now - self.last_time)
+        self.last_time = now
+        self.last_bytes = metrics.bytes
+
+        self.seq += 1
+        _SEQ.pack_into(self.block, _SEQ_OFFSET, self.seq)
+        _BODY.pack_into(
+            self.block, _BODY_OFFSET,
+            os.getpid(), metrics.started, time.time(), metrics.packets, metrics.bytes, self.bitrate,
+            metrics.gaps, metrics.max_gap, metrics.ts_packets, metrics.cc_errors, dropped, metrics.control_messages,
+            metrics.socket_bound, metrics.advertisement, metrics.first_data,
+        )
+        self.seq += 1
+        _SEQ.pack_into(self.block, _SEQ_OFFSET, self.seq)
+
+    def close(self, unlink=True):
+        self.block.close()
+        if unlink:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class LatencyHistogram:
+    """
+    Counts of latencies in LATENCY_BUCKETS, with their number and sum.
+    """
+
+    def __init__(self, counts=None, total=0.0, buckets=LATENCY_BUCKETS):
+        """
+        :param counts: Counts per bucket to start from, the unbounded one last
+        :param total: Sum of the latencies counted, in seconds
+        """
+        self.buckets = buckets
+        self.counts = list(counts) if counts is not None else [0] * (len(buckets) + 1)
+        self.total = total
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def bucket(self, seconds):
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                return index
+        return len(self.buckets)
+
+    def observe(self, seconds):
+        self.counts[self.bucket(seconds)] += 1
+        self.total += seconds
+
+    def quantile(self, fraction):
+        """
+        Estimates a quantile by linear interpolation in its bucket (the unbounded bucket is
+        reported at its lower bound).
+
+        :return: Seconds, or None if the histogram is empty
+        """
+        count = self.count
+        if not count:
+            return None
+        rank = fraction * count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                if index == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def summary(self):
+        """
+        :return: {"count", "mean", "p50", "p95", "p99", "buckets": {upper bound: count}}, times in seconds
+        """
+        count = self.count
+        quantiles = {f"p{round(q * 100)}": self.quantile(q) for q in (0.5, 0.95, 0.99)}
+        return {
+            "count": count,
+            "mean": self.total / count if count else None,
+            **{name: round(value, 4) if value is not None else None for name, value in quantiles.items()},
+            "buckets": dict(zip([*(str(bound) for bound in self.buckets), "inf"], self.counts)),
+        }
+
+
+def stats_path(name, stats_dir=STATS_DIR):
+    return os.path.join(stats_dir, f"amt-tunnel-{name}.stats")
+
+
+def read_stats(path, attempts=10):
+    """
+    Reads the record published by a tunnel.
+
+    :param path: Path of the block
+    :param attempts: Reads to try while a write is in progress
+    :return: Dictionary of FIELDS, or None if there is no (valid) block
+    """
+    try:
+        with open(path, "rb") as stats_file:
+            for _ in range(attempts):
+                stats_file.seek(0)
+                data = stats_file.read(_BODY_OFFSET + _BODY.size)
+                if len(data) < _BODY_OFFSET + _BODY.size:
+                    return None
+                magic, version = _HEADER.unpack_from(data)
+                if magic != STATS_MAGIC or version != STATS_VERSION:
+                    return None
+                seq = _SEQ.unpack_from(data, _SEQ_OFFSET)[0]
+                if seq == 0:
+                    return None
+                values = _BODY.unpack_from(data, _BODY_OFFSET)
+                stats_file.seek(_SEQ_OFFSET)
+                if not seq & 1 and _SEQ.unpack(stats_file.read(_SEQ.size))[0] == seq:
+                    return dict(zip(FIELDS, values))
+    except OSError:
+        return None
+    return None
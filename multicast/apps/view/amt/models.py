@@ -1,14 +1,22 @@
-from scapy.all import (
+"""
+Scapy definitions of the AMT messages (RFC 7450).
+
+These are only needed to inspect or synthesize control traffic; the tunnel itself uses the
+struct-based codecs in datapath.py and messages.py and never imports this module. Only the
+scapy modules used here are imported (not scapy.all, which loads every layer), so importing
+this module stays cheap when it is needed.
+"""
+from scapy.contrib.igmpv3 import IGMPv3
+from scapy.fields import (
     BitField,
     IPField,
     MACField,
-    Packet,
     PacketListField,
     ShortField,
     XStrFixedLenField
 )
-from scapy.contrib.igmpv3 import IGMPv3
 from scapy.layers.inet import IP
+from scapy.packet import Packet
 
 from constants import (
     AMT_MEM_QUERY,
@@ -0,0 +1,255 @@
+"""
+Registry of the known AMT relays with a health score for each relay address.
+
+Every relay address keeps an EWMA of its Discovery → Advertisement round-trip time and of its
+success rate. Addresses are ranked by the expected time to get an answer, where every expected
+failure costs a timeout, so tunnels try the fastest live relay first instead of waiting out a
+dead one.
+
+The scores live in a small JSON file shared by the prober and the tunnels. Run the prober from
+this directory (once, or every --interval seconds):
+
+    python3 relays.py --state /tmp/amt-relays.json --interval 30 amt-relay.example.net
+
+Host names are resolved at most once every RESOLVE_TTL seconds; the last good resolution is kept
+when DNS fails.
+"""
+import argparse
+import ipaddress
+import json
+import logging
+import os
+import secrets
+import select
+import socket
+import time
+
+from constants import AMT_RELAY_ADV, AMT_RELAY_PORT, DEFAULT_RELAY, DEFAULT_RELAY_IPS, KNOWN_RELAYS
+from messages import discovery_template
+
+logger = logging.getLogger("amt.relays")
+
+DEFAULT_STATE_PATH = "/tmp/amt-relays.json"
+PROBE_TIMEOUT = 2.0
+RESOLVE_TTL = 300
+# Weight of the newest sample in the moving averages
+EWMA_ALPHA = 0.3
+# Assumed success rate of an address that was never probed
+UNKNOWN_SUCCESS = 0.5
+
+
+class RelayHealth:
+    """
+    Moving averages of one relay address.
+    """
+
+    def __init__(self, address, rtt=None, success=UNKNOWN_SUCCESS, probes=0, failures=0, last_probe=0.0):
+        self.address = address
+        self.rtt = rtt
+        self.success = success
+        self.probes = probes
+        self.failures = failures
+        self.last_probe = last_probe
+
+    def record(self, rtt):
+        """
+        :param rtt: Round-trip time in seconds, or None if the relay did not answer
+        """
+        self.probes += 1
+        self.last_probe = time.time()
+        if rtt is None:
+            self.failures += 1
+            self.success *= 1 - EWMA_ALPHA
+            return
+        self.success = self.success * (1 - EWMA_ALPHA) + EWMA_ALPHA
+        self.rtt = rtt if self.rtt is None else self.rtt * (1 - EWMA_ALPHA) + rtt * EWMA_ALPHA
+
+    def score(self):
+        """
+        Expected seconds until this address answers, counting a timeout for every expected
+        failure; lower is better.
+        """
+        rtt = self.rtt if self.rtt is not None else PROBE_TIMEOUT
+        success = max(self.success, 0.01)
+        return rtt + (1 - success) / success * PROBE_TIMEOUT
+
+    def to_dict(self):
+        return {
+            "rtt": self.rtt,
+            "success": self.success,
+            "probes": self.probes,
+            "failures": self.failures,
+            "last_probe": self.last_probe,
+        }
+
+
+class RelayRegistry:
+    """
+    Health scores and cached resolutions of the relays, persisted in a JSON file.
+
+    :param state_path: Path of the state file, or None to keep the registry in memory only
+    """
+
+    def __init__(self, state_path=None):
+        self.state_path = state_path
+        self.health = {}
+        self.resolved = {}
+        self.state_mtime = None
+        self.load()
+
+    def load(self):
+        """
+        Reads the state file if it changed since it was last read.
+        """
+        if self.state_path is None:
+            return
+        try:
+            mtime = os.stat(self.state_path).st_mtime
+            if mtime == self.state_mtime:
+                return
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            return
+        self.state_mtime = mtime
+        self.health = {
+            address: RelayHealth(address, **values) for address, values in state.get("health", {}).items()
+        }
+        self.resolved.update({relay: tuple(entry) for relay, entry in state.get("resolved", {}).items()})
+
+    def save(self):
+        if self.state_path is None:
+            return
+        state = {
+            "health": {address: health.to_dict() for address, health in self.health.items()},
+            "resolved": self.resolved,
+        }
+        # Write and rename, so that readers never see a partial file
+        temp_path = f"{self.state_path}.{os.getpid()}"
+        with open(temp_path, "w") as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_path, self.state_path)
+        self.state_mtime = os.stat(self.state_path).st_mtime
+
+    def resolve(self, relay):
+        """
+        Returns the IPv4 addresses of a relay, using the cached resolution while it is fresh.
+        """
+        if relay == DEFAULT_RELAY:
+            return list(DEFAULT_RELAY_IPS)
+        try:
+            ipaddress.IPv4Address(relay)
+            return [relay]
+        except ValueError:
+            pass
+
+        resolved_at, addresses = self.resolved.get(relay, (0.0, []))
+        if time.time() - resolved_at < RESOLVE_TTL and addresses:
+            return list(addresses)
+        try:
+            infos = socket.getaddrinfo(relay, AMT_RELAY_PORT, socket.AF_INET, socket.SOCK_DGRAM)
+        except socket.gaierror as e:
+            logger.warning(f"Cannot resolve relay {relay}: {e}")
+            return list(addresses)
+        addresses = sorted({info[4][0] for info in infos})
+        self.resolved[relay] = (time.time(), addresses)
+        return addresses
+
+    def get(self, address):
+        if address not in self.health:
+            self.health[address] = RelayHealth(address)
+        return self.health[address]
+
+    def record(self, address, rtt):
+        self.get(address).record(rtt)
+
+    def update(self, address, rtt):
+        """
+        Records one handshake result and writes it to the state file at once, for processes that
+        share the file with the prober.
+        """
+        self.load()
+        self.record(address, rtt)
+        try:
+            self.save()
+        except OSError as e:
+            logger.warning(f"Cannot write relay state {self.state_path}: {e}")
+
+    def candidates(self, relay):
+        """
+        Returns the addresses of a relay, healthiest first.
+        """
+        self.load()
+        return sorted(self.resolve(relay), key=lambda address: self.get(address).score())
+
+    def probe(self, addresses, timeout=PROBE_TIMEOUT):
+        """
+        Sends one AMT Relay Discovery to every address at once and waits for the Advertisements.
+
+        :return: Dictionary of address -> round-trip time in seconds, or None if it did not answer
+        """
+        template = discovery_template()
+        results = dict.fromkeys(addresses)
+        nonces = {}
+        sent_at = {}
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as sock:
+            sock.setblocking(False)
+            for address in addresses:
+                nonces[address] = secrets.token_bytes(4)
+                sent_at[address] = time.perf_counter()
+                try:
+                    sock.sendto(template.render(nonces[address]), (address, AMT_RELAY_PORT))
+                except OSError as e:
+                    logger.warning(f"Cannot probe relay {address}: {e}")
+
+            deadline = time.perf_counter() + timeout
+            pending = set(addresses)
+            while pending:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+                    break
+                try:
+                    data, (address, _) = sock.recvfrom(64)
+                except OSError:
+                    continue
+                if address in pending and len(data) >= 8 and data[0] == AMT_RELAY_ADV and data[4:8] == nonces[address]:
+                    results[address] = time.perf_counter() - sent_at[address]
+                    pending.discard(address)
+        return results
+
+    def probe_all(self, relays=(), timeout=PROBE_TIMEOUT):
+        """
+        Probes the known relays and the given ones, records the results and saves the state.
+        """
+        self.load()
+        addresses = sorted({address for relay in (*KNOWN_RELAYS, *relays) for address in self.resolve(relay)})
+        results = self.probe(addresses, timeout)
+        for address, rtt in results.items():
+            self.record(address, rtt)
+        self.save()
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Probe the AMT relays and keep their health scores")
+    parser.add_argument("relays", nargs="*", help="Relays to probe in addition to the known ones")
+    parser.add_argument("--state", default=DEFAULT_STATE_PATH, help="Path of the shared state file")
+    parser.add_argument("--interval", type=float, help="Probe every INTERVAL seconds instead of once")
+    parser.add_argument("--timeout", type=float, default=PROBE_TIMEOUT, help="Seconds to wait for answers")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - relays - %(levelname)s - %(message)s")
+    registry = RelayRegistry(args.state)
+    while True:
+        registry.probe_all(args.relays, args.timeout)
+        for address in sorted(registry.health, key=lambda address: registry.health[address].score()):
+            health = registry.health[address]
+            rtt = f"{health.rtt * 1000:.1f} ms" if health.rtt is not None else "-"
+            logger.info(f"{address:16} rtt {rtt:>10}  success {health.success:.2f}  probes {health.probes}")
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
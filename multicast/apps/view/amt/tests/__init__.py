@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The amt modules are scripts that import their siblings by name
+AMT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if AMT_DIR not in sys.path:
+    sys.path.insert(0, AMT_DIR)
@@ -0,0 +1,75 @@
+import unittest
+
+from constants import AMT_MULT_DATA
+from datapath import (
+    AMT_DATA_HDR_LEN,
+    encode_multicast_data,
+    message_type,
+    udp_flow,
+    udp_payload,
+    udp_payload_bounds,
+)
+
+SOURCE = "162.250.138.201"
+GROUP = "232.162.250.140"
+
+
+class UdpPayloadBoundsTest(unittest.TestCase):
+    def test_locates_payload(self):
+        data = encode_multicast_data(SOURCE, GROUP, b"\x47" * 188, dport=5001)
+        start, end = udp_payload_bounds(data, len(data))
+        self.assertEqual((start, end), (AMT_DATA_HDR_LEN + 28, len(data)))
+        self.assertEqual(bytes(udp_payload(memoryview(data), len(data))), b"\x47" * 188)
+
+    def test_ignores_trailing_bytes(self):
+        data = encode_multicast_data(SOURCE, GROUP, b"payload") + b"padding"
+        start, end = udp_payload_bounds(data, len(data))
+        self.assertEqual(data[start:end], b"payload")
+
+    def test_rejects_other_messages(self):
+        data = bytearray(encode_multicast_data(SOURCE, GROUP, b"payload"))
+        data[0] = AMT_MULT_DATA + 1
+        self.assertIsNone(udp_payload_bounds(data, len(data)))
+
+    def test_ignores_the_high_nibble_of_the_type(self):
+        data = bytearray(encode_multicast_data(SOURCE, GROUP, b"payload"))
+        # Version and reserved bits set by the relay
+        data[0] |= 0xF0
+        start, end = udp_payload_bounds(data, len(data))
+        self.assertEqual(data[start:end], b"payload")
+
+    def test_rejects_short_messages(self):
+        data = encode_multicast_data(SOURCE, GROUP, b"payload")
+        self.assertIsNone(udp_payload_bounds(data, 20))
+        # The UDP length claims more than was received
+        self.assertIsNone(udp_payload_bounds(data, len(data) - 1))
+
+    def test_rejects_fragments_and_other_protocols(self):
+        data = bytearray(encode_multicast_data(SOURCE, GROUP, b"payload"))
+        data[AMT_DATA_HDR_LEN + 6] = 0x20  # More fragments
+        self.assertIsNone(udp_payload_bounds(data, len(data)))
+        data = bytearray(encode_multicast_data(SOURCE, GROUP, b"payload"))
+        data[AMT_DATA_HDR_LEN + 9] = 6  # TCP
+        self.assertIsNone(udp_payload_bounds(data, len(data)))
+
+    def test_honours_ip_options(self):
+        data = bytearray(encode_multicast_data(SOURCE, GROUP, b"payload"))
+        ip_header = data[AMT_DATA_HDR_LEN:AMT_DATA_HDR_LEN + 20]
+        ip_header[0] = 0x46
+        data[AMT_DATA_HDR_LEN:AMT_DATA_HDR_LEN + 20] = ip_header + bytes(4)
+        start, end = udp_payload_bounds(data, len(data))
+        self.assertEqual(bytes(data[start:end]), b"payload")
+
+
+class UdpFlowTest(unittest.TestCase):
+    def test_flow(self):
+        data = encode_multicast_data(SOURCE, GROUP, b"payload", dport=5002)
+        addresses, dport, start, end = udp_flow(memoryview(data), len(data))
+        self.assertEqual(addresses, bytes([162, 250, 138, 201, 232, 162, 250, 140]))
+        self.assertEqual(dport, 5002)
+        self.assertEqual(data[start:end], b"payload")
+        self.assertEqual(message_type(data), AMT_MULT_DATA)
+
+
+if __name__ == "__main__":
+    unittest.main()
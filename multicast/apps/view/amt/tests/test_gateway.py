@@ -0,0 +1,85 @@
+import unittest
+
+from datapath import encode_multicast_data
+from gateway import RelayProtocol, RelaySession, Subscription
+from messages import BLOCK_OLD_SOURCES, CHANGE_TO_INCLUDE_MODE, MODE_IS_INCLUDE, parse_membership_update
+
+
+class RecordingTransport:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append(data)
+
+
+class MembershipRecordsTest(unittest.TestCase):
+    def setUp(self):
+        self.session = RelaySession(None, "relay.example", None)
+        self.session.transport = RecordingTransport()
+        self.session.relay_addr = ("192.0.2.1", 2268)
+        self.session.nonce = b"\x01\x02\x03\x04"
+        self.session.response_mac = b"\x01" * 6
+        channels = [("10.0.0.1", "232.1.1.1"), ("10.0.0.2", "232.1.1.1"), ("10.0.0.3", "232.1.1.2")]
+        for session_id, (source, group) in enumerate(channels, 1):
+            subscription = Subscription(session_id, source, group, None, 5000 + session_id)
+            self.session.subscriptions[session_id] = subscription
+            self.session.flows.setdefault(subscription.flow, []).append(subscription)
+
+    def sent_records(self):
+        return parse_membership_update(self.session.transport.sent[-1]).records
+
+    def test_current_state(self):
+        self.session.send_membership_update()
+        self.assertEqual(self.sent_records(), [
+            ("232.1.1.1", ["10.0.0.1", "10.0.0.2"], MODE_IS_INCLUDE),
+            ("232.1.1.2", ["10.0.0.3"], MODE_IS_INCLUDE),
+        ])
+
+    def test_leaving_one_source_blocks_it(self):
+        self.session.remove(2)
+        self.assertEqual(self.sent_records(), [
+            ("232.1.1.1", ["10.0.0.1"], MODE_IS_INCLUDE),
+            ("232.1.1.2", ["10.0.0.3"], MODE_IS_INCLUDE),
+            ("232.1.1.1", ["10.0.0.2"], BLOCK_OLD_SOURCES),
+        ])
+
+    def test_leaving_a_group(self):
+        self.session.remove(3)
+        self.assertEqual(self.sent_records(), [
+            ("232.1.1.1", ["10.0.0.1", "10.0.0.2"], MODE_IS_INCLUDE),
+            ("232.1.1.2", [], CHANGE_TO_INCLUDE_MODE),
+        ])
+
+    def test_source_still_subscribed_is_not_blocked(self):
+        subscription = Subscription(4, "10.0.0.1", "232.1.1.1", 6000, 5004)
+        self.session.subscriptions[4] = subscription
+        self.session.flows.setdefault(subscription.flow, []).append(subscription)
+        self.session.remove(4)
+        self.assertNotIn(BLOCK_OLD_SOURCES, [record[2] for record in self.sent_records()])
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+class RecordingSession:
+    def __init__(self):
+        self.forwarded = []
+
+    def forward(self, data):
+        self.forwarded.append(data)
+
+
+class RelayProtocolTest(unittest.TestCase):
+    def test_empty_datagram(self):
+        protocol = RelayProtocol(RecordingSession())
+        protocol.datagram_received(b"", ("192.0.2.1", 2268))
+        self.assertEqual(protocol.session.forwarded, [])
+
+    def test_data_with_high_bits_set(self):
+        protocol = RelayProtocol(RecordingSession())
+        data = bytearray(encode_multicast_data("10.0.0.1", "232.1.1.1", b"payload"))
+        data[0] |= 0xF0
+        protocol.datagram_received(bytes(data), ("192.0.2.1", 2268))
+        self.assertEqual(protocol.session.forwarded, [bytes(data)])
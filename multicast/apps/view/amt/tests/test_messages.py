@@ -0,0 +1,85 @@
+import socket
+import unittest
+
+from constants import AMT_MEM_QUERY, AMT_MEM_UPD, AMT_RELAY_DISCO, AMT_REQUEST, MCAST_ALLHOSTS, MCAST_ANYCAST
+from messages import (
+    CHANGE_TO_INCLUDE_MODE,
+    MODE_IS_INCLUDE,
+    checksum,
+    decode_qqic,
+    discovery_template,
+    encode_membership_query,
+    igmpv3_report,
+    membership_update_template,
+    parse_membership_query,
+    parse_membership_update,
+    request_template,
+)
+
+NONCE = b"\x01\x02\x03\x04"
+MAC = b"\xaa\xbb\xcc\xdd\xee\xff"
+
+
+class TemplateTest(unittest.TestCase):
+    def test_discovery_and_request(self):
+        self.assertEqual(bytes(discovery_template().render(NONCE)), bytes((AMT_RELAY_DISCO, 0, 0, 0)) + NONCE)
+        self.assertEqual(bytes(request_template().render(NONCE)), bytes((AMT_REQUEST, 0, 0, 0)) + NONCE)
+
+    def test_render_patches_in_place(self):
+        template = membership_update_template([("232.1.1.1", ["10.0.0.1"])])
+        first = template.render(NONCE, MAC)
+        second = template.render(b"\x00" * 4, MAC)
+        self.assertIs(first, second)
+        self.assertEqual(bytes(second[8:12]), b"\x00" * 4)
+
+    def test_membership_update_round_trip(self):
+        records = [("232.1.1.1", ["10.0.0.1", "10.0.0.2"]), ("232.1.1.2", [], CHANGE_TO_INCLUDE_MODE)]
+        data = bytes(membership_update_template(records).render(NONCE, MAC))
+        self.assertEqual(data[0], AMT_MEM_UPD)
+        # Valid IPv4 header checksum, with the router alert padding option
+        ip_header = data[12:36]
+        self.assertEqual(checksum(ip_header), 0)
+        self.assertEqual(ip_header[12:20], socket.inet_aton(MCAST_ANYCAST) + socket.inet_aton(MCAST_ALLHOSTS))
+
+        update = parse_membership_update(data)
+        self.assertEqual(update.response_mac, MAC)
+        self.assertEqual(update.nonce, NONCE)
+        self.assertEqual(update.records, [
+            ("232.1.1.1", ["10.0.0.1", "10.0.0.2"], MODE_IS_INCLUDE),
+            ("232.1.1.2", [], CHANGE_TO_INCLUDE_MODE),
+        ])
+
+    def test_report_checksum(self):
+        self.assertEqual(checksum(igmpv3_report([("232.1.1.1", ["10.0.0.1"])])), 0)
+
+    def test_parse_rejects_other_messages(self):
+        self.assertIsNone(parse_membership_update(bytes(discovery_template().render(NONCE))))
+        self.assertIsNone(parse_membership_query(bytes(request_template().render(NONCE))))
+
+
+class MembershipQueryTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = encode_membership_query(NONCE, MAC, "192.0.2.1", qrv=3, qqic=60)
+        self.assertEqual(data[0], AMT_MEM_QUERY)
+        query = parse_membership_query(data)
+        self.assertEqual((query.response_mac, query.nonce, query.qrv, query.qqic, query.query_interval), (MAC, NONCE, 3, 60, 60))
+
+    def test_without_igmp_query(self):
+        query = parse_membership_query(bytes((AMT_MEM_QUERY, 0)) + MAC + NONCE)
+        self.assertEqual((query.qrv, query.qqic, query.query_interval), (0, 0, 0))
+
+
+class DecodeQqicTest(unittest.TestCase):
+    def test_linear_below_128(self):
+        self.assertEqual(decode_qqic(0), 0)
+        self.assertEqual(decode_qqic(125), 125)
+
+    def test_floating_point(self):
+        # RFC 3376, section 4.1.7: (mant | 0x10) << (exp + 3)
+        self.assertEqual(decode_qqic(0x80), 128)
+        self.assertEqual(decode_qqic(0x8F), 31 << 3)
+        self.assertEqual(decode_qqic(0xFF), 31 << 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
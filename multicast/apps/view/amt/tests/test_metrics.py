@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+
+from metrics import TS_NULL_PID, TS_PACKET_SIZE, StatsPublisher, TunnelMetrics, read_stats
+
+
+def ts_packet(pid, cc, payload=True, discontinuity=False):
+    flags = (0x10 if payload else 0) | cc
+    if discontinuity:
+        # Adaptation field of one byte with the discontinuity indicator set
+        return bytes((0x47, pid >> 8, pid & 0xFF, flags | 0x20, 1, 0x80)) + bytes(TS_PACKET_SIZE - 6)
+    return bytes((0x47, pid >> 8, pid & 0xFF, flags)) + bytes(TS_PACKET_SIZE - 4)
+
+
+class ContinuityTest(unittest.TestCase):
+    def observe(self, *packets):
+        metrics = TunnelMetrics()
+        metrics.observe(b"".join(packets), 0.0)
+        return metrics
+
+    def test_in_order(self):
+        metrics = self.observe(*(ts_packet(0x100, cc % 16) for cc in range(20)))
+        self.assertEqual((metrics.ts_packets, metrics.cc_errors), (20, 0))
+
+    def test_gap_is_an_error(self):
+        self.assertEqual(self.observe(ts_packet(0x100, 1), ts_packet(0x100, 3)).cc_errors, 1)
+
+    def test_counters_are_per_pid(self):
+        metrics = self.observe(ts_packet(0x100, 1), ts_packet(0x101, 7), ts_packet(0x100, 2), ts_packet(0x101, 8))
+        self.assertEqual(metrics.cc_errors, 0)
+
+    def test_legal_exceptions(self):
+        metrics = self.observe(
+            ts_packet(0x100, 1),
+            # Duplicate packet
+            ts_packet(0x100, 1),
+            # Packet without payload keeps the counter
+            ts_packet(0x100, 9, payload=False),
+            ts_packet(0x100, 2),
+            # Signalled discontinuity
+            ts_packet(0x100, 9, discontinuity=True),
+            ts_packet(TS_NULL_PID, 5),
+        )
+        self.assertEqual(metrics.cc_errors, 0)
+
+    def test_counts_across_payloads(self):
+        metrics = TunnelMetrics()
+        metrics.observe(ts_packet(0x100, 14) + ts_packet(0x100, 15), 0.0)
+        metrics.observe(ts_packet(0x100, 0) + ts_packet(0x100, 2), 0.01)
+        self.assertEqual((metrics.packets, metrics.ts_packets, metrics.cc_errors), (2, 4, 1))
+
+    def test_ignores_other_payloads(self):
+        metrics = self.observe(b"\x00" * TS_PACKET_SIZE * 2)
+        self.assertEqual((metrics.packets, metrics.ts_packets), (1, 0))
+
+    def test_gaps(self):
+        metrics = TunnelMetrics(gap_threshold=0.1)
+        for now in (0.0, 0.05, 0.5, 0.55, 1.5):
+            metrics.observe(ts_packet(0x100, 0, payload=False), now)
+        self.assertEqual(metrics.gaps, 2)
+        self.assertAlmostEqual(metrics.max_gap, 0.95)
+
+
+class StatsBlockTest(unittest.TestCase):
+    def test_round_trip(self):
+        path = os.path.join(tempfile.mkdtemp(), "stats")
+        publisher = StatsPublisher(path)
+        self.assertIsNone(read_stats(path))
+        metrics = TunnelMetrics()
+        metrics.observe(ts_packet(0x100, 0) + ts_packet(0x100, 5), 0.0)
+        publisher.publish(metrics, dropped=3)
+        stats = read_stats(path)
+        self.assertEqual((stats["pid"], stats["packets"], stats["bytes"]), (os.getpid(), 1, 2 * TS_PACKET_SIZE))
+        self.assertEqual((stats["ts_packets"], stats["cc_errors"], stats["dropped"]), (2, 1, 3))
+        publisher.close()
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(read_stats(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import fcntl
+import os
+import unittest
+
+from transport import F_SETPIPE_SZ, StreamSink
+
+DATAGRAM = 1000
+
+
+class PipeSink(StreamSink):
+    """
+    Stream sink writing into a pipe of one page, so that writes are cut short.
+    """
+
+    name = "pipe"
+
+    def __init__(self, buffer_size):
+        super().__init__(buffer_size)
+        self.read_fd, self.fd = os.pipe()
+        os.set_blocking(self.fd, False)
+        fcntl.fcntl(self.fd, F_SETPIPE_SZ, 4096)
+
+    def read(self):
+        return os.read(self.read_fd, 1 << 20)
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.fd)
+
+
+def datagrams(first, count):
+    return [bytes([index]) * DATAGRAM for index in range(first, first + count)]
+
+
+class StreamSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.sink = PipeSink(buffer_size=64 * 1024)
+        self.addCleanup(self.sink.close)
+
+    def test_partial_datagram_is_completed_first(self):
+        self.sink.write_batch(datagrams(0, 10))
+        self.assertTrue(self.sink.partial)
+        received = self.sink.read()
+        self.sink.write_batch(datagrams(10, 2))
+        while self.sink.pending:
+            received += self.sink.read()
+            self.sink.write_batch([])
+        received += self.sink.read()
+        self.assertEqual(received, b"".join(datagrams(0, 12)))
+        self.assertFalse(self.sink.partial)
+
+    def test_disconnect_drops_partial_datagram(self):
+        self.sink.write_batch(datagrams(0, 10))
+        taken = len(self.sink.read())
+        self.sink.disconnect()
+        self.assertFalse(self.sink.partial)
+        # The next reader starts on a datagram boundary
+        self.sink.write_batch([])
+        received = self.sink.read()
+        self.assertEqual(received[:DATAGRAM], bytes([taken // DATAGRAM + 1]) * DATAGRAM)
+        self.assertEqual(self.sink.dropped_packets, 1)
+        self.assertEqual(self.sink.dropped_bytes, DATAGRAM - taken % DATAGRAM)
+
+    def test_overflow_keeps_partial_datagram(self):
+        sink = PipeSink(buffer_size=3 * DATAGRAM)
+        self.addCleanup(sink.close)
+        sink.write_batch(datagrams(0, 10))
+        head = sink.pending[0]
+        self.assertTrue(sink.partial)
+        self.assertLess(len(head), DATAGRAM)
+        self.assertLessEqual(sink.pending_bytes, 3 * DATAGRAM)
+        # The oldest whole datagrams were dropped, not the rest of the one being read
+        self.assertEqual(sink.pending[1], datagrams(8, 1)[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
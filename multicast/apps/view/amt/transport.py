@@ -0,0 +1,273 @@
+"""
+Hand-off of forwarded payloads from the tunnel to ffmpeg.
+
+udp   Loopback UDP datagrams to 127.0.0.1:<udp_port> (the original transport). The kernel drops
+      datagrams silently when ffmpeg's socket buffer is full.
+fifo  A named pipe that ffmpeg reads as an MPEG-TS file.
+unix  A unix stream socket the tunnel listens on and ffmpeg connects to (unix:<path>).
+
+The stream transports never block the forwarding loop: when ffmpeg falls behind, payloads are
+kept in a bounded in-process buffer, and only when that overflows are the oldest whole datagrams
+dropped. A datagram the reader took only part of is completed before anything else is written,
+and dropped if the reader goes away in between, so a reader never sees a datagram cut short.
+Every sink counts what it forwarded and what it lost.
+"""
+import collections
+import errno
+import fcntl
+import itertools
+import os
+import socket
+
+from constants import LOCAL_LOOPBACK
+
+TRANSPORTS = ("udp", "fifo", "unix")
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+# Stay well below IOV_MAX when flushing the buffer with writev()
+MAX_IOVECS = 512
+# Linux only; lets the pipe itself absorb about a second of a 8 Mbit/s stream
+F_SETPIPE_SZ = 1031
+PIPE_SIZE = 1024 * 1024
+
+
+class UdpSink:
+    """
+    Forwards each payload as one loopback UDP datagram.
+    """
+
+    name = "udp"
+
+    def __init__(self, udp_port):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.destination = (LOCAL_LOOPBACK, udp_port)
+        self.packets = 0
+        self.bytes = 0
+        self.dropped_packets = 0
+        self.dropped_bytes = 0
+
+    def write(self, payload):
+        try:
+            self.sock.sendto(payload, self.destination)
+        except OSError:
+            self.dropped_packets += 1
+            self.dropped_bytes += len(payload)
+            return
+        self.packets += 1
+        self.bytes += len(payload)
+
+    def write_batch(self, payloads):
+        for payload in payloads:
+            self.write(payload)
+
+    def stats(self):
+        return {
+            "transport": self.name,
+            "packets": self.packets,
+            "bytes": self.bytes,
+            "dropped_packets": self.dropped_packets,
+            "dropped_bytes": self.dropped_bytes,
+            "buffered_bytes": 0,
+        }
+
+    def close(self):
+        self.sock.close()
+
+
+class StreamSink:
+    """
+    Base class of the byte-stream transports: non-blocking writes to a file descriptor with a
+    bounded buffer in front of it.
+    """
+
+    name = None
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.fd = None
+        self.buffer_size = buffer_size
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        # Whether the head of pending is the rest of a datagram the reader took the start of
+        self.partial = False
+        self.packets = 0
+        self.bytes = 0
+        self.dropped_packets = 0
+        self.dropped_bytes = 0
+
+    def connected(self):
+        return self.fd is not None
+
+    def disconnect(self):
+        self._drop_partial()
+
+    def _drop_partial(self):
+        # The next reader would start in the middle of a datagram
+        if self.partial:
+            self._drop(0)
+        self.partial = False
+
+    def _drop(self, index):
+        dropped = self.pending[index]
+        del self.pending[index]
+        self.pending_bytes -= len(dropped)
+        self.dropped_packets += 1
+        self.dropped_bytes += len(dropped)
+
+    def _enqueue(self, payload, partial=False):
+        self.pending.append(bytes(payload))
+        self.pending_bytes += len(payload)
+        self.partial = self.partial or partial
+        # Drop the oldest whole datagrams so the stream stays aligned on TS packets; the rest of a
+        # datagram the reader is in the middle of goes first
+        while self.pending_bytes > self.buffer_size and len(self.pending) > int(self.partial):
+            self._drop(int(self.partial))
+
+    def _flush(self):
+        while self.pending:
+            try:
+                written = os.writev(self.fd, list(itertools.islice(self.pending, MAX_IOVECS)))
+            except BlockingIOError:
+                return False
+            except (BrokenPipeError, ConnectionResetError):
+                self.disconnect()
+                return False
+            self.bytes += written
+            self.pending_bytes -= written
+            while written:
+                head = self.pending[0]
+                if written >= len(head):
+                    self.pending.popleft()
+                    self.packets += 1
+                    self.partial = False
+                    written -= len(head)
+                else:
+                    self.pending[0] = head[written:]
+                    self.partial = True
+                    written = 0
+        return True
+
+    def write(self, payload):
+        self.write_batch((payload,))
+
+    def write_batch(self, payloads):
+        if not self.connected() or (self.pending and not self._flush()):
+            for payload in payloads:
+                self._enqueue(payload)
+            return
+        try:
+            written = os.writev(self.fd, payloads)
+        except BlockingIOError:
+            written = 0
+        except (BrokenPipeError, ConnectionResetError):
+            self.disconnect()
+            written = 0
+        self.bytes += written
+        # Keep whatever the reader could not take yet
+        for payload in payloads:
+            if written >= len(payload):
+                written -= len(payload)
+                self.packets += 1
+                continue
+            # Only the first payload not taken can have been taken in part
+            self._enqueue(payload[written:], partial=written > 0)
+            written = 0
+
+    def stats(self):
+        return {
+            "transport": self.name,
+            "packets": self.packets,
+            "bytes": self.bytes,
+            "dropped_packets": self.dropped_packets,
+            "dropped_bytes": self.dropped_bytes,
+            "buffered_bytes": self.pending_bytes,
+        }
+
+
+class FifoSink(StreamSink):
+    """
+    Writes the payloads into a named pipe. The pipe is opened read-write so that opening never
+    blocks and writes never fail while ffmpeg is not (yet) reading it.
+    """
+
+    name = "fifo"
+
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE):
+        super().__init__(buffer_size)
+        self.path = path
+        try:
+            os.mkfifo(path)
+        except FileExistsError:
+            pass
+        self.fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        try:
+            fcntl.fcntl(self.fd, F_SETPIPE_SZ, PIPE_SIZE)
+        except OSError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class UnixSocketSink(StreamSink):
+    """
+    Listens on a unix stream socket and writes the payloads to the ffmpeg process connected to it.
+    A restarted ffmpeg simply connects again; until then payloads go to the bounded buffer.
+    """
+
+    name = "unix"
+
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE):
+        super().__init__(buffer_size)
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(1)
+        self.listener.setblocking(False)
+        self.client = None
+
+    def connected(self):
+        if self.client is None:
+            try:
+                self.client, _ = self.listener.accept()
+            except BlockingIOError:
+                return False
+            self.client.setblocking(False)
+            self.fd = self.client.fileno()
+        return True
+
+    def disconnect(self):
+        super().disconnect()
+        if self.client is not None:
+            self.client.close()
+        self.client = None
+        self.fd = None
+
+    def close(self):
+        self.disconnect()
+        self.listener.close()
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def open_sink(transport, udp_port, path=None, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+    Creates the sink for the given transport.
+
+    :param transport: One of TRANSPORTS
+    :param udp_port: Local UDP port (udp transport)
+    :param path: Path of the named pipe or unix socket (fifo and unix transports)
+    :param buffer_size: Bound of the in-process buffer of the stream transports, in bytes
+    """
+    if transport == "udp":
+        return UdpSink(udp_port)
+    if path is None:
+        raise ValueError(f"The {transport} transport needs a path")
+    if transport == "fifo":
+        return FifoSink(path, buffer_size)
+    if transport == "unix":
+        return UnixSocketSink(path, buffer_size)
+    raise ValueError(f"Unknown transport {transport!r}")
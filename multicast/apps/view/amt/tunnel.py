@@ -1,23 +1,24 @@
+import argparse
 import socket
 import struct
-import sys
 import logging
-from scapy.all import send, IP, UDP, Packet
-from scapy.contrib.igmpv3 import IGMPv3, IGMPv3gr, IGMPv3mr
 import secrets
-from datetime import datetime
 import time
-import psutil
-import random
-
-from constants import DEFAULT_MTU, LOCAL_LOOPBACK, MCAST_ALLHOSTS, MCAST_ANYCAST
-from models import (
-    AMT_Discovery,
-    AMT_Relay_Request,
-    AMT_Membership_Query,
-    AMT_Membership_Update,
-    AMT_Multicast_Data,
+
+from constants import (
+    AMT_MEM_QUERY,
+    AMT_RELAY_PORT,
+    DEFAULT_MTU,
+    DEFAULT_QUERY_INTERVAL,
+    LOCAL_LOOPBACK,
+    REFRESH_RETRY_INTERVAL,
 )
+from batch import DEFAULT_BATCH_SIZE, BatchForwarder, SingleForwarder, mmsg_supported
+from datapath import message_type
+from transport import TRANSPORTS, open_sink
+from metrics import PUBLISH_INTERVAL, StatsPublisher, TunnelMetrics
+from messages import discovery_template, membership_update_template, parse_membership_query, request_template
+from relays import DEFAULT_STATE_PATH, RelayRegistry
 
 # Set up logging
 logging.basicConfig(
@@ -33,63 +34,114 @@ console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
 logger.addHandler(console_handler)
 
-# Define the default relay and its IP addresses
-DEFAULT_RELAY = "amt-relay.m2icast.net"
-DEFAULT_RELAY_IPS = ["162.250.137.254", "162.250.136.101", "164.113.199.110"]
+# Control messages are packed once; only the nonce (and response MAC) change per send
+DISCOVERY_TEMPLATE = discovery_template()
+REQUEST_TEMPLATE = request_template()
+
+# Seconds to wait for each handshake answer of a relay, and for data once the tunnel is up
+HANDSHAKE_TIMEOUT = 5
+DATA_TIMEOUT = 60
 
 
 def setup_socket(amt_port):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # No SO_REUSEPORT: the port is leased to this tunnel alone (util/port_pool.py), and a second
+    # socket on it would take a share of its packets
     s.bind(("", amt_port))
-    s.settimeout(60)  # Set a timeout for receiving data
+    s.settimeout(DATA_TIMEOUT)  # Set a timeout for receiving data
     return s
 
 
-def send_amt_discovery(ip_layer, udp_layer, nonce):
-    amt_layer = AMT_Discovery()
-    amt_layer.setfieldval("nonce", nonce)
-    discovery_packet = ip_layer / udp_layer / amt_layer
-    send(discovery_packet)
+def send_amt_discovery(s, relay_addr, nonce):
+    s.sendto(DISCOVERY_TEMPLATE.render(nonce), relay_addr)
     logger.info(
-        f"Sent AMT relay discovery to {ip_layer.dst}:2268 with nonce {nonce.hex()}"
+        f"Sent AMT relay discovery to {relay_addr[0]}:{relay_addr[1]} with nonce {nonce.hex()}"
     )
 
 
-def send_amt_request(ip_layer, udp_layer, nonce):
-    amt_layer = AMT_Relay_Request()
-    amt_layer.setfieldval("nonce", nonce)
-    request_packet = ip_layer / udp_layer / amt_layer
-    send(request_packet)
+def send_amt_request(s, relay_addr, nonce):
+    s.sendto(REQUEST_TEMPLATE.render(nonce), relay_addr)
     logger.info(
-        f"Sent AMT relay request to {ip_layer.dst}:2268 with nonce {nonce.hex()}"
+        f"Sent AMT relay request to {relay_addr[0]}:{relay_addr[1]} with nonce {nonce.hex()}"
     )
 
 
-def send_membership_update(ip_layer, udp_layer, nonce, response_mac, multicast, source):
-    amt_layer = AMT_Membership_Update()
-    amt_layer.setfieldval("nonce", nonce)
-    amt_layer.setfieldval("response_mac", response_mac)
-
-    options_pkt = Packet(b"\x00")
-    ip_layer2 = IP(src=MCAST_ANYCAST, dst=MCAST_ALLHOSTS, options=[options_pkt])
-
-    igmp_layer = IGMPv3()
-    igmp_layer.type = 34
-
-    igmp_layer2 = IGMPv3mr(records=[IGMPv3gr(maddr=multicast, srcaddrs=[source])])
-
-    membership_update_packet = (
-        ip_layer / udp_layer / amt_layer / ip_layer2 / igmp_layer / igmp_layer2
-    )
-    send(membership_update_packet)
+def send_membership_update(s, relay_addr, update_template, nonce, response_mac, multicast, source):
+    update = update_template.render(nonce, response_mac)
+    s.sendto(update, relay_addr)
     logger.info(
-        f"Sent AMT multicast membership update to {ip_layer.dst}:2268 for group {multicast} from source {source}"
+        f"Sent AMT multicast membership update to {relay_addr[0]}:{relay_addr[1]} for group {multicast} from source {source}"
     )
+    return update
+
+
+class MembershipSession:
+    """
+    Membership state of an established tunnel (RFC 7450, section 5.2.3.4).
+
+    The relay's Membership Query carries the response MAC to quote in Membership Updates and, in
+    its QQIC, the interval at which the gateway refreshes its membership: a Request, answered by
+    a new Query, answered by an Update with the new response MAC. Queries are picked out of the
+    data path, so a refresh never interrupts the stream.
+    """
+
+    def __init__(self, s, relay_addr, nonce, update_template, multicast, source):
+        self.s = s
+        self.relay_addr = relay_addr
+        self.nonce = nonce
+        self.update_template = update_template
+        self.multicast = multicast
+        self.source = source
+        self.response_mac = None
+        self.update = None
+        self.query_interval = DEFAULT_QUERY_INTERVAL
+        self.next_refresh = 0.0
+        self.refresh_pending = False
+
+    def handle_query(self, membership_query):
+        self.response_mac = membership_query.response_mac
+        self.query_interval = membership_query.query_interval or DEFAULT_QUERY_INTERVAL
+        self.next_refresh = time.monotonic() + self.query_interval
+        self.refresh_pending = False
+        self.update = send_membership_update(
+            self.s, self.relay_addr, self.update_template, self.nonce, self.response_mac, self.multicast, self.source
+        )
+        # Wake up in time for the next refresh even when no data arrives
+        self.s.settimeout(min(DATA_TIMEOUT, self.query_interval))
+
+    def handle_control(self, message):
+        """
+        Handles an AMT message other than Multicast Data received on the tunnel socket.
+
+        :return: True if the message was a Membership Query of this session
+        """
+        if message_type(message) != AMT_MEM_QUERY:
+            return False
+        membership_query = parse_membership_query(message)
+        if membership_query is None or membership_query.nonce != self.nonce:
+            return False
+        logger.info(
+            f"Received AMT multicast membership query with response MAC {membership_query.response_mac.hex()}, "
+            f"query interval {membership_query.query_interval or DEFAULT_QUERY_INTERVAL}s"
+        )
+        self.handle_query(membership_query)
+        return True
+
+    def refresh(self):
+        if self.refresh_pending:
+            logger.warning("The relay did not answer the last membership refresh, retrying")
+        send_amt_request(self.s, self.relay_addr, self.nonce)
+        self.refresh_pending = True
+        self.next_refresh = time.monotonic() + min(self.query_interval, REFRESH_RETRY_INTERVAL)
+
+    def heartbeat(self):
+        self.s.sendto(self.update, self.relay_addr)
 
 
 def monitor_resources():
+    import psutil
+
     cpu_percent = psutil.cpu_percent()
     memory_percent = psutil.virtual_memory().percent
     if cpu_percent > 90 or memory_percent > 90:
@@ -99,105 +151,170 @@ def monitor_resources():
     return cpu_percent, memory_percent
 
 
-def get_relay_ip(relay):
-    if relay == DEFAULT_RELAY:
-        return random.choice(DEFAULT_RELAY_IPS)
-    return relay
+def setup_amt_tunnel(relay, amt_port, multicast, source, registry=None, metrics=None):
+    """
+    Sets up the tunnel with the first address of the relay that completes the handshake, trying
+    the addresses in health order.
+
+    :param metrics: TunnelMetrics to mark the setup stages in
+    """
+    registry = registry or RelayRegistry()
+    candidates = registry.candidates(relay)
+    logger.info(f"Attempting to set up AMT tunnel with relay {relay} via {', '.join(candidates) or 'no address'}")
+    for relay_ip in candidates:
+        result = connect_relay(relay_ip, amt_port, multicast, source, registry, metrics)
+        if result[0]:
+            return result
+        logger.warning(f"Relay address {relay_ip} failed, trying the next one")
+    return False, None, None, None
 
 
-def setup_amt_tunnel(relay, amt_port, multicast, source):
-    logger.info(f"Attempting to set up AMT tunnel with relay {relay}")
+def connect_relay(relay_ip, amt_port, multicast, source, registry, metrics=None):
     s = setup_socket(amt_port)
     logger.info(f"Socket set up on port {amt_port}")
+    if metrics is not None:
+        metrics.mark("socket_bound")
+    # Fail over quickly; the long timeout only applies once data flows
+    s.settimeout(HANDSHAKE_TIMEOUT)
 
-    relay_ip = get_relay_ip(relay)
-    ip_layer = IP(dst=relay_ip)
-    udp_layer = UDP(sport=amt_port, dport=2268)
+    relay_addr = (relay_ip, AMT_RELAY_PORT)
     nonce = secrets.token_bytes(4)
 
-    logger.debug(f"Sending AMT discovery to relay {relay_ip}")
-    send_amt_discovery(ip_layer, udp_layer, nonce)
+    logger.debug(f"Sending AMT discovery to relay {relay_addr[0]}")
+    sent_at = time.perf_counter()
+    send_amt_discovery(s, relay_addr, nonce)
 
     try:
-        data, addr = s.recvfrom(8192)
+        data, addr = s.recvfrom(DEFAULT_MTU)
+        registry.update(relay_ip, time.perf_counter() - sent_at)
         logger.info(f"Received {len(data)} bytes from relay {addr}")
+        if metrics is not None:
+            metrics.mark("advertisement")
     except socket.timeout:
         logger.error("Timeout: Did not receive any response from the relay")
-        return False, None, None, None, None
+        registry.update(relay_ip, None)
+        s.close()
+        return False, None, None, None
     except Exception as e:
         logger.error(f"Failed to receive data from relay: {e}")
-        return False, None, None, None, None
+        registry.update(relay_ip, None)
+        s.close()
+        return False, None, None, None
 
-    logger.debug(f"Sending AMT request to relay {relay_ip}")
-    send_amt_request(ip_layer, udp_layer, nonce)
+    logger.debug(f"Sending AMT request to relay {relay_addr[0]}")
+    send_amt_request(s, relay_addr, nonce)
 
     try:
         data, addr = s.recvfrom(DEFAULT_MTU)
-        membership_query = AMT_Membership_Query(data)
+        membership_query = parse_membership_query(data)
+        if membership_query is None:
+            raise ValueError(f"expected a membership query, got AMT message type {data[0] & 0x0F}")
         response_mac = membership_query.response_mac
         logger.info(
-            f"Received AMT multicast membership query from {addr} with response MAC {response_mac.hex() if isinstance(response_mac, bytes) else response_mac}"
+            f"Received AMT multicast membership query from {addr} with response MAC {response_mac.hex()}"
         )
     except Exception as e:
         logger.error(f"Failed to receive or process membership query: {e}")
-        return False, None, None, None, None
+        registry.update(relay_ip, None)
+        s.close()
+        return False, None, None, None
 
     req = struct.pack("=4sl", socket.inet_aton(multicast), socket.INADDR_ANY)
     s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, req)
 
-    logger.debug(f"Sending membership update to relay {relay_ip}")
-    send_membership_update(ip_layer, udp_layer, nonce, response_mac, multicast, source)
-    return True, s, ip_layer, udp_layer, nonce, response_mac
+    logger.debug(f"Sending membership update to relay {relay_addr[0]}")
+    update_template = membership_update_template([(multicast, [source])])
+    session = MembershipSession(s, relay_addr, nonce, update_template, multicast, source)
+    session.handle_query(membership_query)
+    return True, s, relay_addr, session
 
 
-def main(relay, source, multicast, amt_port, udp_port):
+def main(
+    relay, source, multicast, amt_port, udp_port, io_mode="single", batch_size=DEFAULT_BATCH_SIZE,
+    transport="udp", transport_path=None, relay_state=DEFAULT_STATE_PATH, stats_path=None
+):
     logger.info(f"Starting AMT tunnel - Relay: {relay}, Source: {source}, Multicast: {multicast}, AMT Port: {amt_port}, UDP Port: {udp_port}")
+    if io_mode == "batch":
+        logger.info(
+            f"Batched forwarding with bursts of {batch_size} ({'recvmmsg/sendmmsg' if mmsg_supported() else 'recv_into loop'})"
+        )
 
     packet_count = 0
-    last_packet_time = time.time()
-    local_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    relay_index = 0
+    next_log_count = 1000
+    last_packet_time = time.monotonic()
+    sink = open_sink(transport, udp_port, transport_path)
+    logger.info(f"Forwarding over {transport} to {transport_path or f'{LOCAL_LOOPBACK}:{udp_port}'}")
+    registry = RelayRegistry(relay_state)
+    metrics = TunnelMetrics()
+    publisher = StatsPublisher(stats_path) if stats_path else None
+    next_publish = time.monotonic()
     max_reconnect_attempts = 5
     reconnect_delay = 5
 
+    s = None
+    forwarder = None
+
     while True:
         reconnect_attempts = 0
         while reconnect_attempts < max_reconnect_attempts:
             try:
-                current_relay = DEFAULT_RELAY_IPS[relay_index] if relay == DEFAULT_RELAY else relay
-                success, s, ip_layer, udp_layer, nonce, response_mac = setup_amt_tunnel(current_relay, amt_port, multicast, source)
+                success, s, relay_addr, session = setup_amt_tunnel(relay, amt_port, multicast, source, registry, metrics)
 
                 if not success:
-                    logger.warning(f"Failed to set up AMT tunnel with relay {current_relay}. Trying next relay.")
-                    relay_index = (relay_index + 1) % len(DEFAULT_RELAY_IPS)
+                    logger.warning(f"Failed to set up AMT tunnel with any address of relay {relay}. Retrying.")
                     reconnect_attempts += 1
                     time.sleep(reconnect_delay)
                     continue
 
-                logger.info(f"AMT tunnel established with relay {current_relay}")
+                logger.info(f"AMT tunnel established with relay {relay} via {relay_addr[0]}")
+                if publisher is not None:
+                    # Publish the setup stages before any data arrives
+                    publisher.publish(metrics, sink.dropped_packets)
+                if io_mode == "batch":
+                    forwarder = BatchForwarder(
+                        s, sink, batch_size, on_control=session.handle_control, metrics=metrics
+                    )
+                else:
+                    forwarder = SingleForwarder(s, sink, on_control=session.handle_control, metrics=metrics)
 
                 while True:
                     try:
-                        data, _ = s.recvfrom(DEFAULT_MTU)
-                        amt_packet = AMT_Multicast_Data(data)
-                        raw_udp = bytes(amt_packet[UDP].payload)
-                        local_socket.sendto(raw_udp, (LOCAL_LOOPBACK, udp_port))
-
-                        packet_count += 1
-                        last_packet_time = time.time()
-
-                        if packet_count % 1000 == 0:
-                            logger.info(f"Received and forwarded {packet_count} packets")
+                        forwarded = forwarder.forward_burst()
+                        if not forwarded:
+                            continue
+
+                        packet_count += forwarded
+                        last_packet_time = time.monotonic()
+                        if last_packet_time >= session.next_refresh:
+                            session.refresh()
+                        if publisher is not None and last_packet_time >= next_publish:
+                            publisher.publish(metrics, sink.dropped_packets)
+                            next_publish = last_packet_time + PUBLISH_INTERVAL
+
+                        if packet_count >= next_log_count:
+                            sink_stats = sink.stats()
+                            logger.info(
+                                f"Received and forwarded {packet_count} packets "
+                                f"({sink_stats['dropped_packets']} lost in hand-off, {sink_stats['buffered_bytes']} bytes buffered, "
+                                f"{metrics.gaps} gaps, {metrics.cc_errors} continuity errors, "
+                                f"{forwarder.dropped} non-data messages ignored)"
+                            )
+                            next_log_count += 1000
 
                     except socket.timeout:
-                        if time.time() - last_packet_time > 30:
-                            logger.warning("No data received for 30 seconds, sending heartbeat")
-                            try:
-                                heartbeat_packet = ip_layer / udp_layer / AMT_Membership_Update()
-                                send(heartbeat_packet)
-                            except Exception as e:
-                                logger.error(f"Failed to send heartbeat: {e}")
-                                raise  # Re-raise to trigger reconnection
+                        now = time.monotonic()
+                        if publisher is not None:
+                            publisher.publish(metrics, sink.dropped_packets)
+                            next_publish = now + PUBLISH_INTERVAL
+                        try:
+                            if now >= session.next_refresh:
+                                session.refresh()
+                            elif now - last_packet_time > 30:
+                                logger.warning("No data received for 30 seconds, sending heartbeat")
+                                session.heartbeat()
+                        except Exception as e:
+                            logger.error(f"Failed to refresh membership: {e}")
+                            raise  # Re-raise to trigger reconnection
 
                     except Exception as err:
                         logger.error(f"Error occurred in processing packet: {err}")
@@ -205,6 +322,9 @@ def main(relay, source, multicast, amt_port, udp_port):
 
             except Exception as e:
                 logger.error(f"AMT tunnel error: {e}. Attempting to reconnect.")
+                if forwarder:
+                    forwarder.close()
+                    forwarder = None
                 if s:
                     s.close()
                 reconnect_attempts += 1
@@ -216,17 +336,36 @@ def main(relay, source, multicast, amt_port, udp_port):
     logger.info("Exiting AMT tunnel")
     if s:
         s.close()
-    local_socket.close()
+    sink.close()
+    if publisher is not None:
+        publisher.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="AMT gateway forwarding one (S,G) to a local UDP port")
+    parser.add_argument("relay")
+    parser.add_argument("source")
+    parser.add_argument("multicast")
+    parser.add_argument("amt_port", type=int)
+    parser.add_argument("udp_port", type=int)
+    parser.add_argument(
+        "--io", dest="io_mode", choices=("single", "batch"), default="single",
+        help="Forward one datagram per system call (single) or drain the socket in bursts (batch)"
+    )
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Datagrams per burst in batch mode")
+    parser.add_argument(
+        "--transport", choices=TRANSPORTS, default="udp",
+        help="Hand-off to ffmpeg: loopback UDP, a named pipe or a unix stream socket"
+    )
+    parser.add_argument("--transport-path", help="Path of the named pipe or unix socket")
+    parser.add_argument("--relay-state", default=DEFAULT_STATE_PATH, help="Path of the relay health file")
+    parser.add_argument("--stats-path", help="Shared-memory block to publish the tunnel metrics to")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 6:
-        print(
-            "Usage: python tunnel.py <relay> <source> <multicast> <amt_port> <udp_port>"
-        )
-        sys.exit(1)
-
-    relay, source, multicast = sys.argv[1:4]
-    amt_port, udp_port = map(int, sys.argv[4:6])
-
-    main(relay, source, multicast, amt_port, udp_port)
\ No newline at end of file
+    args = parse_args()
+    main(
+        args.relay, args.source, args.multicast, args.amt_port, args.udp_port, args.io_mode, args.batch_size,
+        args.transport, args.transport_path, args.relay_state, args.stats_path
+    )
\ No newline at end of file
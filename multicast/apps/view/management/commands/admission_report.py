@@ -0,0 +1,29 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from ....settings import NODE_NAME
+from ...util.admission import node_report
+
+
+class Command(BaseCommand):
+    help = "Show the load of a node against its admission budget, and the pipelines waiting for capacity."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--node", default=NODE_NAME, help="Name of the node, this one by default")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        report = node_report(options["node"])
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        load, budget = report["load"], report["budget"]
+        self.stdout.write(f"Node {report['node']} ({load['cores']} cores)")
+        self.stdout.write(f"  pipelines {load['pipelines']} of {budget['pipelines']}")
+        self.stdout.write(f"  CPU       {load['cpu']:.0f}% of {budget['cpu']:.0f}%")
+        self.stdout.write(f"  memory    {load['memory']:.0f}% of {budget['memory']:.0f}%")
+        egress_budget = f"{budget['egress'] / 1e6:.0f} Mbit/s" if budget["egress"] else "no limit"
+        self.stdout.write(f"  egress    {load['egress'] / 1e6:.0f} Mbit/s of {egress_budget}")
+        self.stdout.write(f"Starting: {', '.join(map(str, report['starting'])) or 'none'}")
+        self.stdout.write(f"Queued:   {', '.join(map(str, report['queued'])) or 'none'}")
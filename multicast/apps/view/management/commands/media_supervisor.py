@@ -0,0 +1,17 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from .....settings import MEDIA_SUPERVISOR_SOCKET
+from ...supervisor import Supervisor
+
+
+class Command(BaseCommand):
+    help = "Run the media supervisor, which owns the tunnel and ffmpeg processes of all tunnels."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--socket", default=MEDIA_SUPERVISOR_SOCKET, help="Path of the control socket")
+
+    def handle(self, *args, **options):
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+        Supervisor(options["socket"]).run()
@@ -0,0 +1,42 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from ...util import ttff
+
+
+class Command(BaseCommand):
+    help = "Show the latency histograms of the stages of the time to first frame of streams."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--json", action="store_true", help="Print the histograms as JSON")
+        parser.add_argument("--reset", action="store_true", help="Clear the histograms afterwards")
+        parser.add_argument(
+            "--label", choices=ttff.LABELS, help="Only the streams of the warm pool, or only the others"
+        )
+
+    def handle(self, *args, **options):
+        labels = [options["label"]] if options["label"] else ttff.LABELS
+        summaries = {stage: histogram.summary() for stage, histogram in ttff.histograms(labels).items()}
+        if options["json"]:
+            self.stdout.write(json.dumps(summaries))
+        else:
+            self.stdout.write(f"{'stage':15} {'count':>6} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+            for stage, summary in summaries.items():
+                self.write_row(stage, summary)
+            if not options["label"]:
+                # Viewers of a running pipeline count in the total with no wait
+                self.stdout.write("")
+                for label in ttff.LABELS:
+                    self.write_row(f"{ttff.TOTAL} ({label})", ttff.histograms([label])[ttff.TOTAL].summary())
+        if options["reset"]:
+            ttff.reset()
+
+    def write_row(self, name, summary):
+        if not summary["count"]:
+            self.stdout.write(f"{name:15} {0:>6}")
+            return
+        self.stdout.write(
+            f"{name:15} {summary['count']:>6} "
+            + " ".join(f"{summary[field]:>7.3f}s" for field in ("mean", "p50", "p95", "p99"))
+        )
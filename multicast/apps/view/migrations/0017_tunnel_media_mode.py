@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-17 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('view', '0016_tunnel_amt_gateway_pid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tunnel',
+            name='media_mode',
+            field=models.CharField(blank=True, choices=[('remux', 'Remux'), ('transcode', 'Transcode')], max_length=16),
+        ),
+        migrations.AddField(
+            model_name='tunnel',
+            name='media_mode_reason',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
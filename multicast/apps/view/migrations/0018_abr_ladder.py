@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-17 22:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('view', '0017_tunnel_media_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='abr_ladder',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='stream',
+            name='abr_ladder',
+            field=models.BooleanField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='tunnel',
+            name='media_mode',
+            field=models.CharField(blank=True, choices=[('remux', 'Remux'), ('transcode', 'Transcode'), ('ladder', 'ABR ladder')], max_length=16),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-17 22:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('view', '0018_abr_ladder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tunnel',
+            name='last_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='tunnel',
+            name='pipeline_state',
+            field=models.CharField(choices=[('stopped', 'Stopped'), ('starting', 'Starting'), ('running', 'Running'), ('restarting', 'Restarting'), ('crash_loop', 'Crash loop')], default='stopped', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='tunnel',
+            name='restart_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
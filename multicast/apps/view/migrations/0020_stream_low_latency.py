@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 22:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('view', '0019_tunnel_pipeline_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stream',
+            name='low_latency',
+            field=models.BooleanField(default=False),
+        ),
+    ]
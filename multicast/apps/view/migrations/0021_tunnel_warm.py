@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 22:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('view', '0020_stream_low_latency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tunnel',
+            name='warm',
+            field=models.BooleanField(default=False),
+        ),
+    ]
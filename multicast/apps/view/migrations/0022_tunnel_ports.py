@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-17 22:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('view', '0021_tunnel_warm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tunnel',
+            name='amt_port',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tunnel',
+            name='udp_port',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
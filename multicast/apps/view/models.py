@@ -5,11 +5,14 @@ from django.db.models import F
 from django.utils import timezone
 
 from ...settings import TRENDING_STREAM_USAGE_WEIGHT, TRENDING_STREAM_MAX_SIZE, TRENDING_STREAM_INIT_SCORE
+from .util.port_pool import PortsNotLeased
 
 
 class Category(models.Model):
     name = models.CharField(max_length=255)
     slug = models.SlugField()
+    # Streams of this category are packaged as an adaptive-bitrate ladder (see HLS_LADDER)
+    abr_ladder = models.BooleanField(default=False)
 
     class Meta:
         ordering = ("name",)
@@ -33,6 +36,10 @@ class Stream(models.Model):
     group = models.GenericIPAddressField(null=True, blank=True)
     source = models.GenericIPAddressField(null=True, blank=True)
     udp_port = models.IntegerField(null=True, blank=True)
+    # Adaptive-bitrate ladder for this stream; unset follows its categories
+    abr_ladder = models.BooleanField(null=True, blank=True)
+    # Low-latency HLS (partial segments, blocking playlist reload), for live events such as lectures
+    low_latency = models.BooleanField(default=False)
 
     # Display
     categories = models.ManyToManyField(Category, blank=True)
@@ -55,6 +62,11 @@ class Stream(models.Model):
     def __str__(self):
         return "{} (Source: {}, Group: {})".format(self.get_description(), self.source, self.group)
 
+    def uses_abr_ladder(self):
+        if self.abr_ladder is not None:
+            return self.abr_ladder
+        return self.categories.filter(abr_ladder=True).exists()
+
     # Returns the owner's description, if set, otherwise returns the most popular user description
     def get_description(self):
         if self.description:
@@ -221,15 +233,49 @@ class Tunnel(models.Model):
     amt_gateway_pid = models.IntegerField(blank=True, null=True)
     ffmpeg_up = models.BooleanField(default=False)
     ffmpeg_pid = models.IntegerField(blank=True, null=True)
+    # Port pair leased from the port pool (util/port_pool.py) while the pipeline runs
+    amt_port = models.IntegerField(blank=True, null=True)
+    udp_port = models.IntegerField(blank=True, null=True)
+    # Kept running without viewers by the warm pool (tasks.warm_pool)
+    warm = models.BooleanField(default=False)
+
+    MEDIA_MODES = (("remux", "Remux"), ("transcode", "Transcode"), ("ladder", "ABR ladder"))
+
+    # How ffmpeg packages the stream, decided from a probe of the input
+    media_mode = models.CharField(max_length=16, choices=MEDIA_MODES, blank=True)
+    media_mode_reason = models.CharField(max_length=255, blank=True)
+
+    PIPELINE_STATES = (
+        ("stopped", "Stopped"),
+        ("starting", "Starting"),
+        ("running", "Running"),
+        ("restarting", "Restarting"),
+        ("crash_loop", "Crash loop"),
+    )
+
+    # Reported by the media supervisor (supervisor.py), which owns the tunnel and ffmpeg processes
+    pipeline_state = models.CharField(max_length=16, choices=PIPELINE_STATES, default="stopped")
+    restart_count = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
     
     def __str__(self):
         return "Tunnel for {}".format(self.stream)
 
     def get_amt_port_number(self):
-        return (self.id % 1000) + 2000
+        """
+        :raises PortsNotLeased: If the tunnel was never leased a port pair
+        """
+        if self.amt_port is None:
+            raise PortsNotLeased(f"Tunnel {self.id} has no AMT port, its pipeline was not started")
+        return self.amt_port
 
     def get_udp_port_number(self):
-        return (self.id % 1000) + 4000
+        """
+        :raises PortsNotLeased: If the tunnel was never leased a port pair
+        """
+        if self.udp_port is None:
+            raise PortsNotLeased(f"Tunnel {self.id} has no UDP port, its pipeline was not started")
+        return self.udp_port
 
     def get_filename(self):
         return "index{}-.m3u8".format(self.id)
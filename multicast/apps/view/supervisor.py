@@ -0,0 +1,698 @@
+"""
+Media supervisor: one long-lived process that owns the tunnel.py and ffmpeg processes of all
+tunnels ("python manage.py media_supervisor").
+
+Celery tasks used to start these processes themselves and then block a worker for the lifetime
+of ffmpeg, polling it every ten seconds and restarting it recursively. The supervisor instead
+watches all of them from one event loop:
+
+- children are reaped as soon as SIGCHLD arrives, not on the next poll
+- ffmpeg's stderr is read as it is written (an unread pipe eventually stalls ffmpeg), counting
+  input losses and keeping the last lines as the error of a crash
+- a crashed process is restarted after an exponential backoff; one that keeps crashing is
+  given up and reported as a crash loop instead of being restarted forever
+- the state of every pipeline is written to its Tunnel (pipeline_state, restart_count, last_error,
+  the PIDs and up flags), so the views and the reaper only read the database
+- children are terminated when the supervisor exits, even when it is killed (PR_SET_PDEATHSIG),
+  and a starting supervisor stops whatever a previous one left behind
+- the first playlist of a tunnel is announced over Redis pub/sub (util/readiness.py), waking the
+  watch pages waiting for it
+- the HLS files are indexed from inotify events (util/segment_index.py), which tell when a
+  playlist is written and which files to remove when a tunnel stops, and which the views read
+  instead of listing HLS_ROOT
+
+The control socket speaks JSON lines, one reply line per request:
+
+    {"op": "start", "id": 7, "process": "tunnel"}     run tunnel.py for tunnel 7
+    {"op": "start", "id": 7, "process": "ffmpeg"}     probe the input of tunnel 7 and run ffmpeg
+    {"op": "stop", "id": 7, "purge": true}            stop both and remove the HLS files
+    {"op": "list"}
+
+Replies carry "ok": true/false and either the result or an "error" message (see
+util/supervisor_client.py).
+"""
+import collections
+import ctypes
+import glob
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+
+import psutil
+from django.db import DatabaseError, close_old_connections
+from django.db.models import F
+
+from ...settings import (
+    AMT_GATEWAY_SOCKET,
+    MEDIA_PROBE_DURATION,
+    HLS_ROOT,
+    SUPERVISOR_BACKOFF_BASE,
+    SUPERVISOR_BACKOFF_MAX,
+    SUPERVISOR_CRASH_LOOP_RESTARTS,
+    SUPERVISOR_CRASH_LOOP_WINDOW,
+    SUPERVISOR_STABLE_AFTER,
+)
+from .models import Tunnel
+from .util.admission import NodeMonitor
+from .util.ffmpeg import StderrLog
+from .util.pipeline import ffmpeg_plan, needs_probe, tunnel_command, tunnel_log_path, tunnel_probe_command
+from .util.port_pool import PortsNotLeased
+from .util.readiness import publish_ready
+from .util.segment_index import SegmentIndex
+from .util import ttff
+from .util.transcode import parse_probe
+
+logger = logging.getLogger(__name__)
+
+PROCESSES = ("tunnel", "ffmpeg")
+# Seconds a stopped process gets to exit before it is killed
+STOP_TIMEOUT = 5
+# Seconds ffprobe may take beyond its analysis duration
+PROBE_TIMEOUT = 10
+# Seconds between two logs of the input losses of the running ffmpeg processes
+LOSS_LOG_INTERVAL = 60
+TICK = 1.0
+# Seconds between two checks of the playlist while an ffmpeg is starting, which viewers wait for,
+# where there is no inotify to tell when it is written
+STARTING_TICK = 0.1
+# prctl() option of <sys/prctl.h> asking for a signal when the parent process exits
+PR_SET_PDEATHSIG = 1
+# Commands of the children a supervisor may have left behind, as the first two words of their command line
+CHILD_COMMANDS = ("ffmpeg", "ffprobe", "tunnel.py")
+
+
+def backoff(failures, base=SUPERVISOR_BACKOFF_BASE, maximum=SUPERVISOR_BACKOFF_MAX):
+    """
+    Returns the seconds to wait before the restart following the given number of consecutive crashes.
+    """
+    return min(base * 2 ** max(failures - 1, 0), maximum)
+
+
+def die_with_parent(parent_pid):
+    """
+    Runs in a child between fork and exec: has it terminated when the supervisor exits, even if
+    the supervisor is killed, so that no orphan keeps its ports and files.
+
+    :param parent_pid: PID of the supervisor
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    except (OSError, AttributeError):
+        # Not Linux; reset_tunnels() stops the orphans of a previous supervisor
+        return
+    # The supervisor already exited before prctl() took effect
+    if os.getppid() != parent_pid:
+        os._exit(1)
+
+
+def is_child_command(process):
+    try:
+        cmdline = process.cmdline()
+    except psutil.Error:
+        return False
+    return any(os.path.basename(word) in CHILD_COMMANDS for word in cmdline[:2])
+
+
+def describe_exit(returncode):
+    if returncode < 0:
+        try:
+            return f"killed by {signal.Signals(-returncode).name}"
+        except ValueError:
+            return f"killed by signal {-returncode}"
+    return f"exited with status {returncode}"
+
+
+class Service:
+    """
+    One supervised process of a tunnel: its tunnel.py or its ffmpeg (with the ffprobe before it).
+    """
+
+    def __init__(self, tunnel_id, kind):
+        self.tunnel_id = tunnel_id
+        self.kind = kind
+        self.state = "stopped"
+        # Whether the process should be running; crashes of a wanted process are restarted
+        self.wanted = False
+        self.proc = None
+        self.started_at = None
+        self.stop_deadline = None
+        self.purge = False
+        self.restart_at = None
+        self.failures = 0
+        self.crashes = collections.deque()
+        self.stderr = None
+        self.probe = None
+        self.probe_output = None
+        self.probe_deadline = None
+        self.playlist = None
+
+    def running(self):
+        return self.proc is not None or self.probe is not None
+
+    def describe(self):
+        return {
+            "id": self.tunnel_id,
+            "process": self.kind,
+            "state": self.state,
+            "pid": self.proc.pid if self.proc else None,
+            "failures": self.failures,
+            "restart_in": round(max(self.restart_at - time.monotonic(), 0), 1) if self.restart_at else None,
+            "losses": self.stderr.counters if self.stderr else None,
+        }
+
+
+class Supervisor:
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.services = {}
+        self.selector = selectors.DefaultSelector()
+        self.stopping = False
+        self.pid = os.getpid()
+        self.next_loss_log = time.monotonic() + LOSS_LOG_INTERVAL
+        self.index = SegmentIndex()
+        # Reports the load of the node for admission control
+        self.monitor = NodeMonitor()
+
+    # Event loop
+
+    def run(self):
+        self.reset_tunnels()
+        server = self.listen()
+        wakeup_reader, wakeup_writer = socket.socketpair()
+        wakeup_reader.setblocking(False)
+        wakeup_writer.setblocking(False)
+        # SIGCHLD wakes up select() through this socket; the handlers only set flags
+        signal.set_wakeup_fd(wakeup_writer.fileno())
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.signal(signal.SIGTERM, self.request_shutdown)
+        signal.signal(signal.SIGINT, self.request_shutdown)
+        self.selector.register(server, selectors.EVENT_READ, self.accept)
+        self.selector.register(wakeup_reader, selectors.EVENT_READ, self.drain_wakeup)
+        try:
+            self.selector.register(self.index.start(), selectors.EVENT_READ, self.index_events)
+        except OSError as e:
+            logger.warning(f"Not indexing {HLS_ROOT}, checking playlists every {STARTING_TICK} s instead: {e}")
+            self.index = None
+        logger.info(f"Media supervisor listening on {self.socket_path}")
+
+        try:
+            while not self.stopping:
+                for key, _ in self.selector.select(timeout=STARTING_TICK if self.starting() else TICK):
+                    key.data(key.fileobj)
+                self.reap()
+                self.tick()
+        finally:
+            self.shutdown()
+            if self.index is not None:
+                self.index.stop()
+            signal.set_wakeup_fd(-1)
+            server.close()
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+
+    def starting(self):
+        if self.index is not None:
+            return False
+        return any(service.kind == "ffmpeg" and service.state == "starting" for service in self.services.values())
+
+    def listen(self):
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(64)
+        server.setblocking(False)
+        return server
+
+    def request_shutdown(self, signum, frame):
+        self.stopping = True
+
+    def drain_wakeup(self, sock):
+        try:
+            while sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def index_events(self, inotify):
+        for tunnel_id in self.index.handle(inotify):
+            service = self.services.get((tunnel_id, "ffmpeg"))
+            if service is not None and service.state == "starting" and service.proc and service.wanted:
+                self.check_playlist(service)
+
+    def tick(self):
+        now = time.monotonic()
+        if self.index is not None:
+            self.index.heartbeat()
+        # The PIDs of the pipelines, whose CPU use only this host can measure
+        pids = {}
+        for service in self.services.values():
+            if service.proc:
+                pids.setdefault(service.tunnel_id, []).append(service.proc.pid)
+        pipelines = sum(1 for service in self.services.values() if service.kind == "ffmpeg" and service.proc)
+        self.monitor.report(pipelines, pids)
+        for service in list(self.services.values()):
+            if service.stop_deadline is not None and now > service.stop_deadline and service.proc:
+                logger.warning(f"{service.kind} of tunnel {service.tunnel_id} did not stop, killing it")
+                service.proc.kill()
+                service.stop_deadline = None
+            if service.probe is not None and now > service.probe_deadline:
+                logger.warning(f"Probe of tunnel {service.tunnel_id} timed out")
+                service.probe.kill()
+                service.probe_deadline = float("inf")
+            if service.restart_at is not None and now >= service.restart_at:
+                service.restart_at = None
+                self.spawn(service)
+            if service.kind == "ffmpeg" and service.state == "starting" and service.proc and service.wanted:
+                self.check_playlist(service)
+
+        if now >= self.next_loss_log:
+            self.next_loss_log = now + LOSS_LOG_INTERVAL
+            for service in self.services.values():
+                if service.stderr and any(service.stderr.counters.values()):
+                    logger.info(f"FFmpeg of tunnel {service.tunnel_id} input losses: {service.stderr.counters}")
+
+    # Control socket
+
+    def accept(self, server):
+        try:
+            conn, _ = server.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        self.selector.register(conn, selectors.EVENT_READ, self.make_reader())
+
+    def make_reader(self):
+        buffer = bytearray()
+
+        def read(conn):
+            try:
+                data = conn.recv(65536)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b""
+            buffer.extend(data)
+            while b"\n" in buffer:
+                line, _, rest = bytes(buffer).partition(b"\n")
+                buffer[:] = rest
+                reply = self.handle_line(line)
+                try:
+                    conn.setblocking(True)
+                    conn.sendall(json.dumps(reply).encode() + b"\n")
+                    conn.setblocking(False)
+                except OSError:
+                    data = b""
+                    break
+            if not data:
+                self.selector.unregister(conn)
+                conn.close()
+
+        return read
+
+    def handle_line(self, line):
+        try:
+            request = json.loads(line)
+            op = request["op"]
+            if op == "start":
+                result = self.start(int(request["id"]), request["process"])
+            elif op == "stop":
+                result = self.stop(int(request["id"]), bool(request.get("purge", True)))
+            elif op == "list":
+                result = [service.describe() for service in self.services.values()]
+            else:
+                raise ValueError(f"Unknown op {op!r}")
+        except Exception as e:
+            logger.exception(f"Failed to handle request {line[:200]!r}")
+            return {"ok": False, "error": str(e)}
+        return {"ok": True, "result": result}
+
+    # Operations
+
+    def service(self, tunnel_id, kind):
+        if kind not in PROCESSES:
+            raise ValueError(f"Unknown process {kind!r}, expected one of {PROCESSES}")
+        key = (tunnel_id, kind)
+        if key not in self.services:
+            self.services[key] = Service(tunnel_id, kind)
+        return self.services[key]
+
+    def start(self, tunnel_id, kind):
+        service = self.service(tunnel_id, kind)
+        if service.wanted and service.state != "crash_loop":
+            return service.describe()
+        if service.running():
+            # A stop is still in progress; start again once the process exited
+            service.wanted = True
+            service.restart_at = None
+            return service.describe()
+        # An explicit start, e.g. by a new viewer, gives a crash loop another chance
+        service.wanted = True
+        service.failures = 0
+        service.crashes.clear()
+        service.restart_at = None
+        self.spawn(service)
+        return service.describe()
+
+    def stop(self, tunnel_id, purge):
+        stopped = []
+        for kind in PROCESSES:
+            service = self.services.get((tunnel_id, kind))
+            if service is None:
+                continue
+            service.wanted = False
+            service.restart_at = None
+            service.purge = service.purge or purge
+            if service.probe is not None:
+                service.probe.kill()
+            if service.proc is not None:
+                service.proc.terminate()
+                service.stop_deadline = time.monotonic() + STOP_TIMEOUT
+                stopped.append(kind)
+            elif not service.running():
+                self.finish_stop(service)
+        return stopped
+
+    def spawn(self, service):
+        close_old_connections()
+        try:
+            tunnel = Tunnel.objects.select_related("stream").get(id=service.tunnel_id)
+        except Tunnel.DoesNotExist:
+            logger.warning(f"Tunnel {service.tunnel_id} no longer exists")
+            service.wanted = False
+            self.set_state(service, "stopped")
+            return
+
+        service.purge = False
+        service.started_at = time.monotonic()
+        self.set_state(service, "starting")
+        try:
+            if service.kind == "tunnel":
+                self.spawn_tunnel(service, tunnel)
+            elif needs_probe(tunnel):
+                self.spawn_probe(service, tunnel)
+            else:
+                self.spawn_ffmpeg(service, tunnel, None)
+        except PortsNotLeased as e:
+            # Not a crash: restarting it would not lease the ports (start_pipeline does)
+            logger.error(f"Not starting {service.kind} of tunnel {service.tunnel_id}: {e}")
+            service.wanted = False
+            self.set_state(service, "stopped")
+            self.update(service.tunnel_id, last_error=str(e))
+
+    def child_setup(self):
+        die_with_parent(self.pid)
+
+    def spawn_tunnel(self, service, tunnel):
+        log_file_path = tunnel_log_path(tunnel)
+        try:
+            with open(log_file_path, "a") as log_file:
+                service.proc = subprocess.Popen(
+                    tunnel_command(tunnel), stdout=log_file, stderr=subprocess.STDOUT, preexec_fn=self.child_setup
+                )
+        except OSError as e:
+            self.crashed(service, f"Failed to start tunnel.py: {e}")
+            return
+        self.set_state(service, "running")
+        self.update(service.tunnel_id, amt_gateway_pid=service.proc.pid, amt_gateway_up=True)
+        logger.info(f"Started tunnel {service.tunnel_id} with PID {service.proc.pid}, logging to {log_file_path}")
+
+    def spawn_probe(self, service, tunnel):
+        service.probe_output = tempfile.TemporaryFile()
+        try:
+            service.probe = subprocess.Popen(
+                tunnel_probe_command(tunnel), stdout=service.probe_output, stderr=subprocess.DEVNULL,
+                preexec_fn=self.child_setup,
+            )
+        except OSError as e:
+            logger.warning(f"Failed to probe tunnel {service.tunnel_id}: {e}")
+            service.probe_output.close()
+            service.probe_output = None
+            self.spawn_ffmpeg(service, tunnel, None)
+            return
+        service.probe_deadline = time.monotonic() + MEDIA_PROBE_DURATION + PROBE_TIMEOUT
+
+    def probe_finished(self, service):
+        output = service.probe_output
+        service.probe = service.probe_output = None
+        output.seek(0)
+        try:
+            probe = parse_probe(output.read())
+        except ValueError:
+            probe = None
+        finally:
+            output.close()
+        # A failed probe is not a crash: ffmpeg starts with the defaults for an unprobed input
+        if not service.wanted:
+            self.finish_stop(service)
+            return
+        try:
+            tunnel = Tunnel.objects.select_related("stream").get(id=service.tunnel_id)
+        except Tunnel.DoesNotExist:
+            service.wanted = False
+            self.finish_stop(service)
+            return
+        self.spawn_ffmpeg(service, tunnel, probe)
+
+    def spawn_ffmpeg(self, service, tunnel, probe):
+        decision, command, playlist = ffmpeg_plan(tunnel, probe)
+        self.update(service.tunnel_id, media_mode=decision.mode, media_mode_reason=decision.reason)
+        logger.info(f"Tunnel {service.tunnel_id} is packaged by {decision.mode}: {decision.reason}")
+
+        service.playlist = playlist
+        service.started_at = time.monotonic()
+        service.stderr = StderrLog()
+        try:
+            service.proc = subprocess.Popen(
+                command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, preexec_fn=self.child_setup
+            )
+        except OSError as e:
+            self.crashed(service, f"Failed to start FFmpeg: {e}")
+            return
+        ttff.record(service.tunnel_id, "ffmpeg_spawn")
+        os.set_blocking(service.proc.stderr.fileno(), False)
+        self.selector.register(service.proc.stderr, selectors.EVENT_READ, self.make_stderr_reader(service))
+        self.update(service.tunnel_id, ffmpeg_pid=service.proc.pid)
+
+    def make_stderr_reader(self, service):
+        log = service.stderr
+
+        def read(pipe):
+            try:
+                data = os.read(pipe.fileno(), 65536)
+            except BlockingIOError:
+                return
+            log.feed(data)
+            if not data:
+                self.selector.unregister(pipe)
+                pipe.close()
+
+        return read
+
+    def check_playlist(self, service):
+        """
+        Marks ffmpeg up once it wrote its playlist; an older playlist of the same name does not count.
+        """
+        try:
+            age = time.time() - os.path.getmtime(service.playlist)
+        except OSError:
+            return
+        if age < time.monotonic() - service.started_at:
+            self.set_state(service, "running")
+            self.update(service.tunnel_id, ffmpeg_up=True, ffmpeg_pid=service.proc.pid)
+            # Wakes the watch pages waiting for the stream (check_stream_status?wait=1)
+            publish_ready(service.tunnel_id)
+            ttff.record(service.tunnel_id, "playlist")
+            # ffmpeg lists a segment once it is written, so without the index the playlist marks it
+            first_segment_at = self.index.first_segment_at(service.tunnel_id) if self.index is not None else None
+            ttff.record(service.tunnel_id, "first_segment", first_segment_at)
+            ttff.finish(service.tunnel_id)
+            logger.info(f"FFmpeg of tunnel {service.tunnel_id} wrote {service.playlist}")
+
+    # Exits
+
+    def reap(self):
+        for service in list(self.services.values()):
+            if service.probe is not None and service.probe.poll() is not None:
+                self.probe_finished(service)
+            if service.proc is not None and service.proc.poll() is not None:
+                self.exited(service)
+
+    def exited(self, service):
+        proc = service.proc
+        service.proc = None
+        service.stop_deadline = None
+        if proc.stderr is not None and not proc.stderr.closed:
+            # Read what is left before reporting the exit
+            self.selector.get_map()[proc.stderr.fileno()].data(proc.stderr)
+            if not proc.stderr.closed:
+                self.selector.unregister(proc.stderr)
+                proc.stderr.close()
+
+        if not service.wanted:
+            logger.info(f"{service.kind} of tunnel {service.tunnel_id} stopped")
+            self.finish_stop(service)
+            return
+
+        error = f"{service.kind} {describe_exit(proc.returncode)}"
+        if service.stderr is not None and service.stderr.tail:
+            error = f"{error}:\n{service.stderr.output()}"
+        self.crashed(service, error)
+
+    def crashed(self, service, error):
+        now = time.monotonic()
+        if service.started_at is not None and now - service.started_at >= SUPERVISOR_STABLE_AFTER:
+            service.failures = 0
+        service.failures += 1
+        service.crashes.append(now)
+        while service.crashes and now - service.crashes[0] > SUPERVISOR_CRASH_LOOP_WINDOW:
+            service.crashes.popleft()
+        down = {"amt_gateway_up": False, "amt_gateway_pid": None} if service.kind == "tunnel" else {
+            "ffmpeg_up": False, "ffmpeg_pid": None
+        }
+
+        if len(service.crashes) >= SUPERVISOR_CRASH_LOOP_RESTARTS:
+            logger.error(
+                f"{service.kind} of tunnel {service.tunnel_id} crashed {len(service.crashes)} times within "
+                f"{SUPERVISOR_CRASH_LOOP_WINDOW:.0f} seconds, giving up: {error}"
+            )
+            service.wanted = False
+            self.set_state(service, "crash_loop")
+            self.update(service.tunnel_id, last_error=error, **down)
+            return
+
+        delay = backoff(service.failures)
+        logger.warning(f"{error}\nRestarting {service.kind} of tunnel {service.tunnel_id} in {delay:.0f} seconds")
+        service.restart_at = now + delay
+        self.set_state(service, "restarting")
+        self.update(service.tunnel_id, last_error=error, restart_count=F("restart_count") + 1, **down)
+
+    def finish_stop(self, service):
+        if service.running():
+            return
+        if service.kind == "tunnel":
+            self.update(service.tunnel_id, amt_gateway_up=False, amt_gateway_pid=None)
+        else:
+            self.update(service.tunnel_id, ffmpeg_up=False, ffmpeg_pid=None)
+        if service.purge and service.kind == "ffmpeg":
+            self.purge_files(service.tunnel_id)
+            service.purge = False
+        if service.wanted:
+            # Started again while it was stopping
+            self.spawn(service)
+            return
+        self.set_state(service, "stopped")
+        del self.services[(service.tunnel_id, service.kind)]
+
+    def purge_files(self, tunnel_id):
+        if self.index is not None:
+            paths = [os.path.join(HLS_ROOT, name) for name in self.index.files(tunnel_id)]
+        else:
+            try:
+                filename = Tunnel.objects.get(id=tunnel_id).get_filename()
+            except Tunnel.DoesNotExist:
+                return
+            paths = glob.glob(os.path.join(HLS_ROOT, f"{filename}*"))
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # State
+
+    def set_state(self, service, state):
+        service.state = state
+        states = [
+            self.services[(service.tunnel_id, kind)].state
+            for kind in PROCESSES if (service.tunnel_id, kind) in self.services
+        ]
+        for pipeline_state in ("crash_loop", "restarting", "starting", "running"):
+            if pipeline_state in states:
+                break
+        else:
+            pipeline_state = "stopped"
+        self.update(service.tunnel_id, pipeline_state=pipeline_state)
+
+    def update(self, tunnel_id, **fields):
+        try:
+            Tunnel.objects.filter(id=tunnel_id).update(**fields)
+        except DatabaseError as e:
+            logger.error(f"Failed to update tunnel {tunnel_id}: {e}")
+            close_old_connections()
+
+    def reset_tunnels(self):
+        """
+        Stops the processes a previous supervisor left behind, if any outlived it, and marks its
+        pipelines down.
+        """
+        # With the gateway daemon, amt_gateway_pid is the daemon's and not a child of ours
+        pid_fields = ["ffmpeg_pid"] if AMT_GATEWAY_SOCKET else ["ffmpeg_pid", "amt_gateway_pid"]
+        pids = set()
+        for field in pid_fields:
+            pids.update(Tunnel.objects.filter(**{f"{field}__isnull": False}).values_list(field, flat=True))
+        self.stop_orphans(pids)
+
+        fields = {"pipeline_state": "stopped", "ffmpeg_up": False, "ffmpeg_pid": None}
+        if not AMT_GATEWAY_SOCKET:
+            fields.update(amt_gateway_up=False, amt_gateway_pid=None)
+        Tunnel.objects.exclude(pipeline_state="stopped").update(**fields)
+
+    def stop_orphans(self, pids):
+        """
+        Terminates the processes of the given PIDs that are still tunnels or ffmpeg (a PID may
+        have been reused by another process since), and kills those that do not exit in time.
+        """
+        orphans = []
+        for pid in pids:
+            try:
+                process = psutil.Process(pid)
+            except psutil.Error:
+                continue
+            if pid != os.getpid() and is_child_command(process):
+                orphans.append(process)
+        for process in orphans:
+            logger.warning(f"Stopping PID {process.pid}, left behind by a previous supervisor")
+            try:
+                process.terminate()
+            except psutil.Error:
+                pass
+        _, alive = psutil.wait_procs(orphans, timeout=STOP_TIMEOUT)
+        for process in alive:
+            try:
+                process.kill()
+            except psutil.Error:
+                pass
+
+    def shutdown(self):
+        for service in self.services.values():
+            service.wanted = False
+            for proc in (service.probe, service.proc):
+                if proc is not None and proc.poll() is None:
+                    proc.terminate()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for service in list(self.services.values()):
+            for proc in (service.probe, service.proc):
+                if proc is None:
+                    continue
+                try:
+                    proc.wait(timeout=max(deadline - time.monotonic(), 0))
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+            if service.probe is not None:
+                service.probe_output.close()
+                service.probe = service.probe_output = None
+            service.proc = None
+            self.finish_stop(service)
@@ -1,18 +1,37 @@
 from celery import shared_task
 import os
 import subprocess
+import sys
 import tempfile
 
 from django.core.files import File
+from django.db.models import Q
 from django.shortcuts import get_object_or_404
+from redis.exceptions import RedisError
 
-from ...settings import MEDIA_ROOT, BASE_DIR
-from .amt.constants import LOCAL_LOOPBACK
+from ...settings import AMT_GATEWAY_SOCKET, AMT_RELAY_STATE, BASE_DIR, TUNNEL_IDLE_GRACE, WARM_POOL_CPU_BUDGET
+from .amt.constants import DEFAULT_RELAY
 from .models import Stream, Tunnel
+from .util import admission
+from .util.gateway_client import GatewayError, add_session, remove_session
+from .util.pipeline import tunnel_relay
+from .util.port_pool import (
+    PortPoolExhausted,
+    PortsNotLeased,
+    lease_ports,
+    leased_tunnels,
+    pool_usage,
+    release_ports,
+    renew_ports,
+)
+from .util.supervisor_client import SupervisorError, start_process, stop_processes
+from .util import ttff
+from .util.tunnel_stats import tunnel_stats_path
+from .util.viewer_leases import claim_start, lease_state, release_start_claim, start_claimed
+from .util.warm_pool import ranked_streams, select_warm
 from .util.stream_preview import snapshot_multicast_stream, resize_image
 import logging
 import time
-import glob
 
 logger = logging.getLogger(__name__)
 
@@ -25,7 +44,7 @@ def create_preview_for_stream(stream_id):
     stream = Stream.objects.get(id=stream_id)
 
     with tempfile.TemporaryDirectory() as temp_dir:
-        amt_relay = stream.amt_relay or "amt-relay.m2icast.net"
+        amt_relay = stream.amt_relay or DEFAULT_RELAY
         snapshot_multicast_stream(stream.get_url(), amt_relay, temp_dir)
 
         snapshots = os.listdir(temp_dir)
@@ -45,98 +64,249 @@ def create_preview_for_stream(stream_id):
 
 
 @shared_task
-def open_tunnel(tunnel_id):
-    tunnel = get_object_or_404(Tunnel, id=tunnel_id)
-
-    relay = tunnel.stream.amt_relay or "amt-relay.m2icast.net"
+def probe_relays():
+    """
+    Probes the known AMT relays and the relays of all streams and updates their health scores.
+    """
+    relays = (
+        Stream.objects.exclude(amt_relay__isnull=True).exclude(amt_relay="")
+        .values_list("amt_relay", flat=True).distinct()
+    )
     command = [
-        "pipenv", "run", "python3",
-        os.path.join(BASE_DIR, "apps", "view", "amt", "tunnel.py"),
-        relay,
-        tunnel.stream.source,
-        tunnel.stream.group,
-        str(tunnel.get_amt_port_number()),
-        str(tunnel.get_udp_port_number())
+        sys.executable,
+        os.path.join(BASE_DIR, "apps", "view", "amt", "relays.py"),
+        "--state", AMT_RELAY_STATE,
+        *relays,
     ]
+    subprocess.run(command, check=True, capture_output=True, timeout=60)
+    return f"Probed {len(relays)} stream relays"
 
-    log_file_path = os.path.join(BASE_DIR, "logs", "tunnels", f"tunnel_{tunnel_id}_{int(time.time())}.log")
-    os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
 
-    try:
-        with open(log_file_path, "a") as log_file:
-            proc = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+@shared_task
+def open_tunnel(tunnel_id):
+    ttff.record(tunnel_id, "dequeue")
+    tunnel = get_object_or_404(Tunnel, id=tunnel_id)
+
+    if AMT_GATEWAY_SOCKET:
+        # Open the tunnel as a session on the long-lived gateway daemon
+        try:
+            add_session(
+                tunnel_id,
+                tunnel_relay(tunnel),
+                tunnel.stream.source,
+                tunnel.stream.group,
+                tunnel.stream.udp_port,
+                tunnel.get_udp_port_number(),
+                tunnel_stats_path(tunnel_id),
+            )
+        except (OSError, GatewayError, PortsNotLeased) as e:
+            logger.error(f"Failed to open tunnel for {tunnel_id} on the AMT gateway: {e}")
+            tunnel.amt_gateway_up = False
+            tunnel.save()
+            raise
 
-        tunnel.amt_gateway_pid = proc.pid
-        tunnel.log_file_path = log_file_path
+        tunnel.amt_gateway_pid = None
         tunnel.amt_gateway_up = True
         tunnel.save()
+        return f"Tunnel opened for {tunnel_id} on the AMT gateway"
 
-        return f"Tunnel opened for {tunnel_id} with PID {proc.pid}"
-    except subprocess.SubprocessError as e:
-        with open(log_file_path, "a") as log_file:
-            log_file.write(f"Failed to open tunnel for {tunnel_id}: {str(e)}\n")
-        tunnel.amt_gateway_up = False
-        tunnel.save()
+    # The media supervisor runs tunnel.py, restarts it if it crashes and records its PID
+    try:
+        start_process(tunnel_id, "tunnel")
+    except (OSError, SupervisorError) as e:
+        logger.error(f"Failed to open tunnel for {tunnel_id}: {e}")
+        Tunnel.objects.filter(id=tunnel_id).update(amt_gateway_up=False, last_error=str(e))
         raise
+    return f"Tunnel for {tunnel_id} handed to the media supervisor"
 
 
 @shared_task
 def start_ffmpeg(tunnel_id):
-    tunnel = get_object_or_404(Tunnel, id=tunnel_id)
-    udp_port = tunnel.get_udp_port_number()
-
-    output_dir = os.path.join(MEDIA_ROOT, "tunnel-files")
-    os.makedirs(output_dir, exist_ok=True)
-
-    output_file = os.path.join(output_dir, f"index{tunnel_id}-.m3u8")
-
-    ffmpeg_command = [
-        "ffmpeg",
-        "-i", f"udp://127.0.0.1:{udp_port}",
-        "-c:v", "libx264", "-preset", "veryfast", "-tune", "zerolatency",
-        "-profile:v", "main", "-level", "3.1",
-        "-b:v", "2000k",
-        "-maxrate", "2500k",
-        "-bufsize", "4000k",
-        "-c:a", "aac", "-b:a", "128k",
-        "-f", "hls",
-        "-hls_time", "4",
-        "-hls_list_size", "5",
-        "-hls_flags", "delete_segments+append_list+discont_start",
-        "-hls_delete_threshold", "1",
-        "-hls_segment_type", "mpegts",
-        "-hls_segment_filename", f"{output_file}_%03d.ts",
-        output_file,
-    ]
+    # The media supervisor probes the input, runs ffmpeg, restarts it if it crashes and marks
+    # the tunnel up once the playlist is written
+    ttff.record(tunnel_id, "dequeue")
+    get_object_or_404(Tunnel, id=tunnel_id)
+    try:
+        start_process(tunnel_id, "ffmpeg")
+    except (OSError, SupervisorError) as e:
+        logger.error(f"Failed to start FFmpeg for tunnel {tunnel_id}: {e}")
+        Tunnel.objects.filter(id=tunnel_id).update(ffmpeg_up=False, ffmpeg_pid=None, last_error=str(e))
+        raise
+    return f"FFmpeg for tunnel {tunnel_id} handed to the media supervisor"
+
 
+def start_pipeline(tunnel, watch_at=None, queue=True):
+    """
+    Starts the tunnel and ffmpeg of a tunnel if they are down, unless another viewer is already
+    starting them or the node does not have the capacity.
+
+    :param watch_at: Unix time of the watch request starting it, to trace its time to first frame from
+    :param queue: Whether a start the node does not have the capacity for waits in the admission queue
+    :return: True if a start was dispatched
+    """
+    if tunnel.amt_gateway_up and tunnel.ffmpeg_up:
+        return False
+    if not claim_start(tunnel.id):
+        return False
+    decision = admission.admit(tunnel, queue)
+    if not decision.admitted:
+        logger.warning(f"Not starting tunnel {tunnel.id}: {decision.reason}")
+        release_start_claim(tunnel.id)
+        return False
     try:
-        proc = subprocess.Popen(ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        start_time = time.time()
-        while time.time() - start_time < 60:  # Increased timeout to 60 seconds
-            if os.path.exists(output_file):
-                logger.info(f"M3U8 file created: {output_file}")
-                break
-            if proc.poll() is not None:
-                stdout, stderr = proc.communicate()
-                logger.error(f"FFmpeg process ended unexpectedly. Stdout: {stdout.decode()}, Stderr: {stderr.decode()}")
-                raise subprocess.CalledProcessError(proc.returncode, ffmpeg_command, stdout, stderr)
-            time.sleep(1)
+        ports = lease_ports(tunnel.id)
+    except PortPoolExhausted as e:
+        logger.warning(f"Cannot start tunnel {tunnel.id}: {e}")
+        Tunnel.objects.filter(id=tunnel.id).update(last_error=str(e))
+        release_start_claim(tunnel.id)
+        return False
+    if (tunnel.amt_port, tunnel.udp_port) != ports:
+        tunnel.amt_port, tunnel.udp_port = ports
+        Tunnel.objects.filter(id=tunnel.id).update(amt_port=tunnel.amt_port, udp_port=tunnel.udp_port)
+    if watch_at is not None:
+        ttff.begin(tunnel.id, watch_at, ttff.tunnel_label(tunnel))
+    if not tunnel.amt_gateway_up:
+        open_tunnel.delay(tunnel.id)
+    if not tunnel.ffmpeg_up:
+        start_ffmpeg.delay(tunnel.id)
+    return True
+
+
+def stop_pipeline(tunnel):
+    """
+    Stops the tunnel and ffmpeg of a tunnel, removes its HLS files and returns its ports to the pool.
+    """
+    Tunnel.objects.filter(id=tunnel.id).update(
+        amt_gateway_up=False, amt_gateway_pid=None, ffmpeg_up=False, ffmpeg_pid=None, active_viewer_count=0,
+        pipeline_state="stopped",
+    )
+    # The supervisor removes the HLS files once ffmpeg exited
+    try:
+        stop_processes(tunnel.id, purge=True)
+    except (OSError, SupervisorError) as e:
+        logger.warning(f"Failed to stop the processes of tunnel {tunnel.id}: {e}")
+    if AMT_GATEWAY_SOCKET:
+        try:
+            remove_session(tunnel.id)
+        except (OSError, GatewayError) as e:
+            logger.warning(f"Failed to remove tunnel {tunnel.id} from the AMT gateway: {e}")
+
+    try:
+        os.remove(tunnel_stats_path(tunnel.id))
+    except OSError:
+        pass
+    release_ports(tunnel.id)
+
+
+@shared_task
+def reap_idle_tunnels():
+    """
+    Stops the tunnel and ffmpeg of every stream whose last viewer lease expired more than
+    TUNNEL_IDLE_GRACE seconds ago, unless it is in the warm pool, and keeps active_viewer_count
+    at the number of live leases.
+    """
+    stopped = 0
+    for tunnel in Tunnel.objects.filter(Q(amt_gateway_up=True) | Q(ffmpeg_up=True) | Q(ffmpeg_pid__isnull=False)):
+        live, latest_expiry = lease_state(tunnel.id)
+        recent = latest_expiry is not None and time.time() - latest_expiry < TUNNEL_IDLE_GRACE
+        if live or recent or tunnel.warm:
+            if tunnel.active_viewer_count != live:
+                Tunnel.objects.filter(id=tunnel.id).update(active_viewer_count=live)
+            continue
+
+        logger.info(f"Stopping idle tunnel {tunnel.id}")
+        stop_pipeline(tunnel)
+        stopped += 1
+        # A viewer who arrived during the teardown gets the pipeline back
+        release_start_claim(tunnel.id)
+        if lease_state(tunnel.id)[0]:
+            start_pipeline(Tunnel.objects.get(id=tunnel.id))
+    return f"Stopped {stopped} idle tunnels"
+
+
+@shared_task
+def recover_port_leases():
+    """
+    Renews the port leases of the tunnels whose pipeline runs, and returns to the pool those of
+    tunnels that stopped without releasing them, e.g. when a worker or the supervisor crashed.
+    Leases of tunnels nobody renews run out by themselves after PORT_LEASE_TTL.
+    """
+    running = set(
+        Tunnel.objects.filter(
+            Q(amt_gateway_up=True) | Q(ffmpeg_up=True) | Q(ffmpeg_pid__isnull=False) | Q(amt_gateway_pid__isnull=False)
+            | Q(pipeline_state__in=("starting", "running", "restarting"))
+        ).values_list("id", flat=True)
+    )
+    recovered = 0
+    for tunnel_id in leased_tunnels():
+        if tunnel_id in running:
+            renew_ports(tunnel_id)
+        # A pipeline being started has its ports before its processes run
+        elif not start_claimed(tunnel_id) and release_ports(tunnel_id):
+            logger.info(f"Recovered the ports of stopped tunnel {tunnel_id}")
+            recovered += 1
+    leased, size = pool_usage()
+    return f"Recovered {recovered} port leases, {leased} of {size} port pairs in use"
+
+
+@shared_task
+def admit_queued():
+    """
+    Starts the pipelines waiting in the admission queue, in order, as long as the node has the
+    capacity. Tunnels whose viewers all left, that run already or that another viewer is
+    starting leave the queue.
+    """
+    started = 0
+    for tunnel_id in admission.queued_tunnels():
+        tunnel = Tunnel.objects.filter(id=tunnel_id).first()
+        if (
+            tunnel is None or not lease_state(tunnel_id)[0] or start_claimed(tunnel_id)
+            or (tunnel.amt_gateway_up and tunnel.ffmpeg_up)
+        ):
+            admission.dequeue(tunnel_id)
+            continue
+        if start_pipeline(tunnel):
+            started += 1
+        elif tunnel_id in admission.queued_tunnels():
+            # First come first served: no later tunnel overtakes this one
+            break
         else:
-            raise TimeoutError("FFmpeg failed to start within 60 seconds")
-
-        Tunnel.objects.filter(id=tunnel_id).update(ffmpeg_up=True, ffmpeg_pid=proc.pid)
-        
-        # Monitor FFmpeg process
-        while proc.poll() is None:
-            time.sleep(10)
-            logger.info(f"FFmpeg process for tunnel {tunnel_id} is still running. PID: {proc.pid}")
-        
-        # If FFmpeg process has stopped, restart it
-        logger.warning(f"FFmpeg process for tunnel {tunnel_id} has stopped. Restarting...")
-        return start_ffmpeg(tunnel_id)
-
-    except Exception as e:
-        logger.error(f"Failed to start FFmpeg for tunnel {tunnel_id}: {str(e)}")
-        Tunnel.objects.filter(id=tunnel_id).update(ffmpeg_up=False, ffmpeg_pid=None)
-        raise
\ No newline at end of file
+            admission.dequeue(tunnel_id)
+    return f"Started {started} queued pipelines"
+
+
+@shared_task
+def warm_pool():
+    """
+    Keeps the pipelines of the streams most likely to be opened running, within the CPU budget
+    of the warm pool. Streams that drop out of it are left to the reaper.
+    """
+    candidates = []
+    for stream in ranked_streams():
+        tunnel = Tunnel.objects.filter(stream=stream).first()
+        # A broken stream would restart every minute
+        if tunnel is None or tunnel.pipeline_state != "crash_loop":
+            candidates.append((stream, tunnel))
+    selected = select_warm(candidates)
+
+    warm_ids = []
+    for stream, tunnel, cost in selected:
+        if tunnel is None:
+            tunnel, _ = Tunnel.objects.get_or_create(stream=stream, defaults={"active_viewer_count": 0})
+        warm_ids.append(tunnel.id)
+        if not tunnel.warm:
+            logger.info(f"Warming tunnel {tunnel.id} ({cost:.2f} cores)")
+            Tunnel.objects.filter(id=tunnel.id).update(warm=True)
+        # Warming up must not take the place of viewers in the admission queue
+        start_pipeline(tunnel, queue=False)
+    Tunnel.objects.filter(warm=True).exclude(id__in=warm_ids).update(warm=False)
+
+    used = sum(cost for _, _, cost in selected)
+    logger.info(f"Warm pool: {len(selected)} pipelines, {used:.2f} of {WARM_POOL_CPU_BUDGET} cores")
+    # Only reported: the pipelines are started already
+    try:
+        medians = {label: ttff.histograms([label])[ttff.TOTAL].summary()["p50"] for label in ttff.LABELS}
+        logger.info(f"Median time to first frame: {medians}")
+    except RedisError as e:
+        logger.warning(f"Failed to read the time-to-first-frame histograms: {e}")
+    return f"Kept {len(selected)} pipelines warm"
@@ -0,0 +1,28 @@
+import os
+from unittest import mock
+
+import fakeredis
+from django.test import SimpleTestCase
+
+from ..models import Tunnel
+from ..util.admission import NodeMonitor, pipeline_cpu
+
+
+class PipelineCpuTest(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch("multicast.apps.view.util.viewer_leases._redis", fakeredis.FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_measured_by_the_supervisor_of_the_node(self):
+        NodeMonitor("node-a").report(1, {7: [os.getpid()]})
+        tunnel = Tunnel(id=7, media_mode="remux", ffmpeg_pid=os.getpid())
+        self.assertNotEqual(pipeline_cpu(tunnel, "node-a"), 0.1)
+        # The PIDs of the tunnel are not looked at on another node
+        with mock.patch("psutil.Process", side_effect=AssertionError("measured locally")):
+            self.assertEqual(pipeline_cpu(tunnel, "node-b"), 0.1)
+
+    def test_estimated_until_reported(self):
+        self.assertEqual(pipeline_cpu(Tunnel(id=8, media_mode="remux"), "node-a"), 0.1)
+        self.assertEqual(pipeline_cpu(Tunnel(id=9), "node-a"), 1.0)
+        self.assertEqual(pipeline_cpu(None, "node-a"), 1.0)
@@ -0,0 +1,72 @@
+from django.test import RequestFactory, SimpleTestCase
+
+from ..util.hls_http import SEGMENT_CACHE_CONTROL, byte_range, hls_response, is_file_segment
+from ..util.segment_store import HLSFile
+
+SEGMENT = HLSFile(bytes(range(100)), "video/mp2t", None)
+PLAYLIST = HLSFile(b"#EXTM3U\n", "application/vnd.apple.mpegurl", None)
+
+
+class ByteRangeTest(SimpleTestCase):
+    def test_ranges(self):
+        self.assertEqual(byte_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(byte_range("bytes=90-", 100), (90, 99))
+        self.assertEqual(byte_range("bytes=-10", 100), (90, 99))
+        # Clamped to the end of the file
+        self.assertEqual(byte_range("bytes=50-500", 100), (50, 99))
+        self.assertEqual(byte_range("bytes=-500", 100), (0, 99))
+
+    def test_whole_file(self):
+        self.assertIsNone(byte_range(None, 100))
+        self.assertIsNone(byte_range("bytes=-", 100))
+        self.assertIsNone(byte_range("bytes=0-9,20-29", 100))
+        self.assertIsNone(byte_range("items=0-9", 100))
+
+    def test_unsatisfiable(self):
+        self.assertIs(byte_range("bytes=100-", 100), False)
+        self.assertIs(byte_range("bytes=20-10", 100), False)
+        self.assertIs(byte_range("bytes=-0", 100), False)
+
+
+class HLSResponseTest(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_segment_range(self):
+        request = self.factory.get("/", HTTP_RANGE="bytes=10-19")
+        response = hls_response(request, "index7-.m3u8_003.ts", SEGMENT)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, bytes(range(10, 20)))
+        self.assertEqual(response["Content-Range"], "bytes 10-19/100")
+        self.assertEqual(response["Content-Length"], "10")
+        self.assertEqual(response["Cache-Control"], SEGMENT_CACHE_CONTROL)
+
+    def test_whole_segment(self):
+        response = hls_response(self.factory.get("/"), "index7-.m3u8_003.ts", SEGMENT)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, SEGMENT.data)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+    def test_unsatisfiable_range(self):
+        request = self.factory.get("/", HTTP_RANGE="bytes=100-")
+        response = hls_response(request, "index7-.m3u8_003.ts", SEGMENT)
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */100")
+
+    def test_playlist_ignores_ranges_and_revalidates(self):
+        request = self.factory.get("/", HTTP_RANGE="bytes=0-1")
+        response = hls_response(request, "index7-.m3u8", PLAYLIST)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, PLAYLIST.data)
+
+        request = self.factory.get("/", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(hls_response(request, "index7-.m3u8", PLAYLIST).status_code, 304)
+
+
+class IsFileSegmentTest(SimpleTestCase):
+    def test_names(self):
+        self.assertTrue(is_file_segment("index7-.m3u8_003.ts"))
+        self.assertTrue(is_file_segment("index7-.m3u8_p00012.m4s"))
+        # Assembled from parts
+        self.assertFalse(is_file_segment("index7-.m3u8_s00003.m4s"))
+        self.assertFalse(is_file_segment("index7-.m3u8"))
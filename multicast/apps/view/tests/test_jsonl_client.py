@@ -0,0 +1,49 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+
+from django.test import SimpleTestCase
+
+from ..util.gateway_client import GatewayError, gateway_request
+from ..util.supervisor_client import SupervisorError, supervisor_request
+
+
+class ControlSocketTest(SimpleTestCase):
+    """
+    Runs a control socket answering each request line with the given reply lines.
+    """
+
+    def serve(self, *replies):
+        path = os.path.join(tempfile.mkdtemp(), "control.sock")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(len(replies))
+        self.addCleanup(listener.close)
+        self.requests = []
+
+        def serve():
+            for reply in replies:
+                connection, _ = listener.accept()
+                with connection, connection.makefile("rb") as reader:
+                    self.requests.append(json.loads(reader.readline()))
+                    connection.sendall(reply)
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        return path
+
+    def test_result(self):
+        path = self.serve(b'{"ok": true, "result": [1, 2]}\n', b'{"ok": true, "result": {"id": 3}}\n')
+        self.assertEqual(supervisor_request({"op": "list"}, socket_path=path), [1, 2])
+        self.assertEqual(gateway_request({"op": "add", "id": 3}, socket_path=path), {"id": 3})
+        self.assertEqual(self.requests, [{"op": "list"}, {"op": "add", "id": 3}])
+
+    def test_errors(self):
+        path = self.serve(b'{"ok": false, "error": "No such tunnel"}\n', b"")
+        with self.assertRaisesMessage(SupervisorError, "No such tunnel"):
+            supervisor_request({"op": "stop", "id": 1}, socket_path=path)
+        with self.assertRaisesMessage(GatewayError, "The AMT gateway closed the connection without replying"):
+            gateway_request({"op": "list"}, socket_path=path)
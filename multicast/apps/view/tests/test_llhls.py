@@ -0,0 +1,79 @@
+import os
+import tempfile
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from ..util.llhls import BlockingRequestError, LowLatencyHLS, Part, parse_parts_playlist, render_playlist
+from ..util.readiness import ReadinessListener
+from ..util.segment_store import SegmentStore
+
+NAME = "index7-.m3u8"
+
+
+def parts_playlist(sequences, duration=1.0):
+    lines = ["#EXTM3U", "#EXT-X-VERSION:7", f'#EXT-X-MAP:URI="{NAME}_init.mp4"']
+    for sequence in sequences:
+        lines += [f"#EXTINF:{duration:.6f},", f"{NAME}_p{sequence:05d}.m4s"]
+    return "\n".join(lines) + "\n"
+
+
+class ParsePartsPlaylistTest(SimpleTestCase):
+    def test_parts(self):
+        init_uri, parts = parse_parts_playlist(parts_playlist([4, 5], duration=0.5))
+        self.assertEqual(init_uri, f"{NAME}_init.mp4")
+        self.assertEqual(parts, [Part(4, 0.5, f"{NAME}_p00004.m4s"), Part(5, 0.5, f"{NAME}_p00005.m4s")])
+
+    def test_ignores_other_uris(self):
+        text = "#EXTM3U\n#EXTINF:1.0,\nindex7-.m3u8_004.ts\n#EXTINF:1.0,\nindex7-.m3u8_p00005.m4s\n"
+        self.assertEqual(parse_parts_playlist(text), (None, [Part(5, 1.0, "index7-.m3u8_p00005.m4s")]))
+
+
+class RenderPlaylistTest(SimpleTestCase):
+    def test_segments_and_preload_hint(self):
+        _, parts = parse_parts_playlist(parts_playlist(range(2, 12)))
+        lines = render_playlist(NAME, None, parts, parts_per_segment=4, part_seconds=1.0).splitlines()
+        # Parts 2 and 3 belong to a segment whose first parts are gone
+        self.assertIn("#EXT-X-MEDIA-SEQUENCE:1", lines)
+        self.assertEqual([line for line in lines if line.endswith(".m4s") and "_s" in line], [
+            f"{NAME}_s00001.m4s", f"{NAME}_s00002.m4s"
+        ])
+        self.assertEqual(lines[-1], f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="{NAME}_p00012.m4s"')
+
+
+class Listener(ReadinessListener):
+    def start(self):
+        # Announcements come from the test instead of Redis
+        pass
+
+
+class BlockingReloadTest(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.listener = Listener(recheck_interval=60)
+        self.hls = LowLatencyHLS(SegmentStore(self.root), self.listener, parts_per_segment=4, block_timeout=5)
+        self.write_parts(range(0, 4))
+
+    def write_parts(self, sequences):
+        path = os.path.join(self.root, f"{NAME}_parts.m3u8")
+        with open(f"{path}.tmp", "w") as playlist:
+            playlist.write(parts_playlist(sequences))
+        os.rename(f"{path}.tmp", path)
+
+    def test_woken_when_the_playlist_is_written(self):
+        def write():
+            self.write_parts(range(0, 5))
+            self.listener.wake(7)
+
+        timer = threading.Timer(0.1, write)
+        timer.start()
+        self.addCleanup(timer.join)
+        started = time.monotonic()
+        playlist = self.hls.get(NAME, msn=1, part=0).data.decode()
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertIn(f"{NAME}_p00004.m4s", playlist)
+
+    def test_too_far_ahead(self):
+        with self.assertRaises(BlockingRequestError):
+            self.hls.get(NAME, msn=3)
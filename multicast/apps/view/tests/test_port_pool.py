@@ -0,0 +1,75 @@
+import time
+from unittest import mock
+
+import fakeredis
+from django.test import SimpleTestCase, TestCase
+
+from ..models import Stream, Tunnel
+from ..util import port_pool
+from ..util.port_pool import (
+    PortPoolExhausted,
+    PortsNotLeased,
+    lease_ports,
+    leased_tunnels,
+    pool_usage,
+    release_ports,
+    renew_ports,
+    slot_ports,
+)
+
+
+class PortPoolTest(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch("multicast.apps.view.util.viewer_leases._redis", fakeredis.FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = time.time()
+        patcher = mock.patch.object(port_pool.time, "time", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lowest_free_pair(self):
+        self.assertEqual(lease_ports(1), slot_ports(0))
+        self.assertEqual(lease_ports(2), slot_ports(1))
+        # A tunnel keeps its pair
+        self.assertEqual(lease_ports(1), slot_ports(0))
+        self.assertEqual(leased_tunnels(), {1: slot_ports(0), 2: slot_ports(1)})
+
+    def test_released_pair_is_reused_after_the_delay(self):
+        lease_ports(1)
+        self.assertTrue(release_ports(1))
+        self.assertFalse(release_ports(1))
+        self.assertFalse(renew_ports(1))
+        self.assertEqual(lease_ports(2), slot_ports(1))
+        self.now += port_pool.PORT_REUSE_DELAY + 1
+        self.assertEqual(lease_ports(3), slot_ports(0))
+
+    def test_expired_lease_is_reclaimed(self):
+        lease_ports(1, ttl=10)
+        self.now += 5
+        self.assertTrue(renew_ports(1, ttl=10))
+        self.now += 11
+        self.assertEqual(lease_ports(2), slot_ports(0))
+        # The pair went to another tunnel
+        self.assertFalse(renew_ports(1))
+        self.assertFalse(release_ports(1))
+        self.assertEqual(leased_tunnels(), {2: slot_ports(0)})
+
+    def test_exhausted(self):
+        with mock.patch.object(port_pool, "PORT_POOL_SIZE", 2):
+            lease_ports(1)
+            lease_ports(2)
+            self.assertEqual(pool_usage(), (2, 2))
+            with self.assertRaises(PortPoolExhausted):
+                lease_ports(3)
+
+
+class TunnelPortsTest(TestCase):
+    def test_not_leased(self):
+        tunnel = Tunnel.objects.create(stream=Stream.objects.create(source="192.0.2.1", group="232.1.1.1"))
+        with self.assertRaises(PortsNotLeased):
+            tunnel.get_amt_port_number()
+        with self.assertRaises(PortsNotLeased):
+            tunnel.get_udp_port_number()
+        tunnel.amt_port, tunnel.udp_port = slot_ports(0)
+        self.assertEqual((tunnel.get_amt_port_number(), tunnel.get_udp_port_number()), slot_ports(0))
@@ -0,0 +1,102 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import psutil
+from django.test import SimpleTestCase, TestCase
+
+from ..models import Stream, Tunnel
+from ..supervisor import Service, Supervisor, die_with_parent
+
+
+def wait_gone(pid, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if psutil.Process(pid).status() == psutil.STATUS_ZOMBIE:
+                return True
+        except psutil.NoSuchProcess:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class OrphanTest(SimpleTestCase):
+    def test_child_dies_with_the_supervisor(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Stands in for a supervisor that gets killed right after starting a child
+            try:
+                supervisor_pid = os.getpid()
+                child = subprocess.Popen(["sleep", "30"], preexec_fn=lambda: die_with_parent(supervisor_pid))
+                os.write(write_fd, str(child.pid).encode())
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        child_pid = int(os.read(read_fd, 32))
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        self.assertTrue(wait_gone(child_pid))
+
+    def test_stop_orphans(self):
+        directory = tempfile.mkdtemp()
+        script = os.path.join(directory, "tunnel.py")
+        with open(script, "w") as script_file:
+            script_file.write("import time\ntime.sleep(30)\n")
+        orphan = subprocess.Popen([sys.executable, script])
+        # A PID reused by an unrelated process
+        other = subprocess.Popen(["sleep", "30"])
+        self.addCleanup(other.kill)
+        self.addCleanup(orphan.kill)
+
+        Supervisor(os.path.join(directory, "supervisor.sock")).stop_orphans({orphan.pid, other.pid, 999999999})
+        # Reaped by stop_orphans()
+        self.assertFalse(psutil.pid_exists(orphan.pid))
+        self.assertIsNone(other.poll())
+
+
+class SpawnTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        patcher = mock.patch("multicast.apps.view.util.pipeline.HLS_ROOT", self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        stream = Stream.objects.create(source="192.0.2.1", group="232.1.1.1", low_latency=True)
+        self.tunnel = Tunnel.objects.create(stream=stream, amt_port=40000, udp_port=40001)
+        self.supervisor = Supervisor(os.path.join(self.directory, "supervisor.sock"))
+
+    def test_up_once_the_parts_playlist_is_written(self):
+        supervisor = self.supervisor
+        service = supervisor.services[(self.tunnel.id, "ffmpeg")] = Service(self.tunnel.id, "ffmpeg")
+        service.wanted = True
+        service.state = "starting"
+        popen = subprocess.Popen
+        # Stands in for ffmpeg, which writes no files here
+        with mock.patch("subprocess.Popen", side_effect=lambda command, **kwargs: popen(["sleep", "30"], **kwargs)):
+            supervisor.spawn_ffmpeg(service, self.tunnel, None)
+        self.addCleanup(service.proc.wait)
+        self.addCleanup(service.proc.kill)
+        self.assertEqual(service.playlist, os.path.join(self.directory, f"{self.tunnel.get_filename()}_parts.m3u8"))
+
+        supervisor.check_playlist(service)
+        self.assertEqual(service.state, "starting")
+        # Further apart than the granularity of file timestamps
+        time.sleep(0.05)
+        with open(service.playlist, "w") as playlist:
+            playlist.write("#EXTM3U\n")
+        supervisor.check_playlist(service)
+        self.assertEqual(service.state, "running")
+        self.assertTrue(Tunnel.objects.get(id=self.tunnel.id).ffmpeg_up)
+
+    def test_not_started_without_ports(self):
+        Tunnel.objects.filter(id=self.tunnel.id).update(amt_port=None, udp_port=None)
+        service = self.supervisor.services[(self.tunnel.id, "ffmpeg")] = Service(self.tunnel.id, "ffmpeg")
+        service.wanted = True
+        self.supervisor.spawn(service)
+        self.assertFalse(service.wanted)
+        self.assertEqual(service.state, "stopped")
+        self.assertIn("no UDP port", Tunnel.objects.get(id=self.tunnel.id).last_error)
@@ -0,0 +1,65 @@
+from django.test import SimpleTestCase
+
+from ..util.transcode import MediaProbe, choose_ladder, ladder_args, ladder_rungs
+
+LADDER = (("1080p", 1080, 5000), ("720p", 720, 2800), ("480p", 480, 1200))
+
+
+def probe(height, audio_codec="aac"):
+    return MediaProbe("h264", "High", "yuv420p", height * 16 // 9, height, audio_codec, 4_000_000)
+
+
+class LadderRungsTest(SimpleTestCase):
+    def test_leaves_out_rungs_taller_than_the_source(self):
+        self.assertEqual(ladder_rungs(probe(720), LADDER), [("720p", 720, 2800), ("480p", 480, 1200)])
+        self.assertEqual(ladder_rungs(probe(1080), LADDER), list(LADDER))
+
+    def test_source_below_all_rungs(self):
+        self.assertEqual(ladder_rungs(probe(360), LADDER), [("360p", 360, 1200)])
+
+    def test_unknown_height(self):
+        self.assertEqual(ladder_rungs(None, LADDER), list(LADDER))
+        self.assertEqual(ladder_rungs(probe(0), LADDER), list(LADDER))
+
+
+class LadderArgsTest(SimpleTestCase):
+    def option_values(self, args, option):
+        return [args[index + 1] for index, arg in enumerate(args) if arg == option]
+
+    def test_renditions_with_audio(self):
+        rungs = ladder_rungs(probe(720), LADDER)
+        decision = choose_ladder(probe(720), rungs, audio_only=True)
+        self.assertEqual(decision.mode, "ladder")
+        self.assertTrue(decision.copy_audio)
+        self.assertTrue(decision.reason.endswith("ladder 720p, 480p, audio"))
+
+        args = ladder_args(decision, rungs, probe(720), "/hls/index1-.m3u8", audio_only=True)
+        self.assertEqual(
+            self.option_values(args, "-filter_complex"),
+            ["[0:v:0]split=2[v0][v1];[v0]scale=-2:720[v0out];[v1]scale=-2:480[v1out]"],
+        )
+        self.assertEqual(self.option_values(args, "-map"), ["[v0out]", "[v1out]", "0:a:0", "0:a:0", "0:a:0"])
+        self.assertEqual(self.option_values(args, "-b:v:1"), ["1200k"])
+        self.assertEqual(
+            self.option_values(args, "-var_stream_map"),
+            ["v:0,a:0,name:720p v:1,a:1,name:480p a:2,name:audio"],
+        )
+        self.assertEqual(self.option_values(args, "-master_pl_name"), ["index1-.m3u8"])
+        self.assertEqual(self.option_values(args, "-c:a"), ["copy"])
+        self.assertEqual(args[-1], "/hls/index1-.m3u8_%v.m3u8")
+
+    def test_renditions_without_audio(self):
+        source = probe(480, audio_codec=None)
+        rungs = ladder_rungs(source, LADDER)
+        args = ladder_args(choose_ladder(source, rungs), rungs, source, "/hls/index1-.m3u8", audio_only=True)
+        self.assertEqual(self.option_values(args, "-map"), ["[v0out]"])
+        self.assertEqual(self.option_values(args, "-var_stream_map"), ["v:0,name:480p"])
+        self.assertNotIn("-c:a", args)
+
+    def test_transcoded_audio(self):
+        source = probe(480, audio_codec="mp2")
+        rungs = ladder_rungs(source, LADDER)
+        decision = choose_ladder(source, rungs)
+        self.assertFalse(decision.copy_audio)
+        args = ladder_args(decision, rungs, source, "/hls/index1-.m3u8")
+        self.assertEqual(self.option_values(args, "-c:a"), ["aac"])
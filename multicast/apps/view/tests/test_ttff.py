@@ -0,0 +1,48 @@
+from unittest import mock
+
+import fakeredis
+from django.test import SimpleTestCase
+
+from ..util import ttff
+
+
+class TraceTest(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch("multicast.apps.view.util.viewer_leases._redis", fakeredis.FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_histograms_by_label(self):
+        ttff.begin(7, 100.0, "warm")
+        ttff.record(7, "dequeue", 100.5)
+        ttff.record(7, "playlist", 101.5)
+        ttff.record(7, "first_segment", 102.0)
+        self.assertEqual(ttff.finish(7), {"dequeue": 0.5, "playlist": 1.0, "first_segment": 0.5, ttff.TOTAL: 2.0})
+        # The trace is gone
+        self.assertIsNone(ttff.finish(7))
+
+        warm = ttff.histograms(["warm"])
+        self.assertEqual(warm["dequeue"].count, 1)
+        self.assertEqual(warm[ttff.TOTAL].total, 2.0)
+        self.assertEqual(ttff.histograms(["cold"])[ttff.TOTAL].count, 0)
+
+    def test_instant_starts_count_in_the_total(self):
+        ttff.begin(7, 100.0, "cold")
+        ttff.record(7, "playlist", 103.0)
+        ttff.record(7, "first_segment", 104.0)
+        ttff.finish(7)
+        ttff.record_instant("cold")
+        ttff.record_instant("warm")
+
+        self.assertEqual(ttff.histograms(["cold"])[ttff.TOTAL].count, 2)
+        self.assertEqual(ttff.histograms(["warm"])[ttff.TOTAL].summary()["p50"], 0.0005)
+        both = ttff.histograms()
+        self.assertEqual((both[ttff.TOTAL].count, both[ttff.TOTAL].total), (3, 4.0))
+        self.assertEqual(both["playlist"].count, 1)
+
+        ttff.reset()
+        self.assertEqual(ttff.histograms()[ttff.TOTAL].count, 0)
+
+    def test_no_trace_without_begin(self):
+        ttff.record(7, "dequeue")
+        self.assertIsNone(ttff.finish(7))
@@ -0,0 +1,36 @@
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+
+from ..models import Stream, Tunnel
+from ..util.viewer_leases import LEASE_TOKEN_MAX_LENGTH, lease_id_from_token, lease_token, new_lease_id
+
+
+class LeaseTokenTest(SimpleTestCase):
+    def test_round_trip(self):
+        lease_id = new_lease_id()
+        self.assertEqual(lease_id_from_token(7, lease_token(7, lease_id)), lease_id)
+
+    def test_bound_to_the_tunnel(self):
+        self.assertIsNone(lease_id_from_token(8, lease_token(7, new_lease_id())))
+
+    def test_rejects_made_up_tokens(self):
+        lease_id = new_lease_id()
+        token = lease_token(7, lease_id)
+        self.assertIsNone(lease_id_from_token(7, lease_id))
+        self.assertIsNone(lease_id_from_token(7, token[:-1]))
+        self.assertIsNone(lease_id_from_token(7, ""))
+        self.assertIsNone(lease_id_from_token(7, None))
+        self.assertIsNone(lease_id_from_token(7, "a" * (LEASE_TOKEN_MAX_LENGTH + 1)))
+
+    def test_rejects_signed_ids_of_another_format(self):
+        self.assertIsNone(lease_id_from_token(7, lease_token(7, "x" * 1000)))
+
+
+class ViewerLeaseViewTest(TestCase):
+    def test_rejects_invalid_lease(self):
+        stream = Stream.objects.create(source="192.0.2.1", group="232.1.1.1")
+        tunnel = Tunnel.objects.create(stream=stream)
+        url = reverse("view:viewer_lease", args=[stream.id])
+        for lease in ("", new_lease_id(), lease_token(tunnel.id + 1, new_lease_id())):
+            response = self.client.post(url, {"lease": lease})
+            self.assertEqual(response.status_code, 400)
@@ -25,4 +25,6 @@ urlpatterns = [
     path("detail/like_stream/<int:stream_id>/", views.like_stream, name="like_stream"),
     path("detail/remove_like_from_stream/<int:stream_id>/", views.remove_like_from_stream, name="remove_like_from_stream"),
     path('check_stream_status/<int:stream_id>/', views.check_stream_status, name='check_stream_status'),
+    path('tunnel_stats/<int:stream_id>/', views.tunnel_stats, name='tunnel_stats'),
+    path('viewer_lease/<int:stream_id>/', views.viewer_lease, name='viewer_lease'),
 ]
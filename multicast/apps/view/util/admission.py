@@ -0,0 +1,257 @@
+import collections
+import logging
+import os
+import time
+
+import psutil
+from redis.exceptions import RedisError
+
+from ....settings import (
+    ADMISSION_MAX_CPU_PERCENT,
+    ADMISSION_MAX_EGRESS_BPS,
+    ADMISSION_MAX_MEMORY_PERCENT,
+    ADMISSION_MAX_PIPELINES,
+    ADMISSION_QUEUE_MAX,
+    NODE_NAME,
+    PIPELINE_START_CLAIM_TTL,
+    WARM_POOL_CPU_COST,
+)
+from ..models import Tunnel
+from .viewer_leases import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Hash of the load of a node, written by its media supervisor every NODE_REPORT_INTERVAL seconds:
+# cpu and memory (percent), egress (bit/s), pipelines, cores and updated (Unix time)
+NODE_LOAD_KEY = "node-load:{}"
+NODE_REPORT_INTERVAL = 2.0
+NODE_LOAD_TTL = 10
+# Hash of the CPU the pipelines of a node use, reported with its load: tunnel ID -> cores
+PIPELINE_CPU_KEY = "pipeline-cpu:{}"
+# Sorted set of the tunnels admitted but not running yet: tunnel ID -> time of admission
+STARTING_KEY = "admission-starting:{}"
+# Sorted set of the tunnels waiting for capacity, first come first served: tunnel ID -> time queued
+QUEUE_KEY = "admission-queue:{}"
+# Reason a tunnel was turned away, kept for its viewers to see
+REJECTED_KEY = "admission-rejected:{}"
+REJECTED_TTL = 60
+
+PIPELINE_STATES = ("starting", "running", "restarting")
+
+NodeLoad = collections.namedtuple("NodeLoad", ["cpu", "memory", "egress", "pipelines", "cores"])
+Decision = collections.namedtuple("Decision", ["admitted", "reason"])
+
+
+def process_cpu(pid):
+    """
+    Returns the average CPU use of a process since it started, in cores, or None if it is gone.
+    """
+    try:
+        proc = psutil.Process(pid)
+        times = proc.cpu_times()
+        return (times.user + times.system) / max(time.time() - proc.create_time(), 1.0)
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return None
+
+
+class NodeMonitor:
+    """
+    Measures the load of this node for its media supervisor, which reports it with report().
+    """
+
+    def __init__(self, node=NODE_NAME):
+        self.node = node
+        self.next_report = 0
+        self.last_sent = None
+        # Starts the CPU measurement, which the next call completes
+        psutil.cpu_percent()
+
+    def measure(self, pipelines):
+        now = time.monotonic()
+        sent = psutil.net_io_counters().bytes_sent
+        egress = 0.0
+        if self.last_sent is not None and now > self.last_sent[0]:
+            egress = (sent - self.last_sent[1]) * 8 / (now - self.last_sent[0])
+        self.last_sent = (now, sent)
+        return NodeLoad(psutil.cpu_percent(), psutil.virtual_memory().percent, egress, pipelines, os.cpu_count() or 1)
+
+    def report(self, pipelines, pids=None):
+        """
+        Writes the load of the node, and the CPU each of its pipelines uses, to Redis, at most
+        every NODE_REPORT_INTERVAL seconds.
+
+        :param pipelines: Number of ffmpeg processes the supervisor runs
+        :param pids: {tunnel ID: PIDs of the processes of its pipeline}, children of the supervisor
+        """
+        now = time.monotonic()
+        if now < self.next_report:
+            return
+        self.next_report = now + NODE_REPORT_INTERVAL
+        load = self.measure(pipelines)
+        cpu = {}
+        for tunnel_id, tunnel_pids in (pids or {}).items():
+            measured = [process_cpu(pid) for pid in tunnel_pids]
+            if any(cores is not None for cores in measured):
+                cpu[tunnel_id] = sum(cores for cores in measured if cores is not None)
+        try:
+            pipeline = redis_client().pipeline()
+            pipeline.hset(NODE_LOAD_KEY.format(self.node), mapping={**load._asdict(), "updated": time.time()})
+            pipeline.expire(NODE_LOAD_KEY.format(self.node), NODE_LOAD_TTL)
+            pipeline.delete(PIPELINE_CPU_KEY.format(self.node))
+            if cpu:
+                pipeline.hset(PIPELINE_CPU_KEY.format(self.node), mapping=cpu)
+                pipeline.expire(PIPELINE_CPU_KEY.format(self.node), NODE_LOAD_TTL)
+            pipeline.execute()
+        except RedisError as e:
+            logger.warning(f"Failed to report the load of node {self.node}: {e}")
+
+
+def node_load(node=NODE_NAME):
+    """
+    :return: The NodeLoad its supervisor last reported, or one measured here (the web and worker
+        processes run on the node) if there is no recent report
+    """
+    fields = redis_client().hgetall(NODE_LOAD_KEY.format(node))
+    if fields:
+        fields = {name.decode(): float(value) for name, value in fields.items()}
+        return NodeLoad(fields["cpu"], fields["memory"], fields["egress"], int(fields["pipelines"]), int(fields["cores"]))
+    cores = os.cpu_count() or 1
+    # The load average stands in for a CPU sample, which would take a measurement interval
+    cpu = min(os.getloadavg()[0] / cores * 100, 100.0)
+    pipelines = Tunnel.objects.filter(pipeline_state__in=PIPELINE_STATES).count()
+    return NodeLoad(cpu, psutil.virtual_memory().percent, 0.0, pipelines, cores)
+
+
+def pipeline_cpu(tunnel, node=NODE_NAME):
+    """
+    Returns the CPU the pipeline of a tunnel uses, as the media supervisor of the node measured it
+    (if it runs there), or is expected to use, in cores.
+    """
+    if tunnel is not None:
+        try:
+            measured = redis_client().hget(PIPELINE_CPU_KEY.format(node), tunnel.id)
+        except RedisError as e:
+            logger.warning(f"Failed to read the CPU use of tunnel {tunnel.id}: {e}")
+            measured = None
+        if measured is not None:
+            return float(measured)
+    media_mode = tunnel.media_mode if tunnel is not None else ""
+    return WARM_POOL_CPU_COST.get(media_mode, WARM_POOL_CPU_COST["transcode"])
+
+
+def starting_tunnels(node=NODE_NAME):
+    """
+    :return: IDs of the tunnels admitted within the last PIPELINE_START_CLAIM_TTL seconds, whose
+        load may not show yet
+    """
+    key = STARTING_KEY.format(node)
+    pipeline = redis_client().pipeline()
+    pipeline.zremrangebyscore(key, "-inf", time.time() - PIPELINE_START_CLAIM_TTL)
+    pipeline.zrange(key, 0, -1)
+    _, members = pipeline.execute()
+    return [int(member) for member in members]
+
+
+def decide(tunnel, node=NODE_NAME):
+    """
+    Decides whether the node has the capacity to start the pipeline of a tunnel: what it runs,
+    plus what it was asked to start recently, plus this pipeline must fit in the budget.
+
+    :return: Decision
+    """
+    load = node_load(node)
+    starting = [tunnel_id for tunnel_id in starting_tunnels(node) if tunnel_id != tunnel.id]
+    running = set(Tunnel.objects.filter(id__in=starting, pipeline_state__in=PIPELINE_STATES).values_list("id", flat=True))
+    pending = [tunnel_id for tunnel_id in starting if tunnel_id not in running]
+
+    if load.pipelines + len(pending) + 1 > ADMISSION_MAX_PIPELINES:
+        return Decision(False, f"{load.pipelines + len(pending)} of {ADMISSION_MAX_PIPELINES} pipelines in use")
+    # Pipelines not running yet are expected to cost as much as this one
+    cost = pipeline_cpu(tunnel, node) / load.cores * 100
+    cpu = load.cpu + cost * (len(pending) + 1)
+    if cpu > ADMISSION_MAX_CPU_PERCENT:
+        return Decision(False, f"CPU would reach {cpu:.0f}% (budget {ADMISSION_MAX_CPU_PERCENT}%)")
+    if load.memory > ADMISSION_MAX_MEMORY_PERCENT:
+        return Decision(False, f"memory at {load.memory:.0f}% (budget {ADMISSION_MAX_MEMORY_PERCENT}%)")
+    if ADMISSION_MAX_EGRESS_BPS and load.egress > ADMISSION_MAX_EGRESS_BPS:
+        return Decision(False, f"egress at {load.egress / 1e6:.0f} Mbit/s (budget {ADMISSION_MAX_EGRESS_BPS / 1e6:.0f} Mbit/s)")
+    return Decision(True, None)
+
+
+def admit(tunnel, queue=True, node=NODE_NAME):
+    """
+    Admits the start of the pipeline of a tunnel if the node has the capacity, and otherwise
+    queues it (up to ADMISSION_QUEUE_MAX tunnels) or turns it away.
+
+    :param queue: Whether a start that does not fit may wait for capacity
+    :return: Decision
+    """
+    try:
+        decision = decide(tunnel, node)
+        client = redis_client()
+        if decision.admitted:
+            pipeline = client.pipeline()
+            pipeline.zadd(STARTING_KEY.format(node), {tunnel.id: time.time()})
+            pipeline.zrem(QUEUE_KEY.format(node), tunnel.id)
+            pipeline.delete(REJECTED_KEY.format(tunnel.id))
+            pipeline.execute()
+            return decision
+        if not queue:
+            return decision
+        if client.zscore(QUEUE_KEY.format(node), tunnel.id) is None and client.zcard(QUEUE_KEY.format(node)) >= ADMISSION_QUEUE_MAX:
+            client.set(REJECTED_KEY.format(tunnel.id), decision.reason, ex=REJECTED_TTL)
+            logger.warning(f"Turned away tunnel {tunnel.id}, the queue is full: {decision.reason}")
+            return decision
+        if client.zadd(QUEUE_KEY.format(node), {tunnel.id: time.time()}, nx=True):
+            logger.info(f"Queued tunnel {tunnel.id}: {decision.reason}")
+        return decision
+    except RedisError as e:
+        # Admission control must not take the site down with Redis
+        logger.warning(f"Admitting tunnel {tunnel.id} unchecked: {e}")
+        return Decision(True, None)
+
+
+def queued_tunnels(node=NODE_NAME):
+    """
+    :return: IDs of the tunnels waiting for capacity, first in line first
+    """
+    return [int(member) for member in redis_client().zrange(QUEUE_KEY.format(node), 0, -1)]
+
+
+def dequeue(tunnel_id, node=NODE_NAME):
+    redis_client().zrem(QUEUE_KEY.format(node), tunnel_id)
+
+
+def capacity_status(tunnel_id, node=NODE_NAME):
+    """
+    :return: The status of a tunnel for the watch page if it waits for capacity or was turned
+        away, or None
+    """
+    pipeline = redis_client().pipeline()
+    pipeline.zrank(QUEUE_KEY.format(node), tunnel_id)
+    pipeline.get(REJECTED_KEY.format(tunnel_id))
+    position, rejected = pipeline.execute()
+    if position is not None:
+        return {"status": "capacity", "queued": True, "position": position + 1}
+    if rejected is not None:
+        return {"status": "capacity", "queued": False, "reason": rejected.decode()}
+    return None
+
+
+def node_report(node=NODE_NAME):
+    """
+    :return: Load, budget and queue of a node, for the admission_report command
+    """
+    load = node_load(node)
+    return {
+        "node": node,
+        "load": load._asdict(),
+        "budget": {
+            "cpu": ADMISSION_MAX_CPU_PERCENT,
+            "memory": ADMISSION_MAX_MEMORY_PERCENT,
+            "egress": ADMISSION_MAX_EGRESS_BPS or None,
+            "pipelines": ADMISSION_MAX_PIPELINES,
+        },
+        "starting": starting_tunnels(node),
+        "queued": queued_tunnels(node),
+    }
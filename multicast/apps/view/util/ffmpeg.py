@@ -0,0 +1,103 @@
+import collections
+import os
+import re
+
+from ....settings import AMT_GATEWAY_SOCKET, TUNNEL_RUNTIME_DIR, TUNNEL_TRANSPORT
+from ..amt.constants import LOCAL_LOOPBACK
+
+# Must match TRANSPORTS in amt/transport.py
+TRANSPORTS = ("udp", "fifo", "unix")
+
+# ffmpeg log lines that mean input data was lost or damaged before it reached the encoder
+LOSS_PATTERNS = {
+    "overruns": re.compile(r"circular buffer overrun", re.IGNORECASE),
+    "continuity_errors": re.compile(r"continuity check failed", re.IGNORECASE),
+    "corrupt_packets": re.compile(r"packet corrupt|corrupt (?:input )?packet", re.IGNORECASE),
+}
+
+
+def tunnel_transport():
+    """
+    Returns the transport tunnels hand their payloads to ffmpeg over.
+    The AMT gateway daemon only forwards over loopback UDP.
+    """
+    if AMT_GATEWAY_SOCKET:
+        return "udp"
+    if TUNNEL_TRANSPORT not in TRANSPORTS:
+        raise ValueError(f"Unknown TUNNEL_TRANSPORT {TUNNEL_TRANSPORT!r}, expected one of {TRANSPORTS}")
+    return TUNNEL_TRANSPORT
+
+
+def transport_path(tunnel_id, transport=None):
+    """
+    Returns the path of the named pipe or unix socket of a tunnel, or None for the udp transport.
+    """
+    transport = transport or tunnel_transport()
+    if transport == "udp":
+        return None
+    os.makedirs(TUNNEL_RUNTIME_DIR, exist_ok=True)
+    return os.path.join(TUNNEL_RUNTIME_DIR, f"tunnel{tunnel_id}.{'fifo' if transport == 'fifo' else 'sock'}")
+
+
+def tunnel_transport_args(tunnel_id):
+    """
+    Returns the command line arguments selecting the transport of amt/tunnel.py.
+    """
+    transport = tunnel_transport()
+    if transport == "udp":
+        return []
+    return ["--transport", transport, "--transport-path", transport_path(tunnel_id, transport)]
+
+
+def ffmpeg_input_args(tunnel_id, udp_port):
+    """
+    Returns the ffmpeg input arguments reading the payloads a tunnel forwards.
+
+    :param tunnel_id: ID of the tunnel
+    :param udp_port: Local UDP port of the tunnel (udp transport)
+    :return: List of arguments, ending with the input
+    """
+    transport = tunnel_transport()
+    if transport == "udp":
+        return ["-i", f"udp://{LOCAL_LOOPBACK}:{udp_port}"]
+
+    path = transport_path(tunnel_id, transport)
+    if transport == "fifo":
+        # ffmpeg may start before the tunnel; both sides open the same pipe
+        try:
+            os.mkfifo(path)
+        except FileExistsError:
+            pass
+        return ["-f", "mpegts", "-i", path]
+    return ["-f", "mpegts", "-i", f"unix:{path}"]
+
+
+class StderrLog:
+    """
+    Collects the stderr output of an ffmpeg process as it is read: counts the lines reporting lost
+    input data and keeps the last lines for error reports.
+    """
+
+    def __init__(self, tail_lines=20):
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.counters = dict.fromkeys(LOSS_PATTERNS, 0)
+        self.partial = b""
+
+    def feed(self, data):
+        """
+        :param data: Bytes read from the pipe; an empty read flushes the last unterminated line
+        """
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop() if data else b""
+        for raw_line in lines:
+            # ffmpeg ends progress lines with a carriage return
+            line = raw_line.decode(errors="replace").rstrip().rpartition("\r")[2]
+            if not line:
+                continue
+            self.tail.append(line)
+            for name, pattern in LOSS_PATTERNS.items():
+                if pattern.search(line):
+                    self.counters[name] += 1
+
+    def output(self):
+        return "\n".join(self.tail)
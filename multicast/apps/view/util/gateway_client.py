@@ -0,0 +1,47 @@
+from ....settings import AMT_GATEWAY_SOCKET, AMT_GATEWAY_TIMEOUT
+from .jsonl_client import jsonl_request
+
+
+class GatewayError(Exception):
+    """
+    Raised when the AMT gateway daemon rejects a request.
+    """
+
+
+def gateway_request(request, socket_path=None, timeout=AMT_GATEWAY_TIMEOUT):
+    """
+    Sends one JSON request to the AMT gateway daemon and returns the result of its reply.
+
+    :param request: Request dictionary, e.g. {"op": "list"}
+    :param socket_path: Path of the daemon's control socket (defaults to AMT_GATEWAY_SOCKET)
+    :param timeout: Socket timeout in seconds
+    :return: The "result" member of the reply
+    """
+    return jsonl_request(request, socket_path or AMT_GATEWAY_SOCKET, timeout, GatewayError, "AMT gateway")
+
+
+def add_session(session_id, relay, source, group, stream_port, udp_port, stats_path=None):
+    """
+    Subscribes a local UDP port to an (S,G) channel. Channels from the same relay share one AMT
+    session on the gateway, so no AMT port is needed per tunnel.
+
+    :param stats_path: Shared-memory block the gateway publishes the metrics of the session to
+    """
+    return gateway_request({
+        "op": "add",
+        "id": session_id,
+        "relay": relay,
+        "source": source,
+        "group": group,
+        "stream_port": stream_port,
+        "udp_port": udp_port,
+        "stats_path": stats_path,
+    })
+
+
+def remove_session(session_id):
+    return gateway_request({"op": "remove", "id": session_id})
+
+
+def list_sessions():
+    return gateway_request({"op": "list"})
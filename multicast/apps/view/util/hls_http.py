@@ -0,0 +1,111 @@
+import hashlib
+import os
+import re
+
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+
+from ....settings import HLS_PLAYLIST_MAX_AGE, HLS_ROOT, HLS_SENDFILE, HLS_SENDFILE_PREFIX
+from .segment_store import CONTENT_TYPES, HLS_FILE_NAME
+
+SENDFILE_HEADERS = {
+    "x-accel-redirect": "X-Accel-Redirect",
+    "x-sendfile": "X-Sendfile",
+}
+# Segment names are never reused (see segment_start_number), so caches may keep them for good
+SEGMENT_CACHE_CONTROL = "public, max-age=31536000, immutable"
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def is_segment(match):
+    """
+    Whether a matched HLS file name is a segment (or part), whose content never changes.
+    """
+    return match.group("sequence") is not None
+
+
+def is_file_segment(name):
+    """
+    Whether name is a segment that exists as a file as it is, which the front end can send.
+    Segments of low-latency tunnels are assembled from their parts.
+    """
+    match = HLS_FILE_NAME.match(name)
+    return match is not None and is_segment(match) and match.group("kind") != "s"
+
+
+def sendfile_response(name):
+    """
+    Returns an empty response handing the file name of HLS_ROOT to the front end (HLS_SENDFILE).
+    """
+    if HLS_SENDFILE not in SENDFILE_HEADERS:
+        raise ValueError(f"Unknown HLS_SENDFILE {HLS_SENDFILE!r}, expected one of {tuple(SENDFILE_HEADERS)}")
+    match = HLS_FILE_NAME.match(name)
+    response = HttpResponse(content_type=CONTENT_TYPES[match.group("extension")])
+    if HLS_SENDFILE == "x-accel-redirect":
+        response["X-Accel-Redirect"] = f"{HLS_SENDFILE_PREFIX.rstrip('/')}/{name}"
+    else:
+        response[SENDFILE_HEADERS[HLS_SENDFILE]] = os.path.join(HLS_ROOT, name)
+    response["Cache-Control"] = SEGMENT_CACHE_CONTROL
+    return response
+
+
+def byte_range(header, length):
+    """
+    Parses a single-range Range header.
+
+    :return: (first, last) byte, None to send everything (no header, or several ranges), or
+        False if the range cannot be satisfied
+    """
+    match = RANGE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # The last n bytes
+        first, last = max(length - int(last), 0), length - 1
+    else:
+        first, last = int(first), min(int(last), length - 1) if last else length - 1
+    if first >= length or first > last:
+        return False
+    return first, last
+
+
+def hls_response(request, name, hls_file):
+    """
+    Returns the response serving an HLS file: segments with immutable caching and byte ranges,
+    playlists (and initialization segments) with a short max-age and an ETag to revalidate with.
+    """
+    data = hls_file.data
+    if is_segment(HLS_FILE_NAME.match(name)):
+        headers = {"Cache-Control": SEGMENT_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+        span = byte_range(request.META.get("HTTP_RANGE"), len(data))
+        if span is False:
+            response = HttpResponse(status=416, content_type=hls_file.content_type)
+            response["Content-Range"] = f"bytes */{len(data)}"
+            return response
+        status = 200
+        if span is not None:
+            first, last = span
+            headers["Content-Range"] = f"bytes {first}-{last}/{len(data)}"
+            data = data[first:last + 1]
+            status = 206
+    else:
+        headers = {
+            "Cache-Control": f"public, max-age={HLS_PLAYLIST_MAX_AGE}",
+            "ETag": f'"{hashlib.md5(data).hexdigest()}"',
+        }
+        if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+        if if_none_match and (headers["ETag"] in parse_etags(if_none_match) or if_none_match.strip() == "*"):
+            response = HttpResponseNotModified()
+            for header, value in headers.items():
+                response[header] = value
+            return response
+        status = 200
+
+    response = HttpResponse(data, content_type=hls_file.content_type, status=status)
+    response["Content-Length"] = len(data)
+    for header, value in headers.items():
+        response[header] = value
+    return response
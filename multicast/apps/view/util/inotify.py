@@ -0,0 +1,80 @@
+import collections
+import ctypes
+import os
+import struct
+
+# Events of <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+Event = collections.namedtuple("Event", ["wd", "mask", "cookie", "name"])
+
+
+class InotifyUnavailable(OSError):
+    """
+    Raised where there is no inotify (e.g. not on Linux).
+    """
+
+
+class Inotify:
+    """
+    Minimal non-blocking inotify instance (through libc, so that no package is needed). Its
+    fileno() can be registered with a selector.
+    """
+
+    def __init__(self):
+        # The symbols of the libc the interpreter is linked against, as in amt/batch.py
+        # (ctypes.util.find_library would spawn subprocesses)
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            init = self.libc.inotify_init1
+        except (OSError, TypeError, AttributeError) as e:
+            raise InotifyUnavailable(f"inotify is not available: {e}") from e
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise InotifyUnavailable(errno, os.strerror(errno))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """
+        :return: Watch descriptor of the events of mask on path
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def read(self):
+        """
+        :return: List of the pending Events, empty if there are none
+        """
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append(Event(wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,29 @@
+import json
+import socket
+
+
+def jsonl_request(request, socket_path, timeout, error, peer):
+    """
+    Sends one JSON request line to the unix control socket of a daemon and returns the result of
+    its reply line.
+
+    :param request: Request dictionary, e.g. {"op": "list"}
+    :param socket_path: Path of the daemon's control socket
+    :param timeout: Socket timeout in seconds
+    :param error: Exception class raised when the daemon rejects the request
+    :param peer: Name of the daemon in error messages
+    :return: The "result" member of the reply
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as reader:
+            line = reader.readline()
+
+    if not line:
+        raise error(f"The {peer} closed the connection without replying")
+    reply = json.loads(line)
+    if not reply.get("ok"):
+        raise error(reply.get("error", "Unknown error"))
+    return reply.get("result")
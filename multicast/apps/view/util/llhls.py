@@ -0,0 +1,220 @@
+import collections
+import math
+import re
+
+from ....settings import LL_HLS_BLOCK_TIMEOUT, LL_HLS_PART_SECONDS, LL_HLS_PARTS_PER_SEGMENT, LL_HLS_RECHECK_INTERVAL
+from .readiness import ReadinessListener
+from .segment_index import PLAYLIST_CHANNEL
+from .segment_store import HLS_FILE_NAME, HLSFile, segment_store
+
+# ffmpeg writes the parts of a low-latency tunnel as short fMP4 segments listed in
+# index<id>-.m3u8_parts.m3u8 (see ll_hls_output_args). The LL-HLS playlist served as
+# index<id>-.m3u8 is built from that list: LL_HLS_PARTS_PER_SEGMENT consecutive parts make a
+# segment ("_s" sequence), which is served as the concatenation of their fragments. Blocking
+# requests are woken when the segment index announces that the parts playlist was written.
+
+PART_URI = re.compile(r"_p(\d+)\.m4s$")
+# Segments whose parts are listed, counted back from the end of the playlist
+PART_SEGMENTS = 3
+
+Part = collections.namedtuple("Part", ["sequence", "duration", "uri"])
+
+
+class BlockingRequestError(Exception):
+    """
+    Raised for a blocking playlist request too far ahead of the live edge.
+    """
+
+
+def parts_playlist_name(name):
+    return f"{name}_parts.m3u8"
+
+
+def part_name(prefix, sequence):
+    return f"{prefix}_p{sequence:05d}.m4s"
+
+
+def segment_name(prefix, msn):
+    return f"{prefix}_s{msn:05d}.m4s"
+
+
+def parse_parts_playlist(text):
+    """
+    :return: (URI of the initialization segment or None, list of Parts, oldest first)
+    """
+    init_uri = None
+    parts = []
+    duration = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-MAP:"):
+            match = re.search(r'URI="([^"]+)"', line)
+            init_uri = match.group(1) if match else None
+        elif line.startswith("#EXTINF:"):
+            duration = float(line[len("#EXTINF:"):].split(",")[0])
+        elif line and not line.startswith("#") and duration is not None:
+            match = PART_URI.search(line)
+            if match:
+                parts.append(Part(int(match.group(1)), duration, line))
+            duration = None
+    return init_uri, parts
+
+
+def group_segments(parts, parts_per_segment=LL_HLS_PARTS_PER_SEGMENT):
+    """
+    Groups parts into segments.
+
+    :return: List of (media sequence number, parts), oldest first. A leading segment whose first
+        parts were already deleted is left out.
+    """
+    groups = []
+    for part in parts:
+        msn = part.sequence // parts_per_segment
+        if groups and groups[-1][0] == msn:
+            groups[-1][1].append(part)
+        else:
+            groups.append((msn, [part]))
+    if groups and groups[0][1][0].sequence % parts_per_segment:
+        groups.pop(0)
+    return groups
+
+
+def render_playlist(prefix, init_uri, parts, parts_per_segment=LL_HLS_PARTS_PER_SEGMENT, part_seconds=LL_HLS_PART_SECONDS):
+    """
+    Builds the LL-HLS media playlist of a tunnel from its parts.
+
+    :param prefix: Name of the playlist, which the segment names start with
+    """
+    groups = group_segments(parts, parts_per_segment)
+    # ffmpeg cuts on keyframes only, so parts of remuxed sources can be longer than asked for
+    part_target = max([part_seconds, *(part.duration for part in parts)])
+    segment_durations = [sum(part.duration for part in group) for _, group in groups]
+    target_duration = math.ceil(max([part_target * parts_per_segment, *segment_durations]))
+
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:6",
+        f"#EXT-X-TARGETDURATION:{target_duration}",
+        f"#EXT-X-PART-INF:PART-TARGET={part_target:.3f}",
+        f"#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK={3 * part_target:.3f}",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+        f"#EXT-X-MEDIA-SEQUENCE:{groups[0][0] if groups else 0}",
+    ]
+    if init_uri:
+        lines.append(f'#EXT-X-MAP:URI="{init_uri}"')
+    for index, ((msn, group), duration) in enumerate(zip(groups, segment_durations)):
+        last = index == len(groups) - 1
+        if index >= len(groups) - PART_SEGMENTS - 1:
+            # Every part starts on a keyframe
+            lines += [
+                f'#EXT-X-PART:DURATION={part.duration:.5f},URI="{part.uri}",INDEPENDENT=YES' for part in group
+            ]
+        if not last or len(group) == parts_per_segment:
+            lines += [f"#EXTINF:{duration:.5f},", segment_name(prefix, msn)]
+    next_part = parts[-1].sequence + 1 if parts else 0
+    lines.append(f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="{part_name(prefix, next_part)}"')
+    return "\n".join(lines) + "\n"
+
+
+class LowLatencyHLS:
+    """
+    Serves the LL-HLS files of low-latency tunnels from a SegmentStore.
+    """
+
+    def __init__(self, store, listener, parts_per_segment=LL_HLS_PARTS_PER_SEGMENT, block_timeout=LL_HLS_BLOCK_TIMEOUT):
+        """
+        :param listener: ReadinessListener of the tunnels whose playlist was written
+        """
+        self.store = store
+        self.listener = listener
+        self.parts_per_segment = parts_per_segment
+        self.block_timeout = block_timeout
+
+    def get(self, name, msn=None, part=None):
+        """
+        Returns the HLSFile of an LL-HLS file, or None if name is not one (e.g. the playlist of a
+        tunnel that is not in low-latency mode). A playlist request with msn (and part) set is
+        held until the playlist holds that segment (or part), a part from a preload hint until
+        it was written, at most block_timeout seconds.
+
+        :param msn: Media sequence number of _HLS_msn
+        :param part: Part index of _HLS_part
+        :raises BlockingRequestError: For a blocking request more than two segments ahead
+        """
+        match = HLS_FILE_NAME.match(name)
+        if match is None or match.group("rendition") is not None:
+            return None
+        if match.group("kind") == "s":
+            return self.segment(name[:match.start("kind") - 1], int(match.group("sequence")))
+        if match.group("kind") == "p":
+            return self.part(name, name[:match.start("kind") - 1], int(match.group("sequence")))
+        if match.group("sequence") is None and match.group("init") is None:
+            return self.playlist(name, msn, part)
+        return None
+
+    def parts(self, name):
+        parts_file = self.store.get(parts_playlist_name(name))
+        if parts_file is None:
+            return None
+        return parse_parts_playlist(parts_file.data.decode())
+
+    def playlist(self, name, msn=None, part=None):
+        parsed = self.parts(name)
+        if parsed is None:
+            return None
+        if msn is not None:
+            parsed = self.wait_for_part(name, parsed, msn, part)
+        text = render_playlist(name, *parsed, parts_per_segment=self.parts_per_segment)
+        return HLSFile(text.encode(), "application/vnd.apple.mpegurl", None)
+
+    def wait_for_part(self, name, parsed, msn, part):
+        """
+        Waits until the parts playlist of name lists the given part of segment msn, or all parts
+        of that segment if part is None.
+
+        :return: The parsed parts playlist at that point, or the latest one on timeout
+        """
+        wanted = msn * self.parts_per_segment + (self.parts_per_segment - 1 if part is None else part)
+        _, parts = parsed
+        last = parts[-1].sequence if parts else -1
+        if msn > last // self.parts_per_segment + 2:
+            raise BlockingRequestError(f"Segment {msn} is too far ahead of the live edge")
+
+        def check():
+            current = self.parts(name)
+            if current is not None and current[1] and current[1][-1].sequence >= wanted:
+                return current
+            return None
+
+        return self.wait(name, check) or self.parts(name) or parsed
+
+    def part(self, name, prefix, sequence):
+        hls_file = self.store.get(name)
+        if hls_file is not None:
+            return hls_file
+        # Only the part the preload hint points at is waited for
+        parsed = self.parts(prefix)
+        if parsed is None or sequence != (parsed[1][-1].sequence + 1 if parsed[1] else 0):
+            return None
+        return self.wait(name, lambda: self.store.get(name))
+
+    def wait(self, name, check):
+        """
+        Waits until check returns something other than None, checking again whenever the tunnel
+        of file name wrote its playlist, for at most block_timeout seconds.
+        """
+        tunnel_id = int(HLS_FILE_NAME.match(name).group("tunnel"))
+        return self.listener.wait(tunnel_id, check, self.block_timeout)
+
+    def segment(self, prefix, msn):
+        """
+        Assembles segment msn from its parts; fMP4 fragments concatenate into a valid segment.
+        """
+        first = msn * self.parts_per_segment
+        parts = [self.store.get(part_name(prefix, sequence)) for sequence in range(first, first + self.parts_per_segment)]
+        if any(part is None for part in parts):
+            return None
+        return HLSFile(b"".join(part.data for part in parts), "video/iso.segment", None)
+
+
+low_latency_hls = LowLatencyHLS(segment_store, ReadinessListener(LL_HLS_RECHECK_INTERVAL, PLAYLIST_CHANNEL))
@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+
+from ....settings import AMT_RELAY_STATE, BASE_DIR, HLS_ROOT, LL_HLS_PART_SECONDS, TRANSCODE_POLICY
+from ..amt.constants import DEFAULT_RELAY
+from .ffmpeg import ffmpeg_input_args, tunnel_transport, tunnel_transport_args
+from .llhls import parts_playlist_name
+from .transcode import (
+    choose_ladder,
+    choose_media_mode,
+    codec_args,
+    hls_output_args,
+    ladder_args,
+    ladder_rungs,
+    ll_hls_output_args,
+    probe_command,
+)
+from .tunnel_stats import tunnel_stats_path
+
+
+def tunnel_relay(tunnel):
+    return tunnel.stream.amt_relay or DEFAULT_RELAY
+
+
+def tunnel_command(tunnel):
+    """
+    Returns the command line of the amt/tunnel.py process of a tunnel.
+    """
+    # Start the interpreter of this (already resolved) environment directly; "pipenv run"
+    # resolves the environment again on every launch and delays the first AMT Discovery
+    return [
+        sys.executable,
+        os.path.join(BASE_DIR, "apps", "view", "amt", "tunnel.py"),
+        tunnel_relay(tunnel),
+        tunnel.stream.source,
+        tunnel.stream.group,
+        str(tunnel.get_amt_port_number()),
+        str(tunnel.get_udp_port_number()),
+        "--relay-state", AMT_RELAY_STATE,
+        "--stats-path", tunnel_stats_path(tunnel.id),
+        *tunnel_transport_args(tunnel.id),
+    ]
+
+
+def tunnel_log_path(tunnel):
+    log_file_path = os.path.join(BASE_DIR, "logs", "tunnels", f"tunnel_{tunnel.id}_{int(time.time())}.log")
+    os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
+    return log_file_path
+
+
+def playlist_path(tunnel):
+    """
+    Returns the path of the (master) playlist ffmpeg writes for a tunnel.
+    """
+    os.makedirs(HLS_ROOT, exist_ok=True)
+    return os.path.join(HLS_ROOT, tunnel.get_filename())
+
+
+def needs_probe(tunnel):
+    """
+    Whether the packaging of a tunnel depends on a probe of its input.
+    """
+    # ffprobe would consume the data of a named pipe or unix socket before ffmpeg reads it; streams
+    # handed off that way are packaged as if their input could not be probed
+    if tunnel_transport() != "udp":
+        return False
+    ladder = tunnel.stream.uses_abr_ladder() and not tunnel.stream.low_latency
+    return ladder or TRANSCODE_POLICY == "auto"
+
+
+def tunnel_probe_command(tunnel):
+    return probe_command(tunnel.id, tunnel.get_udp_port_number())
+
+
+def ffmpeg_plan(tunnel, probe):
+    """
+    Decides how a tunnel is packaged and builds the ffmpeg command doing it: sources browsers can
+    play as they are are not re-encoded, popular streams get an adaptive-bitrate ladder and
+    low-latency streams a single rendition in low-latency HLS.
+
+    :param probe: MediaProbe of the input, or None
+    :return: (MediaDecision, ffmpeg command, path of the playlist ffmpeg writes once it is up)
+    """
+    output_file = playlist_path(tunnel)
+    playlist = output_file
+    if tunnel.stream.low_latency:
+        # The low-latency mode packages a single rendition, so it takes precedence over the ladder
+        decision = choose_media_mode(probe)
+        decision = decision._replace(reason=f"{decision.reason} (low-latency HLS)"[:255])
+        output_args = [*codec_args(decision, LL_HLS_PART_SECONDS), *ll_hls_output_args(output_file)]
+        # ffmpeg only writes the playlist of parts; the LL-HLS playlist is built from it
+        playlist = parts_playlist_name(output_file)
+    elif tunnel.stream.uses_abr_ladder():
+        rungs = ladder_rungs(probe)
+        decision = choose_ladder(probe, rungs)
+        output_args = ladder_args(decision, rungs, probe, output_file)
+    else:
+        decision = choose_media_mode(probe)
+        output_args = [*codec_args(decision), *hls_output_args(output_file)]
+    command = ["ffmpeg", *ffmpeg_input_args(tunnel.id, tunnel.get_udp_port_number()), *output_args]
+    return decision, command, playlist
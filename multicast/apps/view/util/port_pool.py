@@ -0,0 +1,123 @@
+import time
+
+from ....settings import AMT_PORT_BASE, PORT_LEASE_TTL, PORT_POOL_SIZE, PORT_REUSE_DELAY, UDP_PORT_BASE
+from .viewer_leases import redis_client
+
+# Slot i of the pool is the port pair (AMT_PORT_BASE + i, UDP_PORT_BASE + i).
+# Sorted set: slot -> expiry of its lease (Unix time). A released slot keeps a score of
+# PORT_REUSE_DELAY seconds ahead, so the sockets of a stopping tunnel are closed before its ports
+# are handed out again. A slot is free once its score is in the past.
+LEASES_KEY = "port-pool:leases"
+# Hash: slot -> ID of the tunnel holding it
+OWNERS_KEY = "port-pool:owners"
+# Hash: tunnel ID -> slot it was last given
+TUNNELS_KEY = "port-pool:tunnels"
+
+# Gives the tunnel (ARGV[1]) the slot it holds, or the lowest free one, until ARGV[3]
+LEASE_SCRIPT = """
+local tunnel, now, expiry, size = ARGV[1], tonumber(ARGV[2]), ARGV[3], tonumber(ARGV[4])
+local slot = redis.call("HGET", KEYS[3], tunnel)
+if slot and redis.call("HGET", KEYS[2], slot) == tunnel then
+    redis.call("ZADD", KEYS[1], expiry, slot)
+    return tonumber(slot)
+end
+for i = 0, size - 1 do
+    local score = redis.call("ZSCORE", KEYS[1], i)
+    if not score or tonumber(score) <= now then
+        redis.call("ZADD", KEYS[1], expiry, i)
+        redis.call("HSET", KEYS[2], i, tunnel)
+        redis.call("HSET", KEYS[3], tunnel, i)
+        return i
+    end
+end
+return -1
+"""
+
+# Releases the slot of the tunnel (ARGV[1]) if it still holds it
+RELEASE_SCRIPT = """
+local tunnel = ARGV[1]
+local slot = redis.call("HGET", KEYS[3], tunnel)
+redis.call("HDEL", KEYS[3], tunnel)
+if slot and redis.call("HGET", KEYS[2], slot) == tunnel then
+    redis.call("HDEL", KEYS[2], slot)
+    redis.call("ZADD", KEYS[1], ARGV[2], slot)
+    return 1
+end
+return 0
+"""
+
+
+class PortPoolExhausted(Exception):
+    """
+    Raised when every port pair of the pool is leased.
+    """
+
+
+class PortsNotLeased(Exception):
+    """
+    Raised when the ports of a tunnel are asked for before it was leased a pair (see lease_ports).
+    """
+
+
+def slot_ports(slot):
+    """
+    :return: (AMT port, UDP port) of a slot of the pool
+    """
+    return AMT_PORT_BASE + slot, UDP_PORT_BASE + slot
+
+
+def lease_ports(tunnel_id, ttl=PORT_LEASE_TTL):
+    """
+    Leases a port pair to a tunnel, or extends the lease of the pair it holds.
+
+    :param ttl: Seconds the lease lasts unless it is renewed (see renew_ports)
+    :return: (AMT port, UDP port)
+    :raises PortPoolExhausted: If no pair is free
+    """
+    now = time.time()
+    slot = redis_client().eval(
+        LEASE_SCRIPT, 3, LEASES_KEY, OWNERS_KEY, TUNNELS_KEY, tunnel_id, now, now + ttl, PORT_POOL_SIZE,
+    )
+    if slot < 0:
+        raise PortPoolExhausted(f"All {PORT_POOL_SIZE} port pairs are leased")
+    return slot_ports(slot)
+
+
+def renew_ports(tunnel_id, ttl=PORT_LEASE_TTL):
+    """
+    Extends the lease of the port pair of a tunnel, if it still holds one.
+
+    :return: True if it does
+    """
+    client = redis_client()
+    slot = client.hget(TUNNELS_KEY, tunnel_id)
+    if slot is None or client.hget(OWNERS_KEY, slot) != str(tunnel_id).encode():
+        return False
+    client.zadd(LEASES_KEY, {slot: time.time() + ttl}, xx=True)
+    return True
+
+
+def release_ports(tunnel_id):
+    """
+    Returns the port pair of a tunnel to the pool, after PORT_REUSE_DELAY seconds.
+
+    :return: True if the tunnel held one
+    """
+    released = redis_client().eval(
+        RELEASE_SCRIPT, 3, LEASES_KEY, OWNERS_KEY, TUNNELS_KEY, tunnel_id, time.time() + PORT_REUSE_DELAY,
+    )
+    return bool(released)
+
+
+def leased_tunnels():
+    """
+    :return: {tunnel ID: (AMT port, UDP port)} of the tunnels holding a port pair, expired or not
+    """
+    return {int(tunnel_id): slot_ports(int(slot)) for slot, tunnel_id in redis_client().hgetall(OWNERS_KEY).items()}
+
+
+def pool_usage():
+    """
+    :return: (port pairs leased or waiting to be reused, size of the pool)
+    """
+    return redis_client().zcount(LEASES_KEY, f"({time.time()}", "+inf"), PORT_POOL_SIZE
@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+from ....settings import READINESS_RECHECK_INTERVAL
+from .viewer_leases import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Redis pub/sub channel the media supervisor announces the IDs of tunnels on, once ffmpeg wrote
+# their first segment
+READY_CHANNEL = "tunnel-ready"
+# Seconds to wait before subscribing again after the connection to Redis was lost
+RESUBSCRIBE_DELAY = 1.0
+
+
+def publish_ready(tunnel_id):
+    """
+    Wakes the viewers waiting for a tunnel in every web process.
+    """
+    try:
+        redis_client().publish(READY_CHANNEL, tunnel_id)
+    except RedisError as e:
+        # The waiting viewers find out on their next recheck
+        logger.warning(f"Failed to announce tunnel {tunnel_id} as ready: {e}")
+
+
+class ReadinessListener:
+    """
+    Subscribes a web process to a channel of tunnel IDs (READY_CHANNEL by default) once, in a
+    background thread, and wakes the request threads waiting for the announced tunnels.
+    """
+
+    def __init__(self, recheck_interval=READINESS_RECHECK_INTERVAL, channel=READY_CHANNEL):
+        """
+        :param recheck_interval: Seconds between two checks of a waiting request, in case an
+            announcement was missed (e.g. while Redis was unreachable)
+        """
+        self.recheck_interval = recheck_interval
+        self.channel = channel
+        # Tunnel ID -> events of the requests waiting for it
+        self.waiters = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.listen, name=f"{self.channel}-listener", daemon=True)
+                self.thread.start()
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = redis_client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.wake(int(message["data"]))
+            except (RedisError, OSError, ValueError) as e:
+                logger.warning(f"Subscription to {self.channel} lost: {e}")
+                time.sleep(RESUBSCRIBE_DELAY)
+
+    def wake(self, tunnel_id):
+        with self.lock:
+            for event in self.waiters.get(tunnel_id, ()):
+                event.set()
+
+    def wait(self, tunnel_id, check, timeout):
+        """
+        Waits until check returns something other than None, checking again whenever the tunnel
+        is announced and every recheck_interval seconds, for at most timeout seconds.
+
+        :return: The last result of check
+        """
+        self.start()
+        event = threading.Event()
+        with self.lock:
+            self.waiters.setdefault(tunnel_id, []).append(event)
+        try:
+            deadline = time.monotonic() + timeout
+            # Checking after registering, an announcement in between is not lost
+            result = check()
+            while result is None and time.monotonic() < deadline:
+                event.wait(min(self.recheck_interval, max(deadline - time.monotonic(), 0)))
+                event.clear()
+                result = check()
+            return result
+        finally:
+            with self.lock:
+                self.waiters[tunnel_id].remove(event)
+                if not self.waiters[tunnel_id]:
+                    del self.waiters[tunnel_id]
+
+
+readiness_listener = ReadinessListener()
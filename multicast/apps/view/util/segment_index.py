@@ -0,0 +1,271 @@
+import collections
+import json
+import logging
+import os
+import time
+
+from redis.exceptions import RedisError
+
+from ....settings import HLS_ROOT, HLS_STORE_SEGMENTS
+from .inotify import IN_CLOSE_WRITE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW, Inotify
+from .segment_store import HLS_FILE_NAME
+from .viewer_leases import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Hash of the indexed files of a tunnel: playlist_mtime and first_segment_at (Unix time), the
+# names of its latest segments (JSON, oldest first) and its number of files
+INDEX_KEY = "segment-index:{}"
+# Set of the IDs of the tunnels in the index
+TUNNELS_KEY = "segment-index:tunnels"
+# Present while a media supervisor keeps the index; without it, readers look at the files
+ALIVE_KEY = "segment-index:alive"
+ALIVE_TTL = 10
+HEARTBEAT_INTERVAL = 3
+# Redis pub/sub channel the IDs of tunnels are announced on whenever their playlist was written,
+# waking the blocking LL-HLS requests waiting for it (util/llhls.py)
+PLAYLIST_CHANNEL = "segment-index:playlist-written"
+
+TEMPORARY_SUFFIX = ".tmp"
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+
+
+class TunnelFiles:
+    def __init__(self, segments):
+        self.names = set()
+        self.playlist_mtime = None
+        self.first_segment_at = None
+        self.segments = collections.deque(maxlen=segments)
+
+    def entry(self):
+        return {
+            "playlist_mtime": self.playlist_mtime or "",
+            "first_segment_at": self.first_segment_at or "",
+            "segments": json.dumps(list(self.segments)),
+            "files": len(self.names),
+        }
+
+
+def match_name(name):
+    """
+    Matches the name of an HLS file, or of the temporary file ffmpeg writes it as (-hls_flags temp_file).
+    """
+    if name.endswith(TEMPORARY_SUFFIX):
+        name = name[:-len(TEMPORARY_SUFFIX)]
+    return HLS_FILE_NAME.match(name)
+
+
+def is_playlist(match):
+    # The main playlist, or the playlist of parts of a low-latency tunnel
+    return match.group("sequence") is None and match.group("init") is None and match.group("rendition") in (None, "parts")
+
+
+class SegmentIndex:
+    """
+    Index of the HLS files of all tunnels in HLS_ROOT, kept up to date from inotify events by the
+    media supervisor and mirrored to Redis, so that the web processes learn whether a stream has
+    its first segment with one Redis read instead of listing the directory.
+    """
+
+    def __init__(self, root=HLS_ROOT, segments=HLS_STORE_SEGMENTS):
+        """
+        :param segments: Latest segments kept per tunnel
+        """
+        self.root = root
+        self.segments = segments
+        # Tunnel ID -> TunnelFiles
+        self.tunnels = {}
+        self.inotify = None
+        self.next_heartbeat = 0
+
+    def start(self):
+        """
+        Starts watching the directory and indexes the files already in it.
+
+        :return: The Inotify instance to register with a selector
+        :raises OSError: If inotify is not available
+        """
+        os.makedirs(self.root, exist_ok=True)
+        self.inotify = Inotify()
+        self.inotify.add_watch(self.root, WATCH_MASK)
+        self.rescan()
+        return self.inotify
+
+    def stop(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        try:
+            redis_client().delete(ALIVE_KEY)
+        except RedisError:
+            pass
+
+    def rescan(self):
+        """
+        Rebuilds the index from the directory, e.g. after the kernel dropped events.
+        """
+        self.tunnels = {}
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                try:
+                    self.added(entry.name, entry.stat().st_mtime)
+                except OSError:
+                    pass
+        try:
+            stale = {int(tunnel_id) for tunnel_id in redis_client().smembers(TUNNELS_KEY)} - set(self.tunnels)
+            pipeline = redis_client().pipeline()
+            for tunnel_id in stale:
+                pipeline.delete(INDEX_KEY.format(tunnel_id))
+                pipeline.srem(TUNNELS_KEY, tunnel_id)
+            pipeline.execute()
+        except RedisError as e:
+            logger.warning(f"Failed to clear the segment index: {e}")
+        self.publish(self.tunnels)
+
+    def handle(self, inotify):
+        """
+        Applies the pending events.
+
+        :return: IDs of the tunnels whose playlist was written
+        """
+        written = set()
+        changed = set()
+        now = time.time()
+        for event in inotify.read():
+            if event.mask & IN_Q_OVERFLOW:
+                logger.warning("Segment index lost events, rescanning")
+                self.rescan()
+                return set(self.tunnels)
+            if event.mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                tunnel_id, playlist = self.added(event.name, now)
+                if playlist:
+                    written.add(tunnel_id)
+            else:
+                tunnel_id = self.removed(event.name)
+            if tunnel_id is not None:
+                changed.add(tunnel_id)
+        self.publish(changed, written)
+        return written
+
+    def added(self, name, mtime):
+        """
+        :return: (tunnel ID or None if name is not an HLS file, whether it is its playlist)
+        """
+        match = match_name(name)
+        if match is None:
+            return None, False
+        tunnel_id = int(match.group("tunnel"))
+        files = self.tunnels.setdefault(tunnel_id, TunnelFiles(self.segments))
+        files.names.add(name)
+        if name.endswith(TEMPORARY_SUFFIX):
+            # Only kept to be removed with the others
+            return tunnel_id, False
+        if match.group("sequence") is not None:
+            if name not in files.segments:
+                files.segments.append(name)
+            if files.first_segment_at is None:
+                files.first_segment_at = mtime
+            return tunnel_id, False
+        if is_playlist(match):
+            files.playlist_mtime = mtime
+            return tunnel_id, True
+        return tunnel_id, False
+
+    def removed(self, name):
+        match = match_name(name)
+        if match is None:
+            return None
+        tunnel_id = int(match.group("tunnel"))
+        files = self.tunnels.get(tunnel_id)
+        if files is None:
+            return None
+        files.names.discard(name)
+        if name in files.segments:
+            files.segments.remove(name)
+        if is_playlist(match) and not name.endswith(TEMPORARY_SUFFIX):
+            files.playlist_mtime = None
+        return tunnel_id
+
+    def first_segment_at(self, tunnel_id):
+        files = self.tunnels.get(tunnel_id)
+        return files.first_segment_at if files is not None else None
+
+    def files(self, tunnel_id):
+        """
+        :return: Names of the files of a tunnel
+        """
+        files = self.tunnels.get(tunnel_id)
+        return sorted(files.names) if files is not None else []
+
+    def publish(self, tunnel_ids, written=()):
+        """
+        :param written: IDs of the tunnels whose playlist was written, announced on PLAYLIST_CHANNEL
+        """
+        try:
+            pipeline = redis_client().pipeline()
+            for tunnel_id in list(tunnel_ids):
+                files = self.tunnels.get(tunnel_id)
+                if files is not None and not files.names:
+                    del self.tunnels[tunnel_id]
+                    files = None
+                pipeline.delete(INDEX_KEY.format(tunnel_id))
+                if files is None:
+                    pipeline.srem(TUNNELS_KEY, tunnel_id)
+                else:
+                    pipeline.hset(INDEX_KEY.format(tunnel_id), mapping=files.entry())
+                    pipeline.sadd(TUNNELS_KEY, tunnel_id)
+            pipeline.set(ALIVE_KEY, 1, ex=ALIVE_TTL)
+            for tunnel_id in written:
+                pipeline.publish(PLAYLIST_CHANNEL, tunnel_id)
+            pipeline.execute()
+        except RedisError as e:
+            logger.warning(f"Failed to update the segment index: {e}")
+
+    def heartbeat(self):
+        now = time.monotonic()
+        if now < self.next_heartbeat:
+            return
+        self.next_heartbeat = now + HEARTBEAT_INTERVAL
+        try:
+            redis_client().set(ALIVE_KEY, 1, ex=ALIVE_TTL)
+        except RedisError as e:
+            logger.warning(f"Failed to refresh the segment index: {e}")
+
+
+def tunnel_index(tunnel_id):
+    """
+    Reads the index of the files of a tunnel.
+
+    :return: {"playlist_mtime": ..., "first_segment_at": ..., "segments": [...], "files": ...}, with
+        empty times for what was not written yet, {} for a tunnel without files, or None if no
+        supervisor keeps the index
+    """
+    pipeline = redis_client().pipeline()
+    pipeline.exists(ALIVE_KEY)
+    pipeline.hgetall(INDEX_KEY.format(tunnel_id))
+    alive, entry = pipeline.execute()
+    if not alive:
+        return None
+    if not entry:
+        return {}
+    entry = {key.decode(): value.decode() for key, value in entry.items()}
+    return {
+        "playlist_mtime": float(entry["playlist_mtime"]) if entry["playlist_mtime"] else None,
+        "first_segment_at": float(entry["first_segment_at"]) if entry["first_segment_at"] else None,
+        "segments": json.loads(entry["segments"]),
+        "files": int(entry["files"]),
+    }
+
+
+def first_segment_written(tunnel_id):
+    """
+    :return: Whether a tunnel has its playlist and a first segment, or None if no supervisor
+        keeps the index
+    """
+    try:
+        entry = tunnel_index(tunnel_id)
+    except RedisError:
+        return None
+    if entry is None:
+        return None
+    return bool(entry) and entry["playlist_mtime"] is not None and entry["first_segment_at"] is not None
@@ -0,0 +1,135 @@
+import collections
+import os
+import re
+import threading
+
+from ....settings import HLS_ROOT, HLS_STORE_MAX_BYTES, HLS_STORE_SEGMENTS, LL_HLS_PARTS_PER_SEGMENT
+
+# Names ffmpeg gives the live files of a tunnel (see hls_output_args and ll_hls_output_args): the
+# playlist index<tunnel id>-.m3u8, and the variant playlists, numbered segments, low-latency parts
+# ("_p" sequence) and fMP4 initialization segment named after it. "_s" sequences are the segments
+# util/llhls.py assembles from parts. Anything else, including the .tmp files ffmpeg is still
+# writing, is not served.
+HLS_FILE_NAME = re.compile(
+    r"^index(?P<tunnel>\d+)-\.m3u8(?:_(?P<rendition>[A-Za-z0-9]+))??"
+    r"(?:_(?P<kind>[ps])?(?P<sequence>\d+)(?P<extension>\.ts|\.m4s)|_init(?P<init>\.mp4)|\.m3u8)?$"
+)
+CONTENT_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".ts": "video/mp2t",
+    ".m4s": "video/iso.segment",
+    ".mp4": "video/mp4",
+}
+
+# Cached file: its bytes, its content type and the (inode, size, mtime) it was read at
+HLSFile = collections.namedtuple("HLSFile", ["data", "content_type", "stamp"])
+
+
+def file_stamp(stat):
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class SegmentStore:
+    """
+    Serves the live HLS files of the tunnels from memory: the playlists and the last few
+    segments of every rendition. Every read checks the file is still the one cached (a stat on
+    tmpfs), so a restarted ffmpeg reusing segment names is never served stale data, and a
+    stopped tunnel whose files were removed is evicted on its next request.
+    """
+
+    def __init__(self, root=HLS_ROOT, segments=HLS_STORE_SEGMENTS, max_bytes=HLS_STORE_MAX_BYTES):
+        """
+        :param root: Directory ffmpeg writes the HLS files to
+        :param segments: Segments kept per rendition of a tunnel (LL_HLS_PARTS_PER_SEGMENT times as many parts)
+        :param max_bytes: Most bytes kept in total; the least recently read files go first
+        """
+        self.root = root
+        self.segments = segments
+        self.max_bytes = max_bytes
+        # File name -> HLSFile, least recently read first
+        self.files = collections.OrderedDict()
+        # (tunnel ID, rendition, kind) -> names of its cached segments or parts, oldest first
+        self.windows = collections.defaultdict(collections.deque)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Returns the HLSFile of a live HLS file, or None if there is no such file.
+
+        :param name: File name, e.g. "index7-.m3u8" or "index7-.m3u8_042.ts"
+        """
+        match = HLS_FILE_NAME.match(name)
+        if match is None:
+            return None
+        path = os.path.join(self.root, name)
+        try:
+            stamp = file_stamp(os.stat(path))
+        except OSError:
+            self.forget(name, match)
+            return None
+
+        with self.lock:
+            cached = self.files.get(name)
+            if cached is not None and cached.stamp == stamp:
+                self.files.move_to_end(name)
+                return cached
+
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+                stamp = file_stamp(os.fstat(file.fileno()))
+        except OSError:
+            self.forget(name, match)
+            return None
+        content_type = CONTENT_TYPES[match.group("extension") or match.group("init") or ".m3u8"]
+        hls_file = HLSFile(data, content_type, stamp)
+        # A file that changed while it was read is served but not kept
+        if len(data) == stamp[1]:
+            with self.lock:
+                self.add(name, match, hls_file)
+        return hls_file
+
+    def add(self, name, match, hls_file):
+        self.discard(name)
+        self.files[name] = hls_file
+        self.size += len(hls_file.data)
+        if match.group("sequence") is not None:
+            window = self.windows[(match.group("tunnel"), match.group("rendition"), match.group("kind"))]
+            if name not in window:
+                window.append(name)
+            limit = self.segments * LL_HLS_PARTS_PER_SEGMENT if match.group("kind") == "p" else self.segments
+            while len(window) > limit:
+                self.discard(window.popleft())
+        while self.size > self.max_bytes and self.files:
+            self.discard(next(iter(self.files)))
+
+    def discard(self, name):
+        hls_file = self.files.pop(name, None)
+        if hls_file is not None:
+            self.size -= len(hls_file.data)
+
+    def forget(self, name, match):
+        """
+        Drops a file that no longer exists. A missing main playlist means the tunnel stopped, so
+        all its files go.
+        """
+        if name == f"index{match.group('tunnel')}-.m3u8":
+            self.evict_tunnel(int(match.group("tunnel")))
+            return
+        with self.lock:
+            self.discard(name)
+
+    def evict_tunnel(self, tunnel_id):
+        """
+        Drops all cached files of a tunnel.
+        """
+        tunnel = str(tunnel_id)
+        with self.lock:
+            for name in [name for name in self.files if HLS_FILE_NAME.match(name).group("tunnel") == tunnel]:
+                self.discard(name)
+            for key in [key for key in self.windows if key[0] == tunnel]:
+                del self.windows[key]
+
+
+segment_store = SegmentStore()
@@ -0,0 +1,42 @@
+from ....settings import MEDIA_SUPERVISOR_SOCKET, MEDIA_SUPERVISOR_TIMEOUT
+from .jsonl_client import jsonl_request
+
+
+class SupervisorError(Exception):
+    """
+    Raised when the media supervisor rejects a request.
+    """
+
+
+def supervisor_request(request, socket_path=None, timeout=MEDIA_SUPERVISOR_TIMEOUT):
+    """
+    Sends one JSON request to the media supervisor and returns the result of its reply.
+
+    :param request: Request dictionary, e.g. {"op": "list"}
+    :param socket_path: Path of the supervisor's control socket (defaults to MEDIA_SUPERVISOR_SOCKET)
+    :param timeout: Socket timeout in seconds
+    :return: The "result" member of the reply
+    """
+    return jsonl_request(request, socket_path or MEDIA_SUPERVISOR_SOCKET, timeout, SupervisorError, "media supervisor")
+
+
+def start_process(tunnel_id, process):
+    """
+    Asks the supervisor to run (and keep running) one process of a tunnel.
+
+    :param process: "tunnel" or "ffmpeg"
+    """
+    return supervisor_request({"op": "start", "id": tunnel_id, "process": process})
+
+
+def stop_processes(tunnel_id, purge=True):
+    """
+    Asks the supervisor to stop the processes of a tunnel.
+
+    :param purge: Also remove the HLS files once ffmpeg exited
+    """
+    return supervisor_request({"op": "stop", "id": tunnel_id, "purge": purge})
+
+
+def list_processes():
+    return supervisor_request({"op": "list"})
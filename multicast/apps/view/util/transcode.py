@@ -0,0 +1,263 @@
+import json
+import os
+import time
+from collections import namedtuple
+
+from ....settings import (
+    HLS_LADDER,
+    HLS_LADDER_AUDIO_ONLY,
+    LL_HLS_PART_SECONDS,
+    LL_HLS_PARTS_PER_SEGMENT,
+    MEDIA_PROBE_DURATION,
+    REMUX_MAX_BITRATE,
+    REMUX_MAX_HEIGHT,
+    TRANSCODE_POLICY,
+)
+from .ffmpeg import ffmpeg_input_args
+from .llhls import parts_playlist_name
+
+TRANSCODE_POLICIES = ("auto", "remux", "transcode")
+# H.264 that HLS players decode as it is: 8-bit 4:2:0 in one of these profiles
+REMUX_H264_PROFILES = {"Constrained Baseline", "Baseline", "Main", "High"}
+REMUX_PIXEL_FORMATS = {"yuv420p", "yuvj420p"}
+
+# Profile of the transcoded streams
+TRANSCODE_VIDEO_ARGS = [
+    "-c:v", "libx264", "-preset", "veryfast", "-tune", "zerolatency",
+    "-profile:v", "main", "-level", "3.1",
+    "-b:v", "2000k",
+    "-maxrate", "2500k",
+    "-bufsize", "4000k",
+]
+TRANSCODE_AUDIO_ARGS = ["-c:a", "aac", "-b:a", "128k"]
+
+HLS_SEGMENT_SECONDS = 4
+HLS_ARGS = [
+    "-f", "hls",
+    "-hls_time", str(HLS_SEGMENT_SECONDS),
+    "-hls_list_size", "5",
+    # temp_file: segments get their name once complete, so that readers never see a partial one
+    "-hls_flags", "delete_segments+append_list+discont_start+temp_file",
+    "-hls_delete_threshold", "1",
+    "-hls_segment_type", "mpegts",
+]
+
+MediaProbe = namedtuple(
+    "MediaProbe", ["video_codec", "profile", "pix_fmt", "width", "height", "audio_codec", "bitrate"]
+)
+MediaDecision = namedtuple("MediaDecision", ["mode", "reason", "copy_audio"])
+
+
+def parse_probe(output):
+    """
+    Extracts the first video and audio stream from the JSON output of ffprobe -show_streams -show_format.
+
+    :return: MediaProbe; fields ffprobe could not determine are None
+    """
+    info = json.loads(output)
+    streams = info.get("streams", [])
+    video = next((stream for stream in streams if stream.get("codec_type") == "video" and stream.get("width")), {})
+    audio = next((stream for stream in streams if stream.get("codec_type") == "audio"), {})
+    bitrate = video.get("bit_rate") or info.get("format", {}).get("bit_rate")
+    return MediaProbe(
+        video.get("codec_name"),
+        video.get("profile"),
+        video.get("pix_fmt"),
+        video.get("width"),
+        video.get("height"),
+        audio.get("codec_name"),
+        int(bitrate) if bitrate and str(bitrate).isdigit() else None,
+    )
+
+
+def probe_command(tunnel_id, udp_port, duration=MEDIA_PROBE_DURATION):
+    """
+    Returns the ffprobe command analysing up to duration seconds of the input of a tunnel; its
+    output is read with parse_probe().
+    """
+    return [
+        "ffprobe", "-v", "error",
+        "-analyzeduration", str(int(duration * 1_000_000)),
+        "-show_streams", "-show_format", "-of", "json",
+        *ffmpeg_input_args(tunnel_id, udp_port),
+    ]
+
+
+def describe_probe(probe):
+    video = probe.video_codec or "no video"
+    if probe.height:
+        video = " ".join(filter(None, (video, probe.profile, f"{probe.width}x{probe.height}")))
+    bitrate = f", {probe.bitrate / 1e6:.1f} Mbit/s" if probe.bitrate else ""
+    return f"{video}, {probe.audio_codec or 'no audio'}{bitrate}"
+
+
+def remux_refusal(probe):
+    """
+    Returns why a probed source cannot be remuxed, or None if it can.
+    """
+    if probe.video_codec is None:
+        return "no video stream found"
+    if probe.video_codec != "h264":
+        return f"{probe.video_codec} video needs transcoding to H.264"
+    if probe.profile not in REMUX_H264_PROFILES:
+        return f"H.264 {probe.profile} profile is not widely playable"
+    if probe.pix_fmt not in REMUX_PIXEL_FORMATS:
+        return f"{probe.pix_fmt} pixels are not widely playable"
+    if probe.height and probe.height > REMUX_MAX_HEIGHT:
+        return f"{probe.height}p is above the {REMUX_MAX_HEIGHT}p limit"
+    if probe.bitrate and probe.bitrate > REMUX_MAX_BITRATE:
+        return f"bitrate is above the {REMUX_MAX_BITRATE / 1e6:.0f} Mbit/s limit"
+    return None
+
+
+def choose_media_mode(probe, policy=TRANSCODE_POLICY):
+    """
+    Decides whether a stream is packaged as it is (remux) or re-encoded (transcode).
+
+    :param probe: MediaProbe of the input, or None if it was not (or could not be) probed
+    :param policy: One of TRANSCODE_POLICIES
+    :return: MediaDecision with the mode, the reason and whether the audio is copied
+    """
+    if policy not in TRANSCODE_POLICIES:
+        raise ValueError(f"Unknown TRANSCODE_POLICY {policy!r}, expected one of {TRANSCODE_POLICIES}")
+    # AAC plays in every HLS player; anything else (MPEG audio, AC-3, LATM) is converted
+    copy_audio = probe is not None and probe.audio_codec in ("aac", None)
+    if policy != "auto":
+        return MediaDecision(policy, f"TRANSCODE_POLICY is {policy}", copy_audio)
+    if probe is None:
+        return MediaDecision("transcode", "the input could not be probed", False)
+
+    description = describe_probe(probe)
+    refusal = remux_refusal(probe)
+    if refusal is not None:
+        return MediaDecision("transcode", f"{description}: {refusal}"[:255], copy_audio)
+    audio = "copied" if copy_audio else "converted to AAC"
+    return MediaDecision("remux", f"{description}: video copied, audio {audio}"[:255], copy_audio)
+
+
+def codec_args(decision, keyframe_interval=None):
+    """
+    Returns the ffmpeg codec arguments carrying out a decision.
+
+    :param keyframe_interval: Seconds between forced keyframes of transcoded video, or None for the encoder's choice
+    """
+    video_args = ["-c:v", "copy"] if decision.mode == "remux" else TRANSCODE_VIDEO_ARGS
+    if decision.mode != "remux" and keyframe_interval:
+        video_args = [*video_args, "-force_key_frames", f"expr:gte(t,n_forced*{keyframe_interval})"]
+    audio_args = ["-c:a", "copy"] if decision.copy_audio else TRANSCODE_AUDIO_ARGS
+    return [*video_args, *audio_args]
+
+
+def ladder_rungs(probe, ladder=HLS_LADDER):
+    """
+    Returns the rungs of the ladder worth encoding for a source: those not taller than it, or a
+    single rung at the source height with the bitrate of the lowest rung for a source below all
+    of them. All rungs if the source height is unknown.
+    """
+    if probe is None or not probe.height:
+        return list(ladder)
+    rungs = [rung for rung in ladder if rung[1] <= probe.height]
+    lowest = min(ladder, key=lambda rung: rung[1])
+    return rungs or [(f"{probe.height}p", probe.height, lowest[2])]
+
+
+def has_audio(probe):
+    # Without a probe, assume the usual audio track
+    return probe is None or probe.audio_codec is not None
+
+
+def choose_ladder(probe, rungs, audio_only=HLS_LADDER_AUDIO_ONLY):
+    """
+    Describes the ladder encoded for a source as a MediaDecision.
+    """
+    copy_audio = probe is not None and probe.audio_codec in ("aac", None)
+    names = [rung[0] for rung in rungs] + (["audio"] if audio_only and has_audio(probe) else [])
+    description = describe_probe(probe) if probe is not None else "input not probed"
+    return MediaDecision("ladder", f"{description}: ladder {', '.join(names)}"[:255], copy_audio)
+
+
+def ladder_args(decision, rungs, probe, output_file, audio_only=HLS_LADDER_AUDIO_ONLY):
+    """
+    Returns the ffmpeg output arguments encoding all rungs from one decode: the video is split
+    once and scaled per rung, keyframes are forced on segment boundaries so that players can
+    switch between renditions, and a master playlist named like output_file lists them.
+
+    :param output_file: Path of the master playlist; the variant playlists and segments get it as prefix
+    """
+    audio = has_audio(probe)
+    outputs = "".join(f"[v{index}]" for index in range(len(rungs)))
+    graph = [f"[0:v:0]split={len(rungs)}{outputs}"]
+    graph += [f"[v{index}]scale=-2:{height}[v{index}out]" for index, (_, height, _) in enumerate(rungs)]
+
+    args = ["-filter_complex", ";".join(graph)]
+    variants = []
+    for index, (name, _, bitrate) in enumerate(rungs):
+        args += [
+            "-map", f"[v{index}out]",
+            f"-c:v:{index}", "libx264", f"-b:v:{index}", f"{bitrate}k",
+            f"-maxrate:v:{index}", f"{bitrate * 5 // 4}k", f"-bufsize:v:{index}", f"{bitrate * 2}k",
+        ]
+        variants.append(f"v:{index},a:{index},name:{name}" if audio else f"v:{index},name:{name}")
+    audio_streams = len(rungs) + (1 if audio_only else 0) if audio else 0
+    args += ["-map", "0:a:0"] * audio_streams
+    if audio and audio_only:
+        variants.append(f"a:{len(rungs)},name:audio")
+
+    args += [
+        "-preset", "veryfast", "-tune", "zerolatency", "-profile:v", "main",
+        "-force_key_frames", f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})",
+    ]
+    if audio_streams:
+        args += ["-c:a", "copy"] if decision.copy_audio else TRANSCODE_AUDIO_ARGS
+    return [*args, *hls_output_args(output_file, " ".join(variants))]
+
+
+def segment_start_number(multiple=1):
+    """
+    Returns a first segment number beyond any an earlier ffmpeg of the same tunnel reached, so
+    that segment names are never reused and caches may keep segments for good: milliseconds
+    since the epoch, rounded down to a multiple.
+    """
+    start = int(time.time() * 1000)
+    return start - start % multiple
+
+
+def hls_output_args(output_file, variant_map=None):
+    """
+    Returns the HLS muxer arguments writing output_file, or a master playlist of that name over
+    the variants of variant_map (an ffmpeg -var_stream_map).
+    """
+    args = [*HLS_ARGS, "-start_number", str(segment_start_number())]
+    if variant_map is None:
+        return [*args, "-hls_segment_filename", f"{output_file}_%03d.ts", output_file]
+    return [
+        *args,
+        "-var_stream_map", variant_map,
+        "-master_pl_name", os.path.basename(output_file),
+        "-hls_segment_filename", f"{output_file}_%v_%03d.ts",
+        f"{output_file}_%v.m3u8",
+    ]
+
+
+def ll_hls_output_args(output_file):
+    """
+    Returns the HLS muxer arguments of the low-latency mode: ffmpeg writes CMAF (fMP4) parts and
+    their playlist next to output_file, and util/llhls.py serves the LL-HLS playlist built from it
+    under the name of output_file. ffmpeg cuts on keyframes only, so parts of remuxed streams last
+    a GOP of the source at least.
+    """
+    name = os.path.basename(output_file)
+    return [
+        "-f", "hls",
+        "-hls_time", str(LL_HLS_PART_SECONDS),
+        # The parts of the last four segments
+        "-hls_list_size", str(4 * LL_HLS_PARTS_PER_SEGMENT),
+        "-hls_flags", "delete_segments+temp_file+independent_segments",
+        "-hls_delete_threshold", "1",
+        # Segments start on a part of their own
+        "-start_number", str(segment_start_number(LL_HLS_PARTS_PER_SEGMENT)),
+        "-hls_segment_type", "fmp4",
+        "-hls_fmp4_init_filename", f"{name}_init.mp4",
+        "-hls_segment_filename", f"{output_file}_p%05d.m4s",
+        parts_playlist_name(output_file),
+    ]
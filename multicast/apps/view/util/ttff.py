@@ -0,0 +1,155 @@
+import logging
+import time
+
+from redis.exceptions import RedisError
+
+from ..amt.metrics import LATENCY_BUCKETS, TUNNEL_STAGES, LatencyHistogram, read_stats
+from .tunnel_stats import tunnel_stats_path
+from .viewer_leases import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Stages of the time to first frame of a stream, in order: the watch request that starts its
+# pipeline, the first of its Celery tasks dequeued by a worker, the setup stages of its tunnel
+# (reported through its metrics block), ffmpeg spawned, its playlist written and its first segment
+STAGES = ("watch", "dequeue", *TUNNEL_STAGES, "ffmpeg_spawn", "playlist", "first_segment")
+# Hash of the trace of the current start of a tunnel: stage -> Unix time it was first reached,
+# and its label
+TRACE_KEY = "ttff:{}"
+TRACE_TTL = 600
+# Streams kept running by the warm pool, and the others
+LABELS = ("warm", "cold")
+# Hash of the latency histogram of a stage of the streams of a label: bucket index -> count, and "sum"
+HISTOGRAM_KEY = "ttff-histogram:{}:{}"
+# Time from the watch request to the first segment
+TOTAL = "total"
+
+
+def tunnel_label(tunnel):
+    return "warm" if tunnel.warm else "cold"
+
+
+def begin(tunnel_id, at=None, label="cold"):
+    """
+    Starts the trace of a tunnel whose pipeline a viewer's watch request is starting.
+
+    :param at: Unix time the watch request arrived, now by default
+    :param label: One of LABELS, the histograms the trace is added to
+    """
+    try:
+        pipeline = redis_client().pipeline()
+        pipeline.delete(TRACE_KEY.format(tunnel_id))
+        pipeline.hset(TRACE_KEY.format(tunnel_id), mapping={"watch": at or time.time(), "label": label})
+        pipeline.expire(TRACE_KEY.format(tunnel_id), TRACE_TTL)
+        pipeline.execute()
+    except RedisError as e:
+        logger.warning(f"Failed to start the TTFF trace of tunnel {tunnel_id}: {e}")
+
+
+def record(tunnel_id, stage, at=None):
+    """
+    Records the time a tunnel reached a stage, if a trace of it is running and it had not
+    reached that stage yet.
+
+    :param at: Unix time, now by default
+    """
+    key = TRACE_KEY.format(tunnel_id)
+    try:
+        if redis_client().exists(key):
+            redis_client().hsetnx(key, stage, at or time.time())
+    except RedisError as e:
+        logger.warning(f"Failed to record {stage} of tunnel {tunnel_id}: {e}")
+
+
+def record_instant(label):
+    """
+    Counts a viewer of a pipeline that was up already, whose first frame has no wait, in the
+    total of its label.
+    """
+    try:
+        redis_client().hincrby(HISTOGRAM_KEY.format(label, TOTAL), LatencyHistogram().bucket(0.0), 1)
+    except RedisError as e:
+        logger.warning(f"Failed to record an instant start of a {label} stream: {e}")
+
+
+def stage_latencies(trace):
+    """
+    Splits a trace into the time each stage took, from the stage reached before it.
+
+    :param trace: {stage: Unix time}
+    :return: {stage: seconds, ..., "total": seconds from the watch request to the last stage}
+    """
+    reached = [(stage, trace[stage]) for stage in STAGES if stage in trace]
+    latencies = {}
+    for (_, previous), (stage, at) in zip(reached, reached[1:]):
+        # Stages reported by other processes can be out of order by a clock tick
+        latencies[stage] = max(at - previous, 0.0)
+    if reached and reached[0][0] == "watch" and len(reached) > 1:
+        latencies[TOTAL] = max(reached[-1][1] - reached[0][1], 0.0)
+    return latencies
+
+
+def finish(tunnel_id):
+    """
+    Completes the trace of a tunnel at its first segment: adds the setup stages its tunnel
+    published, and adds the latency of every stage to its histogram.
+
+    :return: {stage: seconds} of the trace, or None if there was none
+    """
+    key = TRACE_KEY.format(tunnel_id)
+    try:
+        pipeline = redis_client().pipeline()
+        pipeline.hgetall(key)
+        pipeline.delete(key)
+        trace, _ = pipeline.execute()
+        if not trace:
+            return None
+        trace = {stage.decode(): at.decode() for stage, at in trace.items()}
+        label = trace.pop("label", "cold")
+        trace = {stage: float(at) for stage, at in trace.items()}
+        stats = read_stats(tunnel_stats_path(tunnel_id)) or {}
+        for stage in TUNNEL_STAGES:
+            if stats.get(stage):
+                trace.setdefault(stage, stats[stage])
+        trace.setdefault("first_segment", time.time())
+        # Left over from an earlier start (e.g. a tunnel that kept running)
+        trace = {stage: at for stage, at in trace.items() if at >= trace.get("watch", 0)}
+
+        latencies = stage_latencies(trace)
+        pipeline = redis_client().pipeline()
+        histogram = LatencyHistogram()
+        for stage, seconds in latencies.items():
+            pipeline.hincrby(HISTOGRAM_KEY.format(label, stage), histogram.bucket(seconds), 1)
+            pipeline.hincrbyfloat(HISTOGRAM_KEY.format(label, stage), "sum", seconds)
+        pipeline.execute()
+    except RedisError as e:
+        logger.warning(f"Failed to finish the TTFF trace of tunnel {tunnel_id}: {e}")
+        return None
+    logger.info(f"Tunnel {tunnel_id} ({label}) time to first frame: " + ", ".join(f"{stage} {seconds:.3f} s" for stage, seconds in latencies.items()))
+    return latencies
+
+
+def histograms(labels=LABELS):
+    """
+    :param labels: Labels whose histograms are added up, all by default
+    :return: {stage: LatencyHistogram} of every stage and of the total, in order
+    """
+    pipeline = redis_client().pipeline()
+    names = [*STAGES[1:], TOTAL]
+    for stage in names:
+        for label in labels:
+            pipeline.hgetall(HISTOGRAM_KEY.format(label, stage))
+    replies = iter(pipeline.execute())
+    result = {}
+    for stage in names:
+        histogram = result[stage] = LatencyHistogram()
+        for _ in labels:
+            fields = {name.decode(): value for name, value in next(replies).items()}
+            for index in range(len(LATENCY_BUCKETS) + 1):
+                histogram.counts[index] += int(fields.get(str(index), 0))
+            histogram.total += float(fields.get("sum", 0.0))
+    return result
+
+
+def reset():
+    redis_client().delete(*(HISTOGRAM_KEY.format(label, stage) for label in LABELS for stage in (*STAGES[1:], TOTAL)))
@@ -0,0 +1,30 @@
+import time
+
+from ..amt.metrics import PUBLISH_INTERVAL, read_stats, stats_path
+
+# Metrics older than this many seconds come from a tunnel that stopped publishing
+STALE_AFTER = 5 * PUBLISH_INTERVAL
+
+
+def tunnel_stats_path(tunnel_id):
+    """
+    Returns the path of the shared-memory block a tunnel publishes its metrics to.
+    """
+    return stats_path(tunnel_id)
+
+
+def get_tunnel_stats(tunnel_id):
+    """
+    Reads the data-plane metrics of a tunnel: packets, bytes, bitrate (bit/s), arrival gaps,
+    MPEG-TS continuity errors, payloads lost in the hand-off to ffmpeg and AMT control messages.
+
+    :param tunnel_id: ID of the tunnel
+    :return: Dictionary of metrics with their age in seconds and a "stale" flag, or None if the
+             tunnel has not published any
+    """
+    stats = read_stats(tunnel_stats_path(tunnel_id))
+    if stats is None:
+        return None
+    stats["age"] = time.time() - stats["updated"]
+    stats["stale"] = stats["age"] > STALE_AFTER
+    return stats
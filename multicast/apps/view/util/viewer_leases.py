@@ -0,0 +1,109 @@
+import re
+import time
+import uuid
+
+from django.core import signing
+from redis import Redis
+
+from ....settings import CELERY_BROKER_URL, PIPELINE_START_CLAIM_TTL, TUNNEL_IDLE_GRACE, VIEWER_LEASE_TTL
+
+# Sorted set of the leases of a tunnel: lease ID -> expiry (Unix time)
+LEASE_KEY = "viewer-leases:{}"
+# Held while the tunnel and ffmpeg of a tunnel are being started
+START_CLAIM_KEY = "pipeline-start:{}"
+
+LEASE_ID = re.compile(r"[0-9a-f]{32}")
+# Longest lease token accepted: a lease ID, a separator and its signature
+LEASE_TOKEN_MAX_LENGTH = 100
+
+_redis = None
+
+
+def redis_client():
+    global _redis
+    if _redis is None:
+        _redis = Redis.from_url(CELERY_BROKER_URL)
+    return _redis
+
+
+def new_lease_id():
+    return uuid.uuid4().hex
+
+
+def lease_signer(tunnel_id):
+    return signing.Signer(salt=f"viewer-lease:{tunnel_id}")
+
+
+def lease_token(tunnel_id, lease_id):
+    """
+    :return: The token the watch page renews and releases a lease of a tunnel with: its lease ID,
+        signed for that tunnel so that clients cannot make up leases
+    """
+    return lease_signer(tunnel_id).sign(lease_id)
+
+
+def lease_id_from_token(tunnel_id, token):
+    """
+    :return: The lease ID of a token lease_token() issued for the tunnel, or None if it did not
+    """
+    if not token or len(token) > LEASE_TOKEN_MAX_LENGTH:
+        return None
+    try:
+        lease_id = lease_signer(tunnel_id).unsign(token)
+    except signing.BadSignature:
+        return None
+    return lease_id if LEASE_ID.fullmatch(lease_id) else None
+
+
+def renew_lease(tunnel_id, lease_id, ttl=VIEWER_LEASE_TTL):
+    """
+    Creates or extends the lease of one viewer of a tunnel.
+
+    :param ttl: Seconds the lease lasts unless it is renewed again
+    """
+    key = LEASE_KEY.format(tunnel_id)
+    pipeline = redis_client().pipeline()
+    pipeline.zadd(key, {lease_id: time.time() + ttl})
+    # Expired leases stay in the set through the grace period, so the reaper knows when the last
+    # one ran out; the set itself goes once nobody renews anything
+    pipeline.expire(key, ttl + TUNNEL_IDLE_GRACE + 60)
+    pipeline.execute()
+
+
+def release_lease(tunnel_id, lease_id):
+    """
+    Ends a lease now, e.g. when the viewer closes the page. The grace period still applies.
+    """
+    redis_client().zadd(LEASE_KEY.format(tunnel_id), {lease_id: time.time()}, xx=True)
+
+
+def lease_state(tunnel_id):
+    """
+    :return: (number of live leases, expiry of the latest lease or None if there is none)
+    """
+    key = LEASE_KEY.format(tunnel_id)
+    now = time.time()
+    pipeline = redis_client().pipeline()
+    pipeline.zremrangebyscore(key, "-inf", now - TUNNEL_IDLE_GRACE - VIEWER_LEASE_TTL)
+    pipeline.zcount(key, f"({now}", "+inf")
+    pipeline.zrange(key, -1, -1, withscores=True)
+    _, live, latest = pipeline.execute()
+    return live, latest[0][1] if latest else None
+
+
+def claim_start(tunnel_id, ttl=PIPELINE_START_CLAIM_TTL):
+    """
+    Claims the start of the pipeline of a tunnel, so that concurrent viewers (and the reaper)
+    start it once.
+
+    :return: True if the caller should start it
+    """
+    return bool(redis_client().set(START_CLAIM_KEY.format(tunnel_id), 1, nx=True, ex=ttl))
+
+
+def start_claimed(tunnel_id):
+    return bool(redis_client().exists(START_CLAIM_KEY.format(tunnel_id)))
+
+
+def release_start_claim(tunnel_id):
+    redis_client().delete(START_CLAIM_KEY.format(tunnel_id))
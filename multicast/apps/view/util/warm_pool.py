@@ -0,0 +1,34 @@
+from ....settings import WARM_POOL_CPU_BUDGET, WARM_POOL_SIZE
+from ..models import Stream, TrendingStream
+from .admission import pipeline_cpu
+
+
+def ranked_streams(size=WARM_POOL_SIZE):
+    """
+    Returns the streams most likely to be opened, most likely first: the editors' choice, then
+    the trending streams by score.
+    """
+    streams = list(Stream.objects.filter(editors_choice=True, active=True).order_by("-trending_stream__score"))
+    chosen = {stream.id for stream in streams}
+    for trending_stream in TrendingStream.objects.select_related("stream").filter(stream__active=True)[:size]:
+        if trending_stream.stream.id not in chosen:
+            streams.append(trending_stream.stream)
+            chosen.add(trending_stream.stream.id)
+    return streams[:size]
+
+
+def select_warm(candidates, budget=WARM_POOL_CPU_BUDGET):
+    """
+    Picks the candidates to keep warm: in order, every one that still fits in the CPU budget.
+
+    :param candidates: List of (stream, tunnel or None), most likely first
+    :return: List of (stream, tunnel or None, CPU cost)
+    """
+    selected = []
+    for stream, tunnel in candidates:
+        cost = pipeline_cpu(tunnel)
+        if cost <= budget:
+            selected.append((stream, tunnel, cost))
+            budget -= cost
+    return selected
+
@@ -3,20 +3,28 @@ import time
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
 from django.core.paginator import Paginator
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.http.response import Http404
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 from django.http import FileResponse
-from wsgiref.util import FileWrapper
 from django.shortcuts import get_object_or_404, render
 from django.views.decorators.cache import never_cache
-from django.db.models import F
+from django.views.decorators.http import require_POST
 from django.db import connection
 
 from redis import Redis
+from redis.exceptions import RedisError
 from .models import Stream, Tunnel
-from .tasks import open_tunnel, start_ffmpeg
+from .util.admission import capacity_status
+from .util.hls_http import hls_response, is_file_segment, sendfile_response
+from .util.llhls import BlockingRequestError, low_latency_hls, parts_playlist_name
+from .util.segment_store import segment_store
+from .util.tunnel_stats import get_tunnel_stats
+from .util.readiness import readiness_listener
+from .util.segment_index import first_segment_written
+from .util import ttff
+from .util.viewer_leases import lease_id_from_token, lease_token, new_lease_id, release_lease, renew_lease
 import time
 import logging
 import glob
@@ -24,8 +32,17 @@ import glob
 from .forms import DescriptionForm, CustomUserCreationForm
 from .models import Category, Description, Stream, TrendingStream, Tunnel
 
-from ...settings import TRENDING_STREAM_MAX_VISIBLE_SIZE, MEDIA_ROOT, CELERY_BROKER_URL
-from .tasks import open_tunnel, start_ffmpeg
+from ...settings import (
+    TRENDING_STREAM_MAX_VISIBLE_SIZE,
+    HLS_ROOT,
+    HLS_SENDFILE,
+    CELERY_BROKER_URL,
+    READINESS_RETRY_DELAY,
+    READINESS_WAIT_TIMEOUT,
+    VIEWER_LEASE_RENEW_INTERVAL,
+    VIEWER_LEASE_TTL,
+)
+from .tasks import start_pipeline
 
 import os
 
@@ -154,41 +171,37 @@ def detail(request, stream_id):
 
 
 def serve_media_file(request, path):
-    file_path = os.path.join(MEDIA_ROOT, "tunnel-files", path)
-    print(f"Requested file path: {file_path}")
+    """
+    Serves a live playlist or segment of a tunnel from the in-memory segment store, or hands
+    segments to the front end (HLS_SENDFILE). Playlists of low-latency tunnels are built from
+    their parts; _HLS_msn and _HLS_part make the request block until the playlist holds that
+    segment or part.
+    """
+    try:
+        msn = int(request.GET["_HLS_msn"]) if "_HLS_msn" in request.GET else None
+        part = int(request.GET["_HLS_part"]) if "_HLS_part" in request.GET else None
+    except ValueError:
+        return HttpResponseBadRequest("Invalid _HLS_msn or _HLS_part")
+
+    if HLS_SENDFILE and is_file_segment(path):
+        # Waits for a low-latency part a preload hint announced
+        if os.path.exists(os.path.join(HLS_ROOT, path)) or low_latency_hls.get(path) is not None:
+            return sendfile_response(path)
+        raise Http404("File not found")
 
     try:
-        if os.path.exists(file_path):
-            print(f"File exists: {file_path}")
-            with open(file_path, "rb") as file_handle:
-                content_type = (
-                    "application/vnd.apple.mpegurl"
-                    if path.endswith(".m3u8")
-                    else "video/mp2t"
-                )
-                response = HttpResponse(
-                    FileWrapper(file_handle), content_type=content_type
-                )
-                response["Content-Disposition"] = (
-                    f'inline; filename="{os.path.basename(file_path)}"'
-                )
-                response["Cache-Control"] = (
-                    "no-store, no-cache, must-revalidate, max-age=0"
-                )
-                response["Pragma"] = "no-cache"
-                response["Expires"] = "Thu, 01 Jan 1970 00:00:00 GMT"
-                print(f"Serving file: {file_path}")
-                return response
-        else:
-            print(f"File does not exist at the given path: {file_path}")
-            raise Http404("File not found")
-    except Exception as e:
-        print(f"Error serving file: {str(e)}")
+        hls_file = low_latency_hls.get(path, msn, part) or segment_store.get(path)
+    except BlockingRequestError as e:
+        return HttpResponseBadRequest(str(e))
+    if hls_file is None:
         raise Http404("File not found")
+    return hls_response(request, path, hls_file)
 
 
 @never_cache
 def watch(request, stream_id):
+    # Start of the stream's time to first frame, if this viewer starts its pipeline
+    watch_at = time.time()
     # Clear up resources
     connection.close()
     redis = Redis.from_url(CELERY_BROKER_URL)
@@ -200,22 +213,27 @@ def watch(request, stream_id):
             if client.get('flags', '') == 'N' and int(client.get('idle', 0)) > 300:  # 5 minutes idle
                 redis.client_kill(addr=client['addr'])
     except Exception as e:
-        print(f"Error cleaning up Redis clients: {e}")
+        logger.warning(f"Error cleaning up Redis clients: {e}")
 
     stream = get_object_or_404(Stream, id=stream_id)
     tunnel, created = Tunnel.objects.get_or_create(stream=stream)
 
-    if not tunnel.amt_gateway_up:
-        open_tunnel.delay(tunnel.id)
-    
-    if not tunnel.ffmpeg_up:
-        start_ffmpeg.delay(tunnel.id)
-
-    Tunnel.objects.filter(id=tunnel.id).update(active_viewer_count=F('active_viewer_count') + 1)
+    # Take the lease before looking at the pipeline, so that the reaper never stops it under a new viewer
+    lease_id = new_lease_id()
+    renew_lease(tunnel.id, lease_id)
+    if tunnel.ready_for_viewing():
+        ttff.record_instant(ttff.tunnel_label(tunnel))
+    start_pipeline(tunnel, watch_at)
 
     context = {
         "stream_id": stream_id,
         "status_check_url": reverse("view:check_stream_status", args=[stream_id]),
+        "status_wait_timeout": READINESS_WAIT_TIMEOUT,
+        "status_retry_delay": READINESS_RETRY_DELAY,
+        "lease_url": reverse("view:viewer_lease", args=[stream_id]),
+        "lease_token": lease_token(tunnel.id, lease_id),
+        "lease_renew_interval": VIEWER_LEASE_RENEW_INTERVAL,
+        "low_latency": stream.low_latency,
     }
 
     response = render(request, "view/watch.html", context=context)
@@ -226,28 +244,83 @@ def watch(request, stream_id):
     return response
 
 
+@never_cache
+@require_POST
+def viewer_lease(request, stream_id):
+    """
+    Renews the lease of a viewer of the watch page, or releases it when "release" is posted.
+    A renewal restarts a pipeline that was stopped in the meantime.
+    """
+    stream = get_object_or_404(Stream, id=stream_id)
+    tunnel = get_object_or_404(Tunnel, stream=stream)
+    # Only leases this server issued for the tunnel, on the watch page
+    lease_id = lease_id_from_token(tunnel.id, request.POST.get("lease"))
+    if lease_id is None:
+        return JsonResponse({"status": "error", "error": "No valid lease given"}, status=400)
+
+    if request.POST.get("release"):
+        release_lease(tunnel.id, lease_id)
+        return JsonResponse({"status": "released"})
+    renew_lease(tunnel.id, lease_id)
+    start_pipeline(tunnel)
+    return JsonResponse({"status": "ok", "ttl": VIEWER_LEASE_TTL})
+
+
+def stream_status(tunnel):
+    """
+    Returns the status of a tunnel for the watch page once ffmpeg wrote its first segment, or
+    while its start waits for capacity or was turned away, or None.
+    """
+    written = first_segment_written(tunnel.id)
+    if written is None:
+        # No supervisor indexes the files
+        written = first_segment_listed(tunnel)
+    if written:
+        return {
+            "status": "ready",
+            "watch_file": f"/media/tunnel-files/{tunnel.get_filename()}",
+        }
+    try:
+        return capacity_status(tunnel.id)
+    except RedisError:
+        return None
+
+
+def first_segment_listed(tunnel):
+    output_file = os.path.join(HLS_ROOT, tunnel.get_filename())
+
+    # Low-latency tunnels have a playlist of parts instead
+    if os.path.exists(output_file) or os.path.exists(parts_playlist_name(output_file)):
+        return bool(glob.glob(f"{output_file}_*.ts") or glob.glob(f"{output_file}_p*.m4s"))
+    return False
+
+
 @never_cache
 def check_stream_status(request, stream_id):
+    """
+    Returns whether the stream can be played. With ?wait=1, a stream that cannot be played yet
+    holds the request until it can (announced by the media supervisor), for at most
+    READINESS_WAIT_TIMEOUT seconds.
+    """
+    tunnel = get_object_or_404(Tunnel, stream_id=stream_id)
+
+    if request.GET.get("wait"):
+        status = readiness_listener.wait(tunnel.id, lambda: stream_status(tunnel), READINESS_WAIT_TIMEOUT)
+    else:
+        status = stream_status(tunnel)
+    return JsonResponse(status or {"status": "not_ready"})
+
+
+@never_cache
+def tunnel_stats(request, stream_id):
     stream = get_object_or_404(Stream, id=stream_id)
     tunnel = get_object_or_404(Tunnel, stream=stream)
 
-    output_file = os.path.join(MEDIA_ROOT, "tunnel-files", tunnel.get_filename())
-    print(f"Checking status for stream {stream_id}. Output file: {output_file}")
-
-    if os.path.exists(output_file):
-        print(f"M3U8 file exists: {output_file}")
-        ts_files = glob.glob(f"{output_file}_*.ts")
-        print(f"Found {len(ts_files)} TS files")
-        if ts_files:
-            watch_file = f"/media/tunnel-files/{tunnel.get_filename()}"
-            print(f"Stream ready. Watch file URL: {watch_file}")
-            return JsonResponse({
-                "status": "ready",
-                "watch_file": watch_file,
-            })
-    
-    print("Stream not ready yet")
-    return JsonResponse({"status": "not_ready"})
+    media = {"mode": tunnel.media_mode, "reason": tunnel.media_mode_reason}
+    stats = get_tunnel_stats(tunnel.id)
+    if stats is None:
+        return JsonResponse({"status": "unavailable", "media": media})
+    return JsonResponse({"status": "stale" if stats["stale"] else "ok", "stats": stats, "media": media})
 
 
 # Download a .m3u file for the user to open in VLC
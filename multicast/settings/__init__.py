@@ -4,6 +4,8 @@ from pathlib import Path
 import mimetypes
 import dj_database_url
 import os
+import socket
+import tempfile
 from importlib_metadata import entry_points
 
 from ..celery import app as celery_app
@@ -153,6 +155,31 @@ CELERY_BEAT_SCHEDULE = {
         "schedule": celery.schedules.crontab(minute=0, hour=1),
         "args": (),
     },
+    "probe_amt_relays": {
+        "task": "multicast.apps.view.tasks.probe_relays",
+        "schedule": 30.0,
+        "args": (),
+    },
+    "reap_idle_tunnels": {
+        "task": "multicast.apps.view.tasks.reap_idle_tunnels",
+        "schedule": 15.0,
+        "args": (),
+    },
+    "recover_port_leases": {
+        "task": "multicast.apps.view.tasks.recover_port_leases",
+        "schedule": 30.0,
+        "args": (),
+    },
+    "admit_queued": {
+        "task": "multicast.apps.view.tasks.admit_queued",
+        "schedule": 5.0,
+        "args": (),
+    },
+    "warm_pool": {
+        "task": "multicast.apps.view.tasks.warm_pool",
+        "schedule": 60.0,
+        "args": (),
+    },
 }
 
 # CORS Header
@@ -167,6 +194,135 @@ TRENDING_STREAM_INIT_SCORE = 1.0
 TRENDING_STREAM_MAX_SIZE = 20
 TRENDING_STREAM_MAX_VISIBLE_SIZE = 10
 
+# AMT gateway daemon (apps/view/amt/gateway.py)
+# When set, tunnels are opened as sessions on the daemon listening on this unix socket
+# instead of starting one tunnel.py process per stream.
+AMT_GATEWAY_SOCKET = os.environ.get("AMT_GATEWAY_SOCKET")
+AMT_GATEWAY_TIMEOUT = 5
+
+# Health scores of the AMT relays (apps/view/amt/relays.py), refreshed by the probe_relays task
+# and read by the tunnels and the gateway daemon to try the healthiest relay address first
+AMT_RELAY_STATE = os.environ.get("AMT_RELAY_STATE", os.path.join(tempfile.gettempdir(), "amt-relays.json"))
+
+# Hand-off from the AMT tunnel to ffmpeg: "udp" (loopback UDP), "fifo" (named pipe) or "unix"
+# (unix stream socket). The stream transports apply backpressure instead of dropping datagrams
+# in the kernel. Tunnels opened on the AMT gateway daemon always use "udp".
+TUNNEL_TRANSPORT = os.environ.get("TUNNEL_TRANSPORT", "udp")
+# Directory of the named pipes and unix sockets of the stream transports
+TUNNEL_RUNTIME_DIR = os.environ.get("TUNNEL_RUNTIME_DIR", os.path.join(tempfile.gettempdir(), "multicast-tunnels"))
+
+# Packaging of the streams by ffmpeg: "auto" probes the input and remuxes (stream copy)
+# sources that browsers can play as they are, "remux" and "transcode" force one mode
+TRANSCODE_POLICY = os.environ.get("TRANSCODE_POLICY", "auto")
+# Largest sources the auto policy remuxes; bigger ones are transcoded down to the HLS profile
+REMUX_MAX_HEIGHT = 1080
+REMUX_MAX_BITRATE = 10_000_000
+# Seconds of input ffprobe analyses before the packaging is decided
+MEDIA_PROBE_DURATION = 3
+# Renditions of the adaptive-bitrate ladder of streams (or categories) with abr_ladder set:
+# (name, height, video kbit/s), all encoded from one decode. Rungs taller than the source are left out.
+HLS_LADDER = (
+    ("1080p", 1080, 5000),
+    ("720p", 720, 2800),
+    ("480p", 480, 1200),
+)
+# Adds an audio-only rendition to the ladder
+HLS_LADDER_AUDIO_ONLY = True
+
+# Live HLS playlists and segments. ffmpeg writes them to tmpfs when there is one, so that segments
+# never touch the disk, and the views serve the live window of each tunnel from memory
+# (apps/view/util/segment_store.py)
+HLS_ROOT = os.environ.get(
+    "HLS_ROOT", "/dev/shm/multicast-hls" if os.path.isdir("/dev/shm") else os.path.join(MEDIA_ROOT, "tunnel-files")
+)
+# Segments kept in memory per rendition, and the most a web process keeps in memory in total
+HLS_STORE_SEGMENTS = 6
+HLS_STORE_MAX_BYTES = 256 * 1024 * 1024
+# Hands segments to the front end instead of sending them from Python: "x-accel-redirect" (nginx,
+# with an internal location serving HLS_ROOT under HLS_SENDFILE_PREFIX) or "x-sendfile" (Apache
+# mod_xsendfile, lighttpd). Unset, the views send them from memory.
+HLS_SENDFILE = os.environ.get("HLS_SENDFILE")
+HLS_SENDFILE_PREFIX = "/internal/hls/"
+# Seconds players and caches may reuse a playlist before revalidating it (segments are immutable)
+HLS_PLAYLIST_MAX_AGE = 1
+
+# Low-latency HLS of streams with low_latency set (apps/view/util/llhls.py): ffmpeg cuts CMAF parts
+# of LL_HLS_PART_SECONDS, LL_HLS_PARTS_PER_SEGMENT parts make a segment, and playlist and preload
+# hint requests are held for at most LL_HLS_BLOCK_TIMEOUT seconds until what they ask for exists.
+# Held requests are woken when ffmpeg writes the playlist (announced by the media supervisor), and
+# check again every LL_HLS_RECHECK_INTERVAL seconds in case an announcement was missed.
+LL_HLS_PART_SECONDS = 1.0
+LL_HLS_PARTS_PER_SEGMENT = 4
+LL_HLS_BLOCK_TIMEOUT = 6.0
+LL_HLS_RECHECK_INTERVAL = 0.25
+
+# Media supervisor (apps/view/supervisor.py, "python manage.py media_supervisor"): owns the tunnel
+# and ffmpeg processes; the Celery tasks only send it commands over this unix socket
+MEDIA_SUPERVISOR_SOCKET = os.environ.get(
+    "MEDIA_SUPERVISOR_SOCKET", os.path.join(tempfile.gettempdir(), "media-supervisor.sock")
+)
+MEDIA_SUPERVISOR_TIMEOUT = 5
+# Restarts of a crashed process wait SUPERVISOR_BACKOFF_BASE * 2^(crashes - 1) seconds, at most
+# SUPERVISOR_BACKOFF_MAX; a process that ran SUPERVISOR_STABLE_AFTER seconds starts over. After
+# SUPERVISOR_CRASH_LOOP_RESTARTS crashes within SUPERVISOR_CRASH_LOOP_WINDOW seconds it is given up.
+SUPERVISOR_BACKOFF_BASE = 1.0
+SUPERVISOR_BACKOFF_MAX = 60.0
+SUPERVISOR_STABLE_AFTER = 60.0
+SUPERVISOR_CRASH_LOOP_RESTARTS = 5
+SUPERVISOR_CRASH_LOOP_WINDOW = 300.0
+
+# Viewer leases (apps/view/util/viewer_leases.py): the watch page renews its lease every
+# VIEWER_LEASE_RENEW_INTERVAL seconds, and the reap_idle_tunnels task stops the tunnel and ffmpeg
+# of a stream TUNNEL_IDLE_GRACE seconds after its last lease expired
+VIEWER_LEASE_TTL = 30
+VIEWER_LEASE_RENEW_INTERVAL = 10
+TUNNEL_IDLE_GRACE = 60
+# Seconds a started pipeline has to come up before another viewer may start it again
+PIPELINE_START_CLAIM_TTL = 90
+
+# Readiness long-poll (apps/view/util/readiness.py): check_stream_status?wait=1 holds the request
+# of the watch page until the media supervisor announces the first segment of the stream over
+# Redis pub/sub, for at most READINESS_WAIT_TIMEOUT seconds, and checks the files again every
+# READINESS_RECHECK_INTERVAL seconds in case an announcement was missed. A held request occupies
+# a gunicorn thread, so the hold is short and the watch page asks again READINESS_RETRY_DELAY
+# seconds after a not_ready answer.
+READINESS_WAIT_TIMEOUT = 3
+READINESS_RECHECK_INTERVAL = 1.0
+READINESS_RETRY_DELAY = 1.0
+
+# Admission control (apps/view/util/admission.py): a pipeline starts only if its node stays
+# within these budgets, counting the pipelines it was asked to start but that do not run yet.
+# Others wait in a queue of at most ADMISSION_QUEUE_MAX tunnels, which the admit_queued task
+# starts in order as capacity frees up; beyond that they are turned away. Viewers of both see a
+# "capacity" status. Each media supervisor reports the load of its node as NODE_NAME.
+NODE_NAME = os.environ.get("NODE_NAME", socket.gethostname())
+ADMISSION_MAX_CPU_PERCENT = float(os.environ.get("ADMISSION_MAX_CPU_PERCENT", 85))
+ADMISSION_MAX_MEMORY_PERCENT = float(os.environ.get("ADMISSION_MAX_MEMORY_PERCENT", 90))
+# Bits per second the node may send; 0 for no limit
+ADMISSION_MAX_EGRESS_BPS = int(os.environ.get("ADMISSION_MAX_EGRESS_BPS", 0))
+ADMISSION_MAX_PIPELINES = int(os.environ.get("ADMISSION_MAX_PIPELINES", 40))
+ADMISSION_QUEUE_MAX = 20
+
+# Port pool (apps/view/util/port_pool.py): every started tunnel leases a pair of local ports, the
+# AMT port AMT_PORT_BASE + i and the UDP port ffmpeg reads from UDP_PORT_BASE + i, for
+# i < PORT_POOL_SIZE. The recover_port_leases task renews the leases of running tunnels and
+# returns those of stopped ones; a pair is handed out again PORT_REUSE_DELAY seconds after its
+# release, or once its lease ran out after a crash.
+PORT_POOL_SIZE = int(os.environ.get("PORT_POOL_SIZE", 1000))
+AMT_PORT_BASE = int(os.environ.get("AMT_PORT_BASE", 2000))
+UDP_PORT_BASE = int(os.environ.get("UDP_PORT_BASE", 4000))
+PORT_LEASE_TTL = 120
+PORT_REUSE_DELAY = 30
+
+# Warm pool (apps/view/util/warm_pool.py): the warm_pool task keeps the pipelines of the
+# WARM_POOL_SIZE streams most likely to be watched (editors' choice, then the trending streams)
+# running without viewers, as long as they fit in WARM_POOL_CPU_BUDGET cores. Running pipelines
+# count with the CPU use their media supervisor measured, the others with the cost of their last
+# media mode.
+WARM_POOL_SIZE = int(os.environ.get("WARM_POOL_SIZE", 5))
+WARM_POOL_CPU_BUDGET = float(os.environ.get("WARM_POOL_CPU_BUDGET", 2.0))
+WARM_POOL_CPU_COST = {"remux": 0.1, "transcode": 1.0, "ladder": 2.5}
+
 # Check for Heroku environment
 if "DATABASE_URL" in os.environ:
     DATABASES = {"default": dj_database_url.config()}